@@ -0,0 +1,102 @@
+import asyncio
+import logging
+
+logger = logging.getLogger("cobra.batching")
+
+
+class MicroBatcher:
+    """
+    Groups records submitted by concurrent requests into micro-batches.
+
+    A batch is closed once it holds max_batch_size records or max_wait seconds
+    after its first record arrived, and is scored by predict_batch (a function
+    from a list of records to a list of results, in order) in the executor
+    (None is the event loop's default thread pool). At most max_concurrency
+    batches run at a time; records keep queuing up meanwhile, which is what
+    makes batches grow under load.
+    """
+
+    def __init__(self, predict_batch, max_batch_size=64, max_wait=0.005,
+                 max_concurrency=2, executor=None):
+        self.predict_batch = predict_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.max_concurrency = max_concurrency
+        self.executor = executor
+        self._queue = None
+        self._worker = None
+        # the event loop only keeps weak references to tasks, running batches
+        # are held here until they are done
+        self._tasks = set()
+
+    async def submit(self, record):
+        if self._worker is None or self._worker.done():
+            # the queue and its consumer belong to the running event loop
+            self._queue = asyncio.Queue()
+            self._slots = asyncio.Semaphore(self.max_concurrency)
+            self._worker = asyncio.ensure_future(self._collect())
+
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((record, future))
+        return await future
+
+    async def _collect(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            await self._slots.acquire()
+            task = asyncio.ensure_future(self._run(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._task_done)
+
+    def _task_done(self, task):
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Batch failed", exc_info=task.exception())
+
+    async def _run(self, batch):
+        loop = asyncio.get_running_loop()
+        records = [record for record, _ in batch]
+        try:
+            try:
+                results = await loop.run_in_executor(
+                    self.executor, self.predict_batch, records)
+                outcomes = [(result, None) for result in results]
+            except Exception as e:
+                if len(batch) == 1:
+                    outcomes = [(None, e)]
+                else:
+                    # score the records one by one so that a bad record only
+                    # fails its own request
+                    logger.warning("Batch of %d failed, retrying records singly", len(batch))
+                    outcomes = [await self._run_single(record) for record in records]
+        finally:
+            self._slots.release()
+
+        for (_, future), (result, error) in zip(batch, outcomes):
+            # the caller may have gone away (and its future been cancelled)
+            if future.done():
+                continue
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+    async def _run_single(self, record):
+        loop = asyncio.get_running_loop()
+        try:
+            results = await loop.run_in_executor(
+                self.executor, self.predict_batch, [record])
+            return results[0], None
+        except Exception as e:
+            return None, e
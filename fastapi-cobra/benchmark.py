@@ -0,0 +1,358 @@
+# Benchmarks of the COBRA models and the API, written as JSON so that runs
+# of different commits can be compared.
+#
+#   python benchmark.py --output before.json
+#   python benchmark.py --scales 1 10 100 1000 --output after.json --compare before.json
+#   python benchmark.py --precision
+#
+# For every dataset this measures the cold start of a fresh process, the
+# single-row latency percentiles of the prediction path (split into
+# preprocessing and ClassifierCobra.predict) and of the endpoint, the batch
+# throughput over several batch sizes, the fit time of every machine in
+# load_default and the memory peak of fitting and batch prediction. Scaled
+# runs calibrate COBRA on the data copied `scale` times with a little noise.
+# The precision report compares the float32 mode (COBRA_PRECISION=float32)
+# with the float64 models on the data files.
+
+from pathlib import Path
+import argparse
+import json
+import pickle
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+import classifiercobra
+from registry import BASE_DIR, registry, with_precision
+from score import AUSTRALIAN_COLUMNS, GERMAN_COLUMNS
+
+DATASETS = ("australian", "german")
+
+COLD_START = '''
+import time
+start = time.perf_counter()
+import model_{0} as m
+rows = {1!r}
+m.predict_batch_{0}(rows)
+print(time.perf_counter() - start)
+'''
+
+
+def load_data(dataset):
+    # raw model inputs and labels of the bundled data files
+    if dataset == "australian":
+        df = pd.read_csv(BASE_DIR.joinpath("data", "australian.dat"), sep=r"\s+", header=None)
+        return pd.DataFrame(df.iloc[:, :14].values, columns=AUSTRALIAN_COLUMNS), df.iloc[:, 14].values
+    df = pd.read_csv(BASE_DIR.joinpath("data", "german.csv"))
+    return df[GERMAN_COLUMNS].reset_index(drop=True), df["GoodCredit"].values
+
+
+def model_functions(dataset):
+    if dataset == "australian":
+        import model_australian as m
+
+        return m.prepare_australian, m.predict_australian, m.predict_batch_australian
+    import model_german as m
+
+    return m.prepare_german, m.predict_german, m.predict_batch_german
+
+
+def percentiles(times):
+    times = np.asarray(times) * 1000
+    return {
+        "mean_ms": float(times.mean()),
+        "p50_ms": float(np.percentile(times, 50)),
+        "p90_ms": float(np.percentile(times, 90)),
+        "p99_ms": float(np.percentile(times, 99)),
+    }
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - start
+
+
+def peak_memory(function, *args):
+    # bytes allocated at the peak of the call, as traced by tracemalloc
+    tracemalloc.start()
+    try:
+        function(*args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def bench_cold_start(dataset, frame, repeat=3):
+    # a fresh interpreter importing the model module, loading the models and
+    # scoring one record; "total" includes the interpreter start up
+    code = COLD_START.format(dataset, frame.iloc[:1].values.tolist())
+    total, first_prediction = [], []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        out = subprocess.run([sys.executable, "-c", code], cwd=str(BASE_DIR),
+                             capture_output=True, text=True, check=True)
+        total.append(time.perf_counter() - start)
+        first_prediction.append(float(out.stdout.split()[-1]))
+    return {"total_s": min(total), "load_and_first_prediction_s": min(first_prediction)}
+
+
+def bench_latency(dataset, frame, repeat):
+    prepare, _, predict_batch = model_functions(dataset)
+    rows = frame.values.tolist()
+    end_to_end, preprocess, model = [], [], []
+    for i in range(repeat):
+        row = rows[i % len(rows)]
+        end_to_end.append(timed(predict_batch, [row]))
+
+        start = time.perf_counter()
+        X, cobra = prepare(frame.iloc[i % len(rows):i % len(rows) + 1])
+        preprocess.append(time.perf_counter() - start)
+        model.append(timed(cobra.predict, X))
+    return {
+        "end_to_end": percentiles(end_to_end),
+        "preprocess": percentiles(preprocess),
+        "predict": percentiles(model),
+    }
+
+
+def bench_endpoint(dataset, frame, repeat):
+    try:
+        from fastapi.testclient import TestClient
+    except ImportError:
+        return None
+    import main
+
+    client = TestClient(main.app)
+    records = frame.to_dict("records")
+    if dataset == "australian":
+        records = [
+            {"param%d" % (i + 1): value for i, value in enumerate(record.values())}
+            for record in records
+        ]
+    times = []
+    for i in range(repeat):
+        record = records[i % len(records)]
+        start = time.perf_counter()
+        client.post("/predict_%s" % dataset, json=record).raise_for_status()
+        times.append(time.perf_counter() - start)
+    return percentiles(times)
+
+
+def bench_throughput(dataset, frame, batch_sizes, rng):
+    _, predict, _ = model_functions(dataset)
+    throughput = {}
+    for batch_size in batch_sizes:
+        batch = frame.iloc[rng.randint(len(frame), size=batch_size)].reset_index(drop=True)
+        seconds = min(timed(predict, batch) for _ in range(3))
+        throughput[str(batch_size)] = {"seconds": seconds, "rows_per_s": batch_size / seconds}
+    return throughput
+
+
+def bench_fit(X, y, machine_list):
+    cobra = classifiercobra.ClassifierCobra(random_state=0, machine_list=machine_list)
+    seconds = timed(cobra.fit, X, y)
+    return {"total_s": seconds, "machines_s": dict(cobra.fit_times_)}
+
+
+def scaled_cobra(X, y, scale, machine_list, rng):
+    # machines are fitted on the first half of the data as usual and COBRA is
+    # calibrated on the second half copied scale times, with noise so that the
+    # copies are not all duplicates
+    X, y = np.asarray(X, dtype=np.float64), np.asarray(y)
+    k = len(X) // 2
+    X_l = np.tile(X[k:], (scale, 1))
+    X_l += rng.normal(scale=0.01, size=X_l.shape) * X.std(axis=0)
+    cobra = classifiercobra.ClassifierCobra(random_state=0, machine_list=machine_list)
+    cobra.fit(np.vstack([X[:k], X_l]), np.concatenate([y[:k], np.tile(y[k:], scale)]), default=False)
+    cobra.split_data(k=k, l=len(cobra.X_), shuffle_data=False)
+    cobra.load_default(machine_list=machine_list)
+    return cobra
+
+
+def bench_scaled(X, y, scale, machine_list, batch_sizes, repeat, rng):
+    cobra = scaled_cobra(X, y, scale, machine_list, rng)
+    calibration = timed(cobra.load_machine_predictions)
+    queries = np.asarray(X, dtype=np.float64)
+    latency = [timed(cobra.predict, queries[i % len(queries)][np.newaxis]) for i in range(repeat)]
+    throughput = {}
+    for batch_size in batch_sizes:
+        batch = queries[rng.randint(len(queries), size=batch_size)]
+        seconds = min(timed(cobra.predict, batch) for _ in range(3))
+        throughput[str(batch_size)] = {"seconds": seconds, "rows_per_s": batch_size / seconds}
+    return {
+        "calibration_rows": len(cobra.X_l_),
+        "calibration_s": calibration,
+        "predict": percentiles(latency),
+        "throughput": throughput,
+    }
+
+
+def bench_precision(dataset, frame, y, batch_size, rng):
+    # float32 against float64 models on the same rows: agreement of the COBRA
+    # and machine predictions, accuracy, probability and feature drift, batch
+    # time and pickled model size
+    prepare, _, _ = model_functions(dataset)
+    prepare(frame.iloc[:1])
+    stored = registry.stored(dataset)
+    if not hasattr(stored["cobra"], "astype"):
+        # models trained before the machine bank have no float32 mode
+        return None
+
+    batch = frame.iloc[rng.randint(len(frame), size=batch_size)].reset_index(drop=True)
+    runs = {}
+    for precision in ("float64", "float32"):
+        X, cobra = prepare(frame, dict(with_precision(stored, precision)))
+        X_batch, _ = prepare(batch, dict(with_precision(stored, precision)))
+        runs[precision] = {
+            "X": X,
+            "labels": cobra.predict(X),
+            "machines": cobra._machine_labels(X),
+            "proba": cobra.predict_proba(X, kernel="gaussian"),
+            "seconds": min(timed(cobra.predict, X_batch) for _ in range(3)),
+            "bytes": len(pickle.dumps(cobra, protocol=pickle.HIGHEST_PROTOCOL)),
+        }
+    full, single = runs["float64"], runs["float32"]
+    return {
+        "rows": len(frame),
+        "prediction_agreement": float((full["labels"] == single["labels"]).mean()),
+        "differing_predictions": int((full["labels"] != single["labels"]).sum()),
+        "accuracy": {
+            "float64": float((full["labels"] == y).mean()),
+            "float32": float((single["labels"] == y).mean()),
+        },
+        "machine_agreement": {
+            machine: float((full["machines"][i] == single["machines"][i]).mean())
+            for i, machine in enumerate(cobra._machines())
+        },
+        "max_feature_diff": float(np.abs(full["X"] - single["X"]).max()),
+        "max_proba_diff": float(np.abs(full["proba"] - single["proba"]).max()),
+        "predict_%d_s" % batch_size: {"float64": full["seconds"], "float32": single["seconds"]},
+        "model_bytes": {"float64": full["bytes"], "float32": single["bytes"]},
+    }
+
+
+def run(datasets=DATASETS, scales=(1, 10, 100), batch_sizes=(1, 10, 100, 1000, 10000),
+        repeat=200, seed=0):
+    rng = np.random.RandomState(seed)
+    results = {}
+    for dataset in datasets:
+        frame, y = load_data(dataset)
+        prepare, predict, _ = model_functions(dataset)
+
+        # train and load the models, then time everything on the warm process
+        load_time = timed(prepare, frame.iloc[:1])
+        X, cobra = prepare(frame)
+        largest = frame.iloc[rng.randint(len(frame), size=max(batch_sizes))].reset_index(drop=True)
+
+        results[dataset] = {
+            "rows": len(frame),
+            "cold_start": bench_cold_start(dataset, frame),
+            "warm_load_s": load_time,
+            "latency": bench_latency(dataset, frame, repeat),
+            "endpoint": bench_endpoint(dataset, frame, repeat),
+            "throughput": bench_throughput(dataset, frame, batch_sizes, rng),
+            "fit": bench_fit(X, y, cobra.machine_list),
+            "memory_peak": {
+                "fit_bytes": peak_memory(bench_fit, X, y, cobra.machine_list),
+                "predict_%d_bytes" % len(largest): peak_memory(predict, largest),
+            },
+            "scaled": {
+                str(scale): bench_scaled(X, y, scale, cobra.machine_list, batch_sizes, repeat, rng)
+                for scale in scales
+            },
+            "precision": bench_precision(dataset, frame, y, max(batch_sizes), rng),
+        }
+    return results
+
+
+def run_precision(datasets=DATASETS, batch_size=10000, seed=0):
+    rng = np.random.RandomState(seed)
+    results = {}
+    for dataset in datasets:
+        frame, y = load_data(dataset)
+        results[dataset] = {"precision": bench_precision(dataset, frame, y, batch_size, rng)}
+    return results
+
+
+def environment():
+    import sklearn
+
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=str(BASE_DIR),
+                                capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        "commit": commit,
+        "created_at": time.time(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "sklearn": sklearn.__version__,
+    }
+
+
+def flatten(results, prefix=""):
+    flat = {}
+    for key, value in results.items():
+        name = prefix + str(key)
+        if isinstance(value, dict):
+            flat.update(flatten(value, name + "."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[name] = value
+    return flat
+
+
+def compare(baseline, current):
+    '''
+    Lines of "metric baseline current ratio" for every metric of both runs.
+    A ratio below 1 is an improvement for times and bytes, above 1 for rows_per_s.
+    '''
+    before, after = flatten(baseline["results"]), flatten(current["results"])
+    lines = []
+    for name in sorted(set(before) & set(after)):
+        ratio = after[name] / before[name] if before[name] else float("nan")
+        lines.append("%-70s %14.6g %14.6g %8.3f" % (name, before[name], after[name], ratio))
+    return lines
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the COBRA models and API.")
+    parser.add_argument("--datasets", nargs="+", choices=DATASETS, default=list(DATASETS))
+    parser.add_argument("--scales", nargs="+", type=int, default=[1, 10, 100])
+    parser.add_argument("--batch-sizes", nargs="+", type=int, default=[1, 10, 100, 1000, 10000])
+    parser.add_argument("--repeat", type=int, default=200, help="single-row requests timed")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="JSON file for the results, stdout by default")
+    parser.add_argument("--compare", help="JSON results of an earlier run to compare against")
+    parser.add_argument("--precision", action="store_true",
+                        help="only compare the float32 mode with float64")
+    args = parser.parse_args(argv)
+
+    if args.precision:
+        results = run_precision(args.datasets, max(args.batch_sizes), args.seed)
+    else:
+        results = run(args.datasets, args.scales, args.batch_sizes, args.repeat, args.seed)
+    report = {"environment": environment(), "results": results}
+
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, indent=2))
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.compare:
+        baseline = json.loads(Path(args.compare).read_text())
+        print("%-70s %14s %14s %8s" % ("metric", "baseline", "current", "ratio"), file=sys.stderr)
+        for line in compare(baseline, report):
+            print(line, file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
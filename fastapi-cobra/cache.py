@@ -0,0 +1,94 @@
+# Cache of prediction results for repeated loan applications.
+
+from collections import OrderedDict
+import hashlib
+import json
+import threading
+import time
+
+
+def request_digest(record):
+    '''
+    Canonical hash of a validated request body: the same fields and values
+    give the same digest whatever their order.
+    '''
+    body = json.dumps(record, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(body.encode("utf-8")).hexdigest()
+
+
+class PredictionCache:
+    """
+    Bounded LRU cache of predictions with a time to live, keyed by dataset and
+    request digest.
+
+    Every lookup carries the version of the models that would serve it; when
+    the version of a dataset changes (its models were reloaded or retrained),
+    the entries of that dataset are dropped. current_version, a function of
+    the dataset (e.g. registry.version), gives the version being served: a
+    prediction made by models that have since been reloaded is not cached.
+    """
+
+    def __init__(self, max_size=10000, ttl=300.0, current_version=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.current_version = current_version
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._versions = {}
+
+    def get(self, dataset, version, digest):
+        '''
+        Returns (True, prediction) on a hit and (False, None) on a miss.
+        '''
+        with self._lock:
+            self._check_version(dataset, version)
+            entry = self._entries.get((dataset, digest))
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._entries[(dataset, digest)]
+                self.misses += 1
+                return False, None
+            self._entries.move_to_end((dataset, digest))
+            self.hits += 1
+            return True, entry[1]
+
+    def put(self, dataset, version, digest, prediction):
+        # a request that started before a reload would evict fresh entries
+        # for one that is never served again
+        if self.current_version is not None and self.current_version(dataset) != version:
+            return
+        with self._lock:
+            self._check_version(dataset, version)
+            self._entries[(dataset, digest)] = (time.monotonic() + self.ttl, prediction)
+            self._entries.move_to_end((dataset, digest))
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._versions.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else None,
+                "invalidations": self.invalidations,
+                "versions": dict(self._versions),
+            }
+
+    def _check_version(self, dataset, version):
+        if self._versions.get(dataset, version) != version:
+            for key in [key for key in self._entries if key[0] == dataset]:
+                del self._entries[key]
+            self.invalidations += 1
+        self._versions[dataset] = version
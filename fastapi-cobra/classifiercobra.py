@@ -1,27 +1,98 @@
 # Licensed under the MIT License - https://opensource.org/licenses/MIT
 
-from sklearn import neighbors, tree, svm
-from sklearn.linear_model import SGDClassifier, LogisticRegression
-from sklearn.ensemble import GradientBoostingClassifier, RandomForestClassifier
-from sklearn.neural_network import MLPClassifier
-from sklearn.utils import shuffle
-from sklearn.base import BaseEstimator
-from sklearn.utils.validation import check_X_y, check_array, check_is_fitted
-from sklearn.naive_bayes import GaussianNB
-
-import math
-import numpy as np
-import random
+from sklearn.base import BaseEstimator, is_classifier
+from sklearn.utils.validation import check_X_y, check_array
+from joblib import Parallel, delayed
+
+import json
 import logging
 import numbers
+import os
+from functools import partial
+
+import consensus
+import fitting
+import machinebank
+import metrics
 
 logger = logging.getLogger("pycobra.classifiercobra")
 
+# every machine load_default knows, in the order of the "advanced" machine list:
+# name -> (estimator class, hyperparameters). Classes given by their dotted
+# path are only imported when the machine is used.
+#
+# The following machines are to be used based on the analysis done on
+# Google Colab - (mapped to symbolic representation)
+# - Decision Tree Classifier - tree
+# - K Nearest Neighbors - knn
+# - Naive Bayes - naive_bayes
+# - Support Vector Machines - svm
+# - Random Forest - random_forest
+# - Gradient Boosting - gdb
+# - Logistic Regression - logreg
+# - MLP Classifier - mlp
+MACHINES = {
+    "gdb": ("sklearn.ensemble.GradientBoostingClassifier", dict(
+        learning_rate=0.05, max_depth=2, n_estimators=50, min_samples_leaf=30, max_features='sqrt')),
+    "svm": ("sklearn.svm.SVC", dict(
+        C=0.01, kernel='linear')),
+    "random_forest": ("sklearn.ensemble.RandomForestClassifier", dict(
+        max_depth=2, n_estimators=10, min_samples_leaf=10, max_features='sqrt')),
+    "tree": ("sklearn.tree.DecisionTreeClassifier", dict(
+        class_weight='balanced', max_depth=None, max_leaf_nodes=None, min_samples_leaf=21, min_samples_split=2)),
+    "mlp": ("sklearn.neural_network.MLPClassifier", dict(
+        max_iter=1000, learning_rate='constant', activation='tanh', learning_rate_init=0.1, alpha=0.1)),
+    "logreg": ("sklearn.linear_model.LogisticRegression", dict(
+        penalty='l2', class_weight='balanced', C=0.5)),
+    "naive_bayes": ("sklearn.naive_bayes.GaussianNB", dict()),
+    "knn": ("sklearn.neighbors.KNeighborsClassifier", dict(
+        n_neighbors=20, weights='uniform')),
+}
+
+BASIC_MACHINES = ["logreg", "svm", "knn", "mlp"]
+
+
+def register_machine(name, estimator, **params):
+    """
+    Make a machine available to load_default. estimator is a class (or any
+    factory taking the hyperparameters as keyword arguments) or its dotted
+    path; params are its hyperparameters. Registering a known name replaces
+    that machine.
+    """
+    MACHINES[name] = (estimator, params)
+
+
+def load_machine_config(path):
+    """
+    Register the machines of a JSON file mapping names to {"estimator":
+    dotted path, "params": {...}}. A known machine given without "estimator"
+    only has its hyperparameters updated. Raises ValueError for a new machine
+    given without "estimator".
+    """
+    with open(path) as f:
+        config = json.load(f)
+    for name, machine in config.items():
+        if name not in MACHINES and "estimator" not in machine:
+            raise ValueError(
+                "%s: machine %r is not known and has no \"estimator\"" % (path, name))
+        estimator, params = MACHINES.get(name, (None, {}))
+        register_machine(
+            name, machine.get("estimator", estimator), **dict(params, **machine.get("params", {})))
+
+
+# machines and hyperparameters of a deployment, e.g. to tune them without code changes
+if os.environ.get("COBRA_MACHINE_CONFIG"):
+    load_machine_config(os.environ["COBRA_MACHINE_CONFIG"])
+
+
+class ClassifierCobra(BaseEstimator, consensus.CobraConsensus, fitting.MachineFitting):
+    known_machines = MACHINES
+    basic_machines = BASIC_MACHINES
 
-class ClassifierCobra(BaseEstimator):
-    def __init__(self, random_state=None, machine_list="basic"):
+    def __init__(self, random_state=None, machine_list="basic", n_jobs=None):
         self.random_state = random_state
         self.machine_list = machine_list
+        self.n_jobs = n_jobs
 
     def fit(self, X, y, default=True, X_k=None, X_l=None, y_k=None, y_l=None):
         X, y = check_X_y(X, y)
@@ -38,194 +109,142 @@ class ClassifierCobra(BaseEstimator):
                 self.split_data()
                 self.load_default(machine_list=self.machine_list)
                 self.load_machine_predictions()
+                self.load_machine_proba_predictions()
         except ValueError:
             return self
         return self
 
-    def pred(self, X, M, info=False):
-        select = {}
-        for machine in self.estimators_:
-            label = self.estimators_[machine].predict(X)
-            select[machine] = set()
-            for count in range(0, len(self.X_l_)):
-                if self.machine_predictions_[machine][count] == label:
-                    select[machine].add(count)
-
-        points = []
-
-        for count in range(0, len(self.X_l_)):
-            row_check = 0
-            for machine in select:
-                if count in select[machine]:
-                    row_check += 1
-            if row_check == M:
-                points.append(count)
-
-        # if no points are selected, return 0
-        if len(points) == 0:
-            if info:
-                logger.info("No points were selected, prediction is 0")
-                return (0, 0)
-            logger.info("No points were selected, prediction is 0")
-            return 0
-
-        classes = {}
-        for label in np.unique(self.y_l_):
-            classes[label] = 0
-
-        for point in points:
-            classes[self.y_l_[point]] += 1
-
-        result = int(max(classes, key=classes.get))
-        if info:
-            return result, points
-        return result
-
-    def predict(self, X, M=None, info=False):
-        X = check_array(X)
+    def _machines(self):
+        return list(self.estimators_)
 
-        if M is None:
-            M = len(self.estimators_)
-        if X.ndim == 1:
-            return self.pred(X.reshape(1, -1), M=M)
-
-        result = np.zeros(len(X))
-        avg_points = 0
-        index = 0
-        for vector in X:
-            if info:
-                result[index], points = self.pred(
-                    vector.reshape(1, -1), M=M, info=info)
-                avg_points += len(points)
-            else:
-                result[index] = self.pred(vector.reshape(1, -1), M=M)
-            index += 1
-
-        if info:
-            avg_points = avg_points / len(X_array)
-            return result, avg_points
-        return result
-
-    def predict_proba(self, X, kernel=None, metric=None, bandwidth=1, **kwargs):
-        probs = []
+    def _check_array(self, X):
+        return check_array(X)
+
+    def _check_X_y(self, X, y):
+        return check_X_y(X, y)
+
+    def _machine_labels(self, X):
+        predictions = []
+        for machine in self.estimators_:
+            with metrics.timer(metrics.MACHINE_SECONDS, machine=machine):
+                predictions.append(self.estimators_[machine].predict(X))
+        return consensus.stack_predictions(predictions).reshape(
+            len(self.estimators_), len(X))
+
+    def export(self):
+        """
+        The model compiled for serving, a machinebank.CompiledCobra: same
+        predictions, with the machines evaluated in NumPy rather than by
+        sklearn. This model is left unchanged. Raises ValueError when a
+        machine can not be compiled.
+        """
+        return machinebank.CompiledCobra.from_cobra(self)
+
+    def evaluate(self, X, y, cv=10, machine_lists=("basic", "advanced"), M=None,
+                 scoring=None, n_jobs=None):
+        """
+        Cross-validate several COBRA configurations against the same fits.
+
+        In every fold the union of the machine lists is fitted once, and each
+        (machine list, M) configuration is scored from the cached machine
+        predictions. Folds run in parallel over n_jobs (self.n_jobs by default).
+        The folds and the machine seeds are those of cross_val_score on
+        ClassifierCobra(random_state=self.random_state, machine_list=...), so
+        the scores match it. M defaults to the size of each machine list and
+        scoring, a function of (y_true, y_pred), to the weighted f1 score.
+
+        Returns one dict per fold and configuration, with keys fold,
+        machine_list, M, score and fit_time (seconds spent fitting the
+        machines of that list in that fold).
+        """
+        X, y = check_X_y(X, y)
+        configs = [(machine_list, fitting.machine_names(machine_list, MACHINES, BASIC_MACHINES))
+                   for machine_list in machine_lists]
+        machines = []
+        for _, names in configs:
+            machines += [name for name in names if name not in machines]
+
+        # only needed for evaluation, kept off the serving imports
+        from sklearn.metrics import f1_score
+        from sklearn.model_selection import check_cv
+
+        if scoring is None:
+            scoring = partial(f1_score, average="weighted")
+        if n_jobs is None:
+            n_jobs = self.n_jobs
+
+        splitter = check_cv(cv, y, classifier=is_classifier(self))
+        folds = Parallel(n_jobs=n_jobs)(
+            delayed(_evaluate_fold)(
+                self.random_state, machines, configs, M, scoring,
+                X[train], y[train], X[test], y[test])
+            for train, test in splitter.split(X, y)
+        )
+
+        report = []
+        for fold, rows in enumerate(folds):
+            for row in rows:
+                report.append(dict(row, fold=fold))
+        return report
+
+    def _machine_outputs(self, X):
+        # predict_proba of every machine, or decision_function when it has none
+        outputs = []
         for machine in self.estimators_:
             try:
-                probs.append(self.estimators_[machine].predict_proba(X))
+                outputs.append(self.estimators_[machine].predict_proba(X))
             except AttributeError:
-                continue
-        prob = np.mean(probs, axis=0)
-        return prob
+                outputs.append(self.estimators_[machine].decision_function(X))
+        return outputs
 
-    def split_data(self, k=None, l=None, shuffle_data=True):
-        if shuffle_data:
-            self.X_, self.y_ = shuffle(
-                self.X_, self.y_, random_state=self.random_state)
-
-        if k is None and l is None:
-            k = int(len(self.X_) / 2)
-            l = int(len(self.X_))
-
-        if k is not None and l is None:
-            l = len(self.X_) - k
-
-        if l is not None and k is None:
-            k = len(self.X_) - l
-
-        self.X_k_ = self.X_[:k]
-        self.X_l_ = self.X_[k:l]
-        self.y_k_ = self.y_[:k]
-        self.y_l_ = self.y_[k:l]
+    def load_machine_predictions(self, predictions=None):
+        # one row per machine, in the order of estimators_
+        self.machine_labels_ = None
+        self.machine_predictions_ = self._calibration_predictions(predictions)
+        # index the calibration set by prediction signature so that pred is
+        # a lookup rather than a scan over X_l_
+        self._build_index()
         return self
 
-    """
-    The following machines are to be used based on the analysis done on 
-    Google Colab - (mapped to symbolic representation)
-    - Decision Tree Classifier - tree
-    - K Nearest Neighbors - knn
-    - Naive Bayes - naive_bayes
-    - Support Vector Machines - svm
-    - Random Forest - random_forest
-    - Gradient Boosting - gdb
-    - Logistic Regression - logreg
-    - MLP Classifier - mlp
-    """
-
-    def load_default(self, machine_list="basic"):
-        if machine_list == "basic":
-            machine_list = ["logreg", "svm", "knn", "mlp"]
-        if machine_list == "advanced":
-            machine_list = [
-                "gdb",
-                "svm",
-                "random_forest",
-                "tree",
-                "mlp",
-                "logreg",
-                "naive_bayes",
-                "knn",
-            ]
-
-        for machine in machine_list:
-            try:
-                if machine == "gdb":
-                    self.estimators_["gdb"] = GradientBoostingClassifier(
-                        learning_rate=0.05, max_depth=2, n_estimators=50, min_samples_leaf=30, max_features='auto').fit(self.X_k_, self.y_k_)
-
-                if machine == "svm":
-                    self.estimators_["svm"] = svm.SVC(
-                        C=0.01, kernel='linear').fit(self.X_k_, self.y_k_)
-
-                if machine == "random_forest":
-                    self.estimators_["random_forest"] = RandomForestClassifier(
-                        max_depth=2, n_estimators=10, min_samples_leaf=10, max_features='auto').fit(self.X_k_, self.y_k_)
-
-                if machine == "tree":
-                    self.estimators_["tree"] = tree.DecisionTreeClassifier(
-                        class_weight='balanced', max_depth=None, max_leaf_nodes=None, min_samples_leaf=21, min_samples_split=2).fit(self.X_k_, self.y_k_)
-
-                if machine == "mlp":
-                    self.estimators_["mlp"] = MLPClassifier(
-                        max_iter=1000, learning_rate='constant', activation='tanh', learning_rate_init=0.1, alpha=0.1).fit(self.X_k_, self.y_k_)
-
-                if machine == "logreg":
-                    self.estimators_["logreg"] = LogisticRegression(
-                        penalty='l2', class_weight='balanced', C=0.5).fit(self.X_k_, self.y_k_)
-
-                if machine == "naive_bayes":
-                    self.estimators_["naive_bayes"] = GaussianNB().fit(
-                        self.X_k_, self.y_k_)
+    def load_machine_proba_predictions(self, predictions=None):
+        if predictions is None:
+            predictions = zip(self.estimators_, self._machine_outputs(self.X_l_))
+        self.machine_proba_predictions_ = dict(predictions)
+        # one column block per machine, in the order of estimators_
+        self._stack_calibration_scores()
+        return self
 
-                if machine == "knn":
-                    self.estimators_["knn"] = neighbors.KNeighborsClassifier(
-                        n_neighbors=20, weights='uniform').fit(self.X_k_, self.y_k_)
 
-            except ValueError:
-                continue
-        return self
+def _evaluate_fold(random_state, machines, configs, M, scoring, X_train, y_train, X_test, y_test):
+    # module level so that it can be sent to joblib worker processes
+    cobra = ClassifierCobra(random_state=random_state, machine_list=machines)
+    cobra.fit(X_train, y_train)
+    fitted = list(cobra.estimators_)
+    query_labels = cobra._machine_labels(X_test)
 
-    def load_machine(self, machine_name, machine):
-        self.estimators_[machine_name] = machine
-        return self
+    rows = []
+    for machine_list, names in configs:
+        subset = [fitted.index(name) for name in names if name in cobra.estimators_]
+        index = consensus.build_signature_index(
+            cobra.machine_predictions_[subset], cobra.y_l_codes_, len(cobra.classes_l_))
+        query_codes = consensus.encode_machine_labels(
+            query_labels[subset], index["labels"])
 
-    def load_machine_predictions(self, predictions=None):
-        self.machine_predictions_ = {}
-        if predictions is None:
-            for machine in self.estimators_:
-                self.machine_predictions_[machine] = self.estimators_[machine].predict(
-                    self.X_l_
-                )
-        return self
+        if M is None:
+            M_values = [len(subset)]
+        elif isinstance(M, numbers.Integral):
+            M_values = [M]
+        else:
+            M_values = M
+
+        # one agreement count for all the values of M
+        for m, votes in zip(M_values, consensus.sweep_votes(index, query_codes, M_values)):
+            y_pred = consensus.majority_labels(votes, cobra.classes_l_)
+            rows.append({
+                "machine_list": machine_list,
+                "M": m,
+                "score": scoring(y_test, y_pred),
+                "fit_time": sum(cobra.fit_times_[fitted[i]] for i in subset),
+            })
+    return rows
 
-    def load_machine_proba_predictions(self, predictions=None):
-        self.machine_proba_predictions_ = {}
-        if predictions is None:
-            for machine in self.estimators_:
-                try:
-                    self.machine_proba_predictions_[machine] = self.estimators_[
-                        machine
-                    ].predict_proba(self.X_l_)
-                except AttributeError:
-                    self.machine_proba_predictions_[machine] = self.estimators_[
-                        machine
-                    ].decision_function(self.X_l_)
-        return self
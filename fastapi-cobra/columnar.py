@@ -0,0 +1,171 @@
+# Columnar payloads for the batch endpoints: Apache Arrow IPC streams and
+# msgpack maps of column name -> list of values. A batch is validated one
+# column at a time in NumPy instead of one record at a time through pydantic,
+# and predictions go back as typed columns.
+
+from typing import Literal, get_args, get_origin
+
+import msgpack
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute
+
+ARROW = "application/vnd.apache.arrow.stream"
+MSGPACK = "application/msgpack"
+
+# error messages of pydantic for the field types of the request models
+MESSAGES = {
+    int: "value is not a valid integer",
+    float: "value is not a valid float",
+}
+
+
+class ColumnError(ValueError):
+    def __init__(self, column, msg, record=None):
+        super().__init__(msg)
+        self.column = column
+        self.msg = msg
+        self.record = record
+
+    def detail(self):
+        detail = {"column": self.column, "msg": self.msg}
+        if self.record is not None:
+            detail["record"] = int(self.record)
+        return detail
+
+
+def media_type(header):
+    '''
+    The columnar format named in a Content-Type or Accept header, or None.
+    '''
+    header = header or ""
+    if "arrow" in header:
+        return ARROW
+    if "msgpack" in header:
+        return MSGPACK
+    return None
+
+
+def read_columns(body, fmt):
+    '''
+    Decode a payload into a dict of column name -> 1-d array. Null values come
+    out as None in object arrays. Raises ValueError on a malformed payload.
+    '''
+    if fmt == ARROW:
+        try:
+            table = pa.ipc.open_stream(pa.py_buffer(body)).read_all()
+        except pa.ArrowException as e:
+            raise ValueError(str(e))
+        return {name: _arrow_values(column)
+                for name, column in zip(table.column_names, table.columns)}
+
+    try:
+        payload = msgpack.unpackb(body, raw=False)
+    except (ValueError, msgpack.UnpackException) as e:
+        raise ValueError(str(e))
+    if not isinstance(payload, dict) or not all(isinstance(v, list) for v in payload.values()):
+        raise ValueError("a msgpack batch must map column names to lists of values")
+    return {name: _list_values(values) for name, values in payload.items()}
+
+
+def _list_values(values):
+    # a typed array when the values share a type, an object array otherwise
+    if None not in values:
+        try:
+            array = np.array(values)
+        except ValueError:
+            array = None
+        if array is not None and array.ndim == 1:
+            return array
+    array = np.empty(len(values), dtype=object)
+    for i, value in enumerate(values):
+        array[i] = value
+    return array
+
+
+def _arrow_values(column):
+    values = column.to_numpy()
+    if column.null_count:
+        nulls = pa.compute.is_null(column).to_numpy()
+        values = values.astype(object)
+        values[nulls] = None
+    return values
+
+
+def validate(columns, fields):
+    '''
+    Check the columns of a batch against fields, (name, type) pairs with type
+    int, float, str or a Literal of strings like those of the pydantic
+    request models, and give them converted, in the order of fields. Numbers
+    sent as strings are parsed and numbers sent for str fields are written
+    out, as pydantic does.
+    Raises ColumnError on the first column that does not validate.
+    '''
+    lengths = {len(values) for values in columns.values()}
+    if len(lengths) > 1:
+        raise ColumnError(None, "columns must have the same length")
+
+    converted = []
+    for name, kind in fields:
+        if name not in columns:
+            raise ColumnError(name, "field required")
+        converted.append(_convert(name, columns[name], kind))
+    return converted
+
+
+def _convert(name, values, kind):
+    if values.dtype == object:
+        nulls = np.flatnonzero(np.equal(values, None))
+        if len(nulls):
+            raise ColumnError(name, "none is not an allowed value", nulls[0])
+
+    choices = get_args(kind) if get_origin(kind) is Literal else None
+    if kind is str or choices is not None:
+        if values.dtype.kind not in "OUSbiuf":
+            raise ColumnError(name, "str type expected")
+        values = values.astype(str)
+        if choices is not None:
+            invalid = np.flatnonzero(~np.isin(values, choices))
+            if len(invalid):
+                raise ColumnError(name, "unexpected value; permitted: %s" % ", ".join(
+                    repr(choice) for choice in choices), invalid[0])
+        return values
+
+    dtype = np.int64 if kind is int else np.float64
+    if values.dtype.kind in "OUS":
+        # int("1.5") fails like it does in pydantic, floats are truncated
+        try:
+            values = values.astype(np.float64 if kind is float else object).astype(dtype)
+        except (TypeError, ValueError, OverflowError):
+            raise ColumnError(name, MESSAGES[kind], _first_invalid(values, kind))
+    elif values.dtype.kind not in "biuf":
+        raise ColumnError(name, MESSAGES[kind])
+
+    if values.dtype.kind == "f":
+        invalid = np.flatnonzero(~np.isfinite(values))
+        if len(invalid):
+            raise ColumnError(name, "value is not a finite number", invalid[0])
+    return values.astype(dtype)
+
+
+def _first_invalid(values, kind):
+    # only called once a column failed, to point at the record
+    for record, value in enumerate(values):
+        try:
+            kind(value)
+        except (TypeError, ValueError, OverflowError):
+            return record
+    return None
+
+
+def write_columns(columns, fmt):
+    '''
+    Encode a dict of column name -> 1-d array as a payload of format fmt.
+    '''
+    if fmt == ARROW:
+        table = pa.table({name: pa.array(np.asarray(values)) for name, values in columns.items()})
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        return sink.getvalue().to_pybytes()
+    return msgpack.packb({name: np.asarray(values).tolist() for name, values in columns.items()})
@@ -0,0 +1,828 @@
+# Licensed under the MIT License - https://opensource.org/licenses/MIT
+
+import logging
+
+import numpy as np
+
+import metrics
+
+logger = logging.getLogger("cobra.consensus")
+
+# Upper bound on the number of (query, calibration point) cells held in memory
+# at once while computing agreement counts for a batch.
+MAX_BLOCK_CELLS = 1 << 22
+
+
+def stack_predictions(predictions):
+    """
+    Stack a list of per-machine prediction vectors into an array of shape
+    (n_machines, n_samples).
+    """
+    predictions = [np.asarray(p).ravel() for p in predictions]
+    if len(predictions) == 0:
+        return np.empty((0, 0))
+    return np.vstack(predictions)
+
+
+def query_blocks(n_query, n_calibration):
+    """
+    Yield (start, stop) slices over the query rows so that every block of the
+    agreement matrix stays below MAX_BLOCK_CELLS cells.
+    """
+    step = max(1, MAX_BLOCK_CELLS // max(1, n_calibration))
+    for start in range(0, n_query, step):
+        yield start, min(start + step, n_query)
+
+
+def agreement_counts(query_labels, machine_predictions):
+    """
+    For every query and every calibration point, count the machines whose
+    prediction on the query equals their prediction on the calibration point.
+
+    query_labels has shape (n_machines, n_query), machine_predictions has shape
+    (n_machines, n_calibration); the result has shape (n_query, n_calibration).
+    """
+    n_query = query_labels.shape[1] if query_labels.ndim == 2 else 0
+    counts = np.zeros((n_query, machine_predictions.shape[1]), dtype=np.int32)
+    for machine in range(len(query_labels)):
+        counts += machine_predictions[machine][np.newaxis, :] == query_labels[machine][:, np.newaxis]
+    return counts
+
+
+def majority_labels(votes, classes, default=0):
+    """
+    Turn a vote matrix into labels. Ties go to the smallest class and rows
+    without any selected point get the default label.
+    """
+    result = np.full(len(votes), default, dtype=np.float64)
+    found = votes.sum(axis=1) > 0
+    result[found] = classes[np.argmax(votes[found], axis=1)]
+    return result
+
+
+def encode_machine_labels(query_labels, labels):
+    """
+    Map machine predictions to their position in the sorted label vocabulary.
+    Labels outside the vocabulary get the code len(labels).
+    """
+    if len(labels) == 0:
+        return np.zeros(np.shape(query_labels), dtype=np.intp)
+    codes = np.minimum(np.searchsorted(labels, query_labels), len(labels) - 1)
+    return np.where(labels[codes] == query_labels, codes, len(labels))
+
+
+def code_dtype(n_codes):
+    """
+    Smallest signed integer dtype holding the codes 0 .. n_codes - 1.
+    """
+    for dtype in (np.int8, np.int16, np.int32):
+        if n_codes - 1 <= np.iinfo(dtype).max:
+            return dtype
+    return np.int64
+
+
+def narrow_labels(values):
+    """
+    Integer labels in the smallest signed integer dtype holding them; other
+    labels are returned as they are.
+    """
+    values = np.asarray(values)
+    if values.dtype.kind not in "biu" or values.size == 0:
+        return values
+    for dtype in (np.int8, np.int16, np.int32):
+        if np.iinfo(dtype).min <= values.min() and values.max() <= np.iinfo(dtype).max:
+            return values.astype(dtype)
+    return values
+
+
+def build_signature_index(machine_predictions, y_codes, n_classes):
+    """
+    Index the calibration set by signature, the vector of machine predictions
+    of a point. Points sharing a signature are interchangeable for COBRA, so
+    the index only keeps the distinct signatures and their class histograms.
+
+    Returns a dict with
+    - labels: sorted vocabulary of machine predictions
+    - signatures: (n_signatures, n_machines) label codes
+    - votes: (n_signatures, n_classes) class histogram over y_l
+    - lookup: hash table from signature tuple to its row
+    - label_masks: (n_machines, n_labels + 1, n_words) bitmasks of the
+      signatures in every (machine, label) set, packed 64 to a word; the last
+      label slot stands for labels never seen in calibration and is empty
+    - vote_masks: (n_classes, n_vote_bits, n_words) the votes bit-sliced over
+      the signatures, bit b of the votes of every class packed like the
+      label masks
+    """
+    n_machines = machine_predictions.shape[0]
+    labels = np.unique(machine_predictions)
+    codes = encode_machine_labels(machine_predictions, labels)
+    if codes.shape[1]:
+        signatures, inverse = np.unique(codes.T, axis=0, return_inverse=True)
+        inverse = inverse.ravel()
+    else:
+        signatures = np.empty((0, n_machines), dtype=np.intp)
+        inverse = np.empty(0, dtype=np.intp)
+    votes = np.bincount(
+        inverse * n_classes + y_codes, minlength=len(signatures) * n_classes
+    ).reshape(len(signatures), n_classes)
+
+    label_bits = np.zeros(
+        (n_machines, len(labels) + 1, len(signatures)), dtype=bool)
+    for machine in range(n_machines):
+        label_bits[machine, signatures[:, machine],
+                   np.arange(len(signatures))] = True
+
+    lookup = {tuple(row): i for i, row in enumerate(signatures.tolist())}
+    return {
+        "labels": labels,
+        "signatures": signatures,
+        "votes": votes,
+        "lookup": lookup,
+        "label_masks": pack_bits(label_bits),
+        "vote_masks": vote_masks(votes),
+    }
+
+
+def pack_bits(bits):
+    """
+    Pack a boolean array along its last axis into uint64 words.
+    """
+    packed = np.packbits(bits, axis=-1)
+    padding = -packed.shape[-1] % 8
+    if padding:
+        packed = np.concatenate(
+            [packed, np.zeros(packed.shape[:-1] + (padding,), dtype=np.uint8)], axis=-1)
+    return np.ascontiguousarray(packed).view(np.uint64)
+
+
+def vote_masks(votes):
+    """
+    Bit-slice a (n_signatures, n_classes) vote matrix into packed masks of
+    shape (n_classes, n_vote_bits, n_words).
+    """
+    n_bits = max(1, int(votes.max()).bit_length()) if votes.size else 1
+    bits = (votes.T[:, np.newaxis, :] >> np.arange(n_bits)[np.newaxis, :, np.newaxis]) & 1
+    return pack_bits(bits.astype(bool))
+
+
+def popcount(words):
+    """
+    Number of set bits of every uint64 word.
+    """
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(words)
+    words = words - ((words >> np.uint64(1)) & np.uint64(0x5555555555555555))
+    words = (words & np.uint64(0x3333333333333333)) + ((words >> np.uint64(2)) & np.uint64(0x3333333333333333))
+    words = (words + (words >> np.uint64(4))) & np.uint64(0x0F0F0F0F0F0F0F0F)
+    return (words * np.uint64(0x0101010101010101)) >> np.uint64(56)
+
+
+def _masks(index):
+    # indexes built before the masks were packed keep a boolean label_bits array
+    if "label_masks" not in index:
+        index["label_masks"] = pack_bits(index["label_bits"])
+    if "vote_masks" not in index:
+        index["vote_masks"] = vote_masks(index["votes"])
+    return index["label_masks"], index["vote_masks"]
+
+
+def agreement_planes(index, query_codes):
+    """
+    Number of machines agreeing with every query on every signature, given
+    the label codes of the queries of shape (n_machines, n_query).
+
+    The count is bit-sliced: plane i holds bit i of the counts, with 64
+    signatures packed in a word, for a shape of (n_planes, n_query, n_words).
+    Every machine adds its (machine, label) mask with a ripple carry of
+    bitwise XOR / AND, so one pass gives the counts for all M at once.
+    """
+    label_masks, _ = _masks(index)
+    n_machines, n_query = query_codes.shape
+    planes = np.zeros(
+        (max(1, n_machines.bit_length()), n_query, label_masks.shape[-1]), dtype=np.uint64)
+    for machine in range(n_machines):
+        carry = label_masks[machine][query_codes[machine]]
+        for plane in planes:
+            overflow = plane & carry
+            plane ^= carry
+            carry = overflow
+    return planes
+
+
+def planes_votes(index, planes, M):
+    """
+    Class votes of the signatures on which exactly M machines agree with the
+    query, from the planes of agreement_planes: the popcount of the selected
+    signatures in every bit slice of the votes.
+    """
+    _, masks = _masks(index)
+    selected = np.full(planes.shape[1:], np.iinfo(np.uint64).max, dtype=np.uint64)
+    for bit, plane in enumerate(planes):
+        selected &= plane if (M >> bit) & 1 else ~plane
+    if M >> len(planes):
+        selected[:] = 0
+
+    votes = np.zeros((planes.shape[1], len(masks)), dtype=np.int64)
+    for label, slices in enumerate(masks):
+        for bit, mask in enumerate(slices):
+            votes[:, label] += popcount(selected & mask).sum(axis=-1, dtype=np.int64) << bit
+    return votes
+
+
+def update_signature_index(index, codes, y_codes, removed_codes=None, removed_y_codes=None):
+    """
+    A signature index with calibration points added and others removed,
+    without rebuilding it. codes are the label codes of the added points, of
+    shape (n_machines, n_points), and must all be in the vocabulary of the
+    index, like y_codes in its classes; removed points must be in the index.
+
+    Existing signatures only have their votes updated, new ones are appended
+    with their bits set in the label masks. The given index is left as it is,
+    so it can keep serving while the update is made.
+    """
+    label_masks, _ = _masks(index)
+    signatures = index["signatures"]
+    lookup = dict(index["lookup"])
+
+    rows = np.array(
+        [lookup.get(key, -1) for key in map(tuple, codes.T.tolist())], dtype=np.intp)
+    new = np.flatnonzero(rows < 0)
+    if len(new):
+        fresh, inverse = np.unique(codes[:, new].T, axis=0, return_inverse=True)
+        start = len(signatures)
+        rows[new] = start + inverse.ravel()
+        signatures = np.vstack([signatures, fresh.astype(signatures.dtype)])
+        for i, key in enumerate(map(tuple, fresh.tolist())):
+            lookup[key] = start + i
+
+        # widen the masks to the new number of words and set the bits of the
+        # new signatures, laid out as pack_bits does
+        n_words = -(-len(signatures) // 64)
+        label_masks = np.concatenate([label_masks, np.zeros(
+            label_masks.shape[:-1] + (n_words - label_masks.shape[-1],), dtype=np.uint64)], axis=-1)
+        positions = start + np.arange(len(fresh))
+        bits = (1 << (7 - positions % 8)).astype(np.uint8)
+        mask_bytes = label_masks.view(np.uint8)
+        for machine in range(len(label_masks)):
+            np.bitwise_or.at(mask_bytes[machine], (fresh[:, machine], positions // 8), bits)
+
+    votes = index["votes"]
+    votes = np.concatenate([votes, np.zeros(
+        (len(signatures) - len(votes), votes.shape[1]), dtype=votes.dtype)])
+    np.add.at(votes, (rows, y_codes), 1)
+    if removed_codes is not None and removed_codes.shape[1]:
+        removed = np.array(
+            [lookup[key] for key in map(tuple, removed_codes.T.tolist())], dtype=np.intp)
+        np.subtract.at(votes, (removed, removed_y_codes), 1)
+
+    return {
+        "labels": index["labels"],
+        "signatures": signatures,
+        "votes": votes,
+        "lookup": lookup,
+        "label_masks": label_masks,
+        "vote_masks": vote_masks(votes),
+    }
+
+
+def indexed_votes(index, query_codes, M):
+    """
+    Class votes for a batch of queries, given their label codes of shape
+    (n_machines, n_query). A full agreement (M == n_machines) is a hash lookup;
+    a partial one counts agreements over the packed (machine, label) masks.
+    """
+    n_machines, n_query = query_codes.shape
+    votes = index["votes"]
+    if M == n_machines and n_machines > 0:
+        rows = np.array(
+            [index["lookup"].get(key, -1) for key in map(tuple, query_codes.T.tolist())],
+            dtype=np.intp,
+        )
+        result = np.zeros((n_query, votes.shape[1]), dtype=votes.dtype)
+        result[rows >= 0] = votes[rows[rows >= 0]]
+        return result
+
+    return planes_votes(index, agreement_planes(index, query_codes), M)
+
+
+def sweep_votes(index, query_codes, M_values):
+    """
+    Class votes for every M of M_values, counting the agreements once.
+    """
+    planes = agreement_planes(index, query_codes)
+    return [planes_votes(index, planes, M) for M in M_values]
+
+
+def score_distances(query_scores, calibration_scores, metric="euclidean"):
+    """
+    Distances between every query and every calibration point, from their
+    machine outputs of shape (n_query, n_scores) and (n_calibration, n_scores).
+    metric is "euclidean", "manhattan" or "hamming" (fraction of differing
+    outputs, meant for hard labels).
+    """
+    distances = np.zeros((len(query_scores), len(calibration_scores)))
+    for column in range(query_scores.shape[1]):
+        difference = query_scores[:, column][:, np.newaxis] - calibration_scores[:, column][np.newaxis, :]
+        if metric == "euclidean":
+            distances += difference ** 2
+        elif metric == "manhattan":
+            distances += np.abs(difference)
+        elif metric == "hamming":
+            distances += difference != 0
+        else:
+            raise ValueError("Unknown metric %r" % metric)
+
+    if metric == "euclidean":
+        np.sqrt(distances, out=distances)
+    elif metric == "hamming" and query_scores.shape[1]:
+        distances /= query_scores.shape[1]
+    return distances
+
+
+def kernel_weights(distances, kernel="gaussian", bandwidth=1):
+    """
+    Weight of every calibration point given its distance to the query.
+    kernel is "gaussian", "triangular", "epanechnikov" or "uniform".
+    Raises ValueError when bandwidth is not positive.
+    """
+    if not bandwidth > 0:
+        raise ValueError("bandwidth must be positive, got %r" % bandwidth)
+    scaled = distances / bandwidth
+    if kernel == "gaussian":
+        return np.exp(-0.5 * scaled ** 2)
+    if kernel == "triangular":
+        return np.maximum(0, 1 - scaled)
+    if kernel == "epanechnikov":
+        return np.maximum(0, 1 - scaled ** 2)
+    if kernel == "uniform":
+        return (scaled <= 1).astype(np.float64)
+    raise ValueError("Unknown kernel %r" % kernel)
+
+
+def class_probabilities(votes, prior):
+    """
+    Normalize (possibly weighted) class votes into probabilities. Rows with no
+    vote at all get the prior.
+    """
+    votes = np.asarray(votes, dtype=np.float64)
+    totals = votes.sum(axis=1)
+    probabilities = np.tile(prior, (len(votes), 1))
+    found = totals > 0
+    probabilities[found] = votes[found] / totals[found][:, np.newaxis]
+    return probabilities
+
+
+def build_sorted_index(machine_predictions):
+    """
+    Index real-valued calibration predictions, shape (n_machines,
+    n_calibration), for epsilon-ball range queries.
+
+    Returns a dict with
+    - sorted: the predictions of every machine in increasing order
+    - order: the calibration point at every position of sorted
+    - rank: the position of every calibration point in sorted, per machine
+    """
+    machine_predictions = np.asarray(machine_predictions, dtype=np.float64)
+    order = np.argsort(machine_predictions, axis=1, kind="stable")
+    rank = np.empty_like(order)
+    np.put_along_axis(
+        rank, order, np.arange(order.shape[1])[np.newaxis].repeat(len(order), axis=0), axis=1)
+    return {
+        "sorted": np.take_along_axis(machine_predictions, order, axis=1),
+        "order": order,
+        "rank": rank,
+    }
+
+
+def epsilon_ranges(index, query_predictions, epsilon):
+    """
+    For every machine and query, the positions [lo, hi) of sorted holding the
+    calibration predictions in [q - epsilon, q + epsilon], q being the
+    prediction of that machine on the query. Both have shape (n_machines,
+    n_query).
+    """
+    lo = np.empty(query_predictions.shape, dtype=np.intp)
+    hi = np.empty(query_predictions.shape, dtype=np.intp)
+    for machine, values in enumerate(index["sorted"]):
+        lo[machine] = np.searchsorted(values, query_predictions[machine] - epsilon, side="left")
+        hi[machine] = np.searchsorted(values, query_predictions[machine] + epsilon, side="right")
+    return lo, hi
+
+
+def ball_selection(index, lo, hi, M, exclude=None):
+    """
+    Calibration points in the epsilon ball of exactly M machines, from the
+    ranges of epsilon_ranges. Returns (queries, points), the selected pairs.
+    exclude optionally gives one point per query never to select, e.g. the
+    query itself when the queries are calibration points.
+
+    A point in M of the balls is in at least one of the n_machines - M + 1
+    narrowest, so only the points of those ranges are candidates; they are
+    checked against the ranges of every machine through their ranks. When
+    the candidates outnumber the calibration points (wide balls, or M = 0),
+    the ranks of every calibration point are compared instead.
+    """
+    n_machines, n_query = lo.shape
+    rank = index["rank"]
+    n_points = rank.shape[1]
+    sizes = hi - lo
+
+    n_narrow = n_machines - M + 1
+    narrow = np.argsort(sizes, axis=0, kind="stable")[:n_narrow]
+    columns = np.arange(n_query)
+    if 0 < M <= n_machines and sizes[narrow, columns].sum() <= n_query * n_points:
+        # every candidate as (query, point, slot of the narrow range it comes from)
+        size = sizes[narrow, columns].ravel()
+        queries = np.repeat(np.tile(columns, n_narrow), size)
+        slots = np.repeat(np.arange(n_narrow), sizes[narrow, columns].sum(axis=1))
+        positions = np.arange(len(queries)) - np.repeat(np.cumsum(size) - size, size)
+        machines = narrow[slots, queries]
+        positions += lo[machines, queries]
+        points = index["order"][machines, positions]
+
+        ranks = rank[:, points]
+        inside = (ranks >= lo[:, queries]) & (ranks < hi[:, queries])
+        candidates = np.arange(len(queries))
+        # a point in several narrow ranges is kept from the first one only
+        first = inside[narrow[:, queries], candidates].argmax(axis=0)
+        keep = (first == slots) & (inside.sum(axis=0) == M)
+        queries, points = queries[keep], points[keep]
+    else:
+        counts = np.zeros((n_query, n_points), dtype=np.int16)
+        for machine in range(n_machines):
+            counts += (rank[machine] >= lo[machine][:, np.newaxis]) & (
+                rank[machine] < hi[machine][:, np.newaxis])
+        queries, points = np.nonzero(counts == M)
+
+    if exclude is not None:
+        keep = points != exclude[queries]
+        queries, points = queries[keep], points[keep]
+    return queries, points
+
+
+def ball_means(queries, points, y, n_query):
+    """
+    Mean of y over the selected points of every query, with the number of
+    points; 0 for a query without any.
+    """
+    counts = np.bincount(queries, minlength=n_query)
+    sums = np.bincount(queries, weights=y[points], minlength=n_query)
+    means = np.zeros(n_query)
+    np.divide(sums, counts, out=means, where=counts > 0)
+    return means, counts
+
+
+class CobraConsensus:
+    """
+    The COBRA consensus of a set of fitted machines over a calibration set:
+    prediction, class probabilities and calibration updates.
+
+    Subclasses give the machines through _machines, _machine_labels (the
+    predicted labels, one row per machine) and _machine_outputs (their
+    predict_proba or decision_function outputs), and set machine_predictions_,
+    y_l_ and the signature index from the calibration set. Nothing here
+    imports sklearn.
+    """
+
+    # dtype the inputs are converted to
+    dtype = np.float64
+
+    def _machines(self):
+        # machine names, in the order of the rows of machine_predictions_
+        raise NotImplementedError
+
+    def _machine_labels(self, X):
+        raise NotImplementedError
+
+    def _machine_outputs(self, X):
+        raise NotImplementedError
+
+    def _check_array(self, X):
+        X = np.asarray(X, dtype=self.dtype)
+        if X.ndim != 2:
+            raise ValueError(
+                "Expected 2D array, got %dD array instead" % X.ndim)
+        if not np.isfinite(X).all():
+            raise ValueError("Input contains NaN or infinity")
+        return X
+
+    def _check_X_y(self, X, y):
+        X = self._check_array(X)
+        y = np.asarray(y).ravel()
+        if len(y) != len(X):
+            raise ValueError(
+                "Found input variables with inconsistent numbers of samples: [%d, %d]"
+                % (len(X), len(y)))
+        return X, y
+
+    def pred(self, X, M, info=False):
+        self._check_machine_predictions()
+        query_labels = self._machine_labels(X)
+
+        if info:
+            # the selected points themselves are only known from a scan
+            counts = agreement_counts(
+                encode_machine_labels(
+                    query_labels, self.signature_index_["labels"]),
+                self._machine_codes())
+            points = np.flatnonzero(counts[0] == M).tolist()
+            votes = np.bincount(
+                self.y_l_codes_[points], minlength=len(self.classes_l_))
+        else:
+            with metrics.timer(metrics.CONSENSUS_SECONDS):
+                votes = self._votes(query_labels, M)[0]
+
+        if metrics.enabled():
+            metrics.SELECTED_POINTS.observe(votes.sum())
+
+        # if no points are selected, return 0
+        if votes.sum() == 0:
+            if info:
+                logger.info("No points were selected, prediction is 0")
+                return (0, 0)
+            logger.info("No points were selected, prediction is 0")
+            return 0
+
+        result = int(self.classes_l_[np.argmax(votes)])
+        if info:
+            return result, points
+        return result
+
+    def predict(self, X, M=None, info=False):
+        X = self._check_array(X)
+
+        if M is None:
+            M = len(self._machines())
+        if X.ndim == 1:
+            return self.pred(X.reshape(1, -1), M=M)
+
+        self._check_machine_predictions()
+        # every machine predicts the whole batch once
+        query_labels = self._machine_labels(X)
+
+        result = np.zeros(len(X))
+        total_points = 0
+        with metrics.timer(metrics.CONSENSUS_SECONDS):
+            for start, stop in query_blocks(
+                    len(X), len(self.signature_index_["votes"])):
+                votes = self._votes(query_labels[:, start:stop], M)
+                result[start:stop] = majority_labels(
+                    votes, self.classes_l_)
+                if info:
+                    total_points += votes.sum()
+                if metrics.enabled():
+                    metrics.SELECTED_POINTS.observe_many(votes.sum(axis=1))
+
+        if info:
+            avg_points = total_points / len(X)
+            return result, avg_points
+        return result
+
+    def predict_sweep(self, X, M_values=None):
+        """
+        Predictions for every M of M_values (1 to the number of machines by
+        default) at the cost of about one predict: the machines predict once
+        and the agreement counts are computed once for all M. Returns a dict
+        from M to the predictions.
+        """
+        X = self._check_array(X)
+        if M_values is None:
+            M_values = range(1, len(self._machines()) + 1)
+        M_values = list(M_values)
+
+        self._check_machine_predictions()
+        query_codes = encode_machine_labels(
+            self._machine_labels(X), self.signature_index_["labels"])
+
+        result = {M: np.zeros(len(X)) for M in M_values}
+        with metrics.timer(metrics.CONSENSUS_SECONDS):
+            for start, stop in query_blocks(
+                    len(X), len(self.signature_index_["votes"])):
+                sweep = sweep_votes(
+                    self.signature_index_, query_codes[:, start:stop], M_values)
+                for M, votes in zip(M_values, sweep):
+                    result[M][start:stop] = majority_labels(
+                        votes, self.classes_l_)
+        return result
+
+    def _votes(self, query_labels, M):
+        query_codes = encode_machine_labels(
+            query_labels, self.signature_index_["labels"])
+        return indexed_votes(self.signature_index_, query_codes, M)
+
+    def _check_machine_predictions(self):
+        # models pickled before machine_predictions_ became an array keep a
+        # dict of per-machine predictions, convert it on first use
+        if isinstance(self.machine_predictions_, dict):
+            self.machine_predictions_ = stack_predictions(
+                [self.machine_predictions_[machine] for machine in self._machines()]
+            ).reshape(len(self._machines()), len(self.y_l_))
+        if not hasattr(self, "signature_index_"):
+            self._build_index()
+        return self
+
+    def _build_index(self):
+        self.classes_l_, self.y_l_codes_ = np.unique(
+            self.y_l_, return_inverse=True)
+        self.signature_index_ = build_signature_index(
+            self._machine_prediction_values(), self.y_l_codes_, len(self.classes_l_))
+        return self
+
+    def _machine_codes(self):
+        # calibration predictions as codes into the labels of the signature index
+        if getattr(self, "machine_labels_", None) is not None:
+            return self.machine_predictions_
+        return encode_machine_labels(
+            self.machine_predictions_, self.signature_index_["labels"])
+
+    def _machine_prediction_values(self):
+        # calibration predictions as labels, decoded once compacted
+        if getattr(self, "machine_labels_", None) is not None:
+            return self.machine_labels_[self.machine_predictions_]
+        return self.machine_predictions_
+
+    def compact(self):
+        """
+        Keep only what inference needs, for storing and serving the model.
+
+        The training matrices X_, y_, X_k_, y_k_ and X_l_ and the per-machine
+        outputs on X_l_ are dropped, after computing the calibration outputs
+        predict_proba uses. machine_predictions_ becomes a small-int (int8
+        for up to 127 distinct predictions) array of codes into
+        machine_labels_, and y_l_ (for integer labels) and y_l_codes_ become
+        small-int arrays. Predictions are unchanged.
+        """
+        self._check_machine_predictions()
+        self._check_calibration_scores()
+
+        labels = self.signature_index_["labels"]
+        # an unseen label has the code len(labels)
+        dtype = code_dtype(len(labels) + 1)
+        self.machine_predictions_ = self._machine_codes().astype(dtype)
+        self.machine_labels_ = labels
+        self.signature_index_["signatures"] = self.signature_index_[
+            "signatures"].astype(dtype)
+
+        self.y_l_ = narrow_labels(self.y_l_)
+        self.y_l_codes_ = self.y_l_codes_.astype(
+            code_dtype(len(self.classes_l_)))
+
+        self.X_ = self.y_ = self.X_k_ = self.y_k_ = self.X_l_ = None
+        self.machine_proba_predictions_ = None
+        return self
+
+    def predict_proba(self, X, kernel=None, metric=None, bandwidth=1, M=None, **kwargs):
+        """
+        Class probabilities, in the order of classes_l_, from the calibration
+        points around every query.
+
+        Without kernel and metric the neighbours are the points predict
+        selects (M machines agree), each counting once. With a kernel
+        ("gaussian", "triangular", "epanechnikov" or "uniform") every
+        calibration point is weighted by the kernel of its distance to the
+        query divided by bandwidth. The distance is taken over the machine
+        outputs with metric: "euclidean" (the default) or "manhattan" on the
+        stored predict_proba / decision_function outputs, or "hamming" on the
+        predicted labels. Queries without any neighbour get the class
+        frequencies of y_l_.
+        """
+        X = self._check_array(X)
+        self._check_machine_predictions()
+        prior = np.bincount(
+            self.y_l_codes_, minlength=len(self.classes_l_)) / len(self.y_l_codes_)
+        probabilities = np.empty((len(X), len(self.classes_l_)))
+
+        if kernel is None and metric is None:
+            if M is None:
+                M = len(self._machines())
+            query_labels = self._machine_labels(X)
+            for start, stop in query_blocks(
+                    len(X), len(self.signature_index_["votes"])):
+                votes = self._votes(query_labels[:, start:stop], M)
+                probabilities[start:stop] = class_probabilities(
+                    votes, prior)
+            return probabilities
+
+        kernel = kernel or "gaussian"
+        metric = metric or "euclidean"
+        if metric == "hamming":
+            query_scores = encode_machine_labels(
+                self._machine_labels(X), self.signature_index_["labels"]).T
+            calibration_scores = self._machine_codes().T
+        else:
+            self._check_calibration_scores()
+            query_scores = self._machine_scores(X)
+            calibration_scores = self.calibration_scores_
+
+        one_hot = np.zeros((len(self.y_l_codes_), len(self.classes_l_)))
+        one_hot[np.arange(len(self.y_l_codes_)), self.y_l_codes_] = 1
+        for start, stop in query_blocks(len(X), len(calibration_scores)):
+            distances = score_distances(
+                query_scores[start:stop], calibration_scores, metric)
+            weights = kernel_weights(distances, kernel, bandwidth)
+            probabilities[start:stop] = class_probabilities(
+                weights @ one_hot, prior)
+        return probabilities
+
+    def _machine_scores(self, X):
+        # the outputs load_machine_proba_predictions stores for X_l_, side by side
+        scores = [np.asarray(score).reshape(len(X), -1) for score in self._machine_outputs(X)]
+        return np.hstack(scores) if scores else np.empty((len(X), 0))
+
+    def _check_calibration_scores(self):
+        # models fitted before predict_proba used the calibration outputs
+        # compute them on first use
+        if not hasattr(self, "calibration_scores_"):
+            if not hasattr(self, "machine_proba_predictions_"):
+                self.load_machine_proba_predictions()
+            else:
+                self._stack_calibration_scores()
+        return self
+
+    def _stack_calibration_scores(self):
+        scores = [
+            np.asarray(self.machine_proba_predictions_[machine]).reshape(len(self.y_l_), -1)
+            for machine in self._machines()
+        ]
+        self.calibration_scores_ = np.hstack(
+            scores) if scores else np.empty((len(self.y_l_), 0))
+        return self
+
+    def add_calibration(self, X, y, max_points=None):
+        """
+        Add labelled points to the calibration set without refitting the
+        machines. The machines only predict the new points and the signature
+        index is updated rather than rebuilt (it is rebuilt when a machine
+        predicts a label, or y holds a class, never seen in calibration).
+
+        With max_points the oldest calibration points are evicted so that at
+        most max_points remain, a sliding window over the arriving points.
+        Compacted models stay compacted.
+        """
+        X, y = self._check_X_y(X, y)
+        self._check_machine_predictions()
+        compacted = getattr(self, "machine_labels_", None) is not None
+        labels = self.signature_index_["labels"]
+
+        new_labels = self._machine_labels(X)
+        new_codes = encode_machine_labels(new_labels, labels)
+        new_y_codes = encode_machine_labels(y, self.classes_l_)
+        rebuild = (new_codes == len(labels)).any() or (new_y_codes == len(self.classes_l_)).any()
+
+        n_points = len(self.y_l_codes_) + len(X)
+        evicted = max(0, n_points - max_points) if max_points is not None else 0
+
+        if not rebuild:
+            removed = slice(0, evicted)
+            old_codes = self.machine_predictions_[:, removed]
+            if not compacted:
+                old_codes = encode_machine_labels(old_codes, labels)
+            index = update_signature_index(
+                self.signature_index_, new_codes, new_y_codes,
+                np.hstack([old_codes, new_codes])[:, removed],
+                np.concatenate([self.y_l_codes_, new_y_codes])[removed])
+
+        if rebuild:
+            predictions = np.hstack([self._machine_prediction_values(), new_labels])
+        elif compacted:
+            predictions = np.hstack([
+                self.machine_predictions_,
+                new_codes.astype(self.machine_predictions_.dtype)])
+        else:
+            predictions = np.hstack([self.machine_predictions_, new_labels])
+
+        if getattr(self, "X_l_", None) is not None:
+            self.X_l_ = np.vstack([self.X_l_, X])[evicted:]
+        if isinstance(getattr(self, "machine_proba_predictions_", None), dict) or hasattr(self, "calibration_scores_"):
+            outputs = dict(zip(self._machines(), self._machine_outputs(X)))
+            if isinstance(getattr(self, "machine_proba_predictions_", None), dict):
+                self.machine_proba_predictions_ = {
+                    machine: np.concatenate([self.machine_proba_predictions_[machine], outputs[machine]])[evicted:]
+                    for machine in self._machines()
+                }
+            if hasattr(self, "calibration_scores_"):
+                scores = [np.asarray(outputs[machine]).reshape(len(X), -1) for machine in self._machines()]
+                self.calibration_scores_ = np.vstack([
+                    self.calibration_scores_,
+                    np.hstack(scores) if scores else np.empty((len(X), 0))])[evicted:]
+
+        self.machine_predictions_ = predictions[:, evicted:]
+        self.y_l_ = np.concatenate([self.y_l_, y])[evicted:]
+        if rebuild:
+            self.machine_labels_ = None
+            self._build_index()
+            if compacted:
+                self.compact()
+        else:
+            self.y_l_codes_ = np.concatenate([
+                self.y_l_codes_, new_y_codes.astype(self.y_l_codes_.dtype)])[evicted:]
+            if compacted:
+                self.y_l_ = narrow_labels(self.y_l_)
+            self.signature_index_ = index
+        return self
+
+    def partial_fit(self, X, y, max_points=None):
+        """
+        Same as add_calibration: the machines are not refitted.
+        """
+        return self.add_calibration(X, y, max_points=max_points)
@@ -0,0 +1,142 @@
+# Licensed under the MIT License - https://opensource.org/licenses/MIT
+
+# Fitting and loading the machines of the COBRA estimators, shared by
+# ClassifierCobra and RegressorCobra. A table of machines maps names to
+# (estimator class or its dotted path, hyperparameters), see MACHINES in
+# classifiercobra and regressorcobra. Kept out of consensus, which serving
+# imports without sklearn.
+
+from sklearn.utils import shuffle, check_random_state
+from joblib import Parallel, delayed
+
+import numpy as np
+import importlib
+import logging
+import time
+
+import consensus
+
+logger = logging.getLogger("pycobra.fitting")
+
+
+def machine_names(machine_list, machines, basic):
+    """
+    The names of the machines of machine_list: "basic" (the names in basic),
+    "advanced" (every machine of the table machines) or a list of names.
+    """
+    if machine_list == "basic":
+        return list(basic)
+    if machine_list == "advanced":
+        return list(machines)
+    return list(machine_list)
+
+
+def make_machine(machine, machines):
+    """
+    A new estimator for the machine named machine in the table machines, None
+    for a machine the table does not know.
+    """
+    if machine not in machines:
+        return None
+    estimator, params = machines[machine]
+    if isinstance(estimator, str):
+        module, _, name = estimator.rpartition(".")
+        estimator = getattr(importlib.import_module(module), name)
+    return estimator(**params)
+
+
+def fit_machine(machine, X, y, random_state, machines):
+    """
+    Fit the machine named machine on X, y. Returns (machine, estimator, fit
+    time in seconds), with estimator None when the machine is not known or
+    failed to fit. Module level so that it can be sent to joblib workers.
+    """
+    estimator = make_machine(machine, machines)
+    if estimator is None:
+        return machine, None, 0.0
+    # machines built by a plain factory need not have sklearn's get_params
+    if hasattr(estimator, "get_params") and "random_state" in estimator.get_params():
+        estimator.set_params(random_state=random_state)
+
+    start = time.perf_counter()
+    try:
+        estimator.fit(X, y)
+    except ValueError:
+        return machine, None, 0.0
+    return machine, estimator, time.perf_counter() - start
+
+
+class MachineFitting:
+    """
+    Splitting the data between the machines (X_k_, y_k_) and the calibration
+    set (X_l_, y_l_), and fitting and loading the machines into estimators_.
+    Subclasses set known_machines and basic_machines to their table of
+    machines and their "basic" machine list.
+    """
+
+    known_machines = {}
+    basic_machines = []
+
+    def split_data(self, k=None, l=None, shuffle_data=True):
+        if shuffle_data:
+            self.X_, self.y_ = shuffle(
+                self.X_, self.y_, random_state=self.random_state)
+
+        if k is None and l is None:
+            k = int(len(self.X_) / 2)
+            l = int(len(self.X_))
+
+        if k is not None and l is None:
+            l = len(self.X_) - k
+
+        if l is not None and k is None:
+            k = len(self.X_) - l
+
+        self.X_k_ = self.X_[:k]
+        self.X_l_ = self.X_[k:l]
+        self.y_k_ = self.y_[:k]
+        self.y_l_ = self.y_[k:l]
+        return self
+
+    def load_default(self, machine_list="basic"):
+        machine_list = machine_names(machine_list, self.known_machines, self.basic_machines)
+
+        # draw one seed per known machine, in a fixed order, so that a machine
+        # is fitted the same way whichever other machines are in the list and
+        # whatever order parallel jobs finish in
+        seeds = dict(zip(self.known_machines, check_random_state(self.random_state).randint(
+            np.iinfo(np.int32).max, size=len(self.known_machines))))
+
+        fitted = Parallel(n_jobs=self.n_jobs)(
+            delayed(fit_machine)(
+                machine, self.X_k_, self.y_k_, seeds.get(machine), self.known_machines)
+            for machine in machine_list
+        )
+
+        self.fit_times_ = {}
+        for machine, estimator, fit_time in fitted:
+            if estimator is None:
+                continue
+            self.estimators_[machine] = estimator
+            self.fit_times_[machine] = fit_time
+            logger.debug("Fitted %s in %.3fs", machine, fit_time)
+        return self
+
+    def load_machine(self, machine_name, machine):
+        self.estimators_[machine_name] = machine
+        return self
+
+    def _calibration_predictions(self, predictions=None):
+        # predictions (machine name -> predictions on X_l_) stacked with one
+        # row per machine, in the order of estimators_
+        if predictions is None:
+            # predict releases the GIL for most machines, threads avoid
+            # shipping the estimators and X_l_ to other processes
+            predictions = dict(zip(self.estimators_, Parallel(
+                n_jobs=self.n_jobs, prefer="threads")(
+                delayed(self.estimators_[machine].predict)(self.X_l_)
+                for machine in self.estimators_
+            )))
+        return consensus.stack_predictions(
+            [predictions[machine] for machine in self.estimators_]
+        ).reshape(len(self.estimators_), len(self.y_l_))
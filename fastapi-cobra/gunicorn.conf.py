@@ -0,0 +1,24 @@
+# gunicorn settings for serving main:app, used by the Dockerfile
+import gc
+import os
+
+bind = "0.0.0.0:%s" % os.environ.get("PORT", "8000")
+workers = int(os.environ.get("WEB_CONCURRENCY", 3))
+worker_class = "uvicorn.workers.UvicornWorker"
+
+# import main:app once in the master and fork the workers from it, so that
+# the models loaded below are shared copy-on-write instead of loaded per worker
+preload_app = True
+
+
+def when_ready(server):
+    from registry import registry
+
+    registry.preload()
+    server.log.info("Preloaded models: %s", registry.stats())
+
+    # move everything allocated so far out of the reach of the cyclic garbage
+    # collector, whose passes would otherwise write to (and so copy) the
+    # shared pages of every model object in every worker
+    gc.collect()
+    gc.freeze()
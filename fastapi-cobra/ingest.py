@@ -0,0 +1,189 @@
+# Cached ingestion of the training data. A data file is parsed and encoded
+# once into a directory of .npy files named after the SHA-256 of its content,
+# and later runs memory-map those instead of parsing the file again.
+#
+#   python ingest.py australian german
+#
+# Changing the parsing or the encodings of a dataset bumps INGEST_VERSION,
+# which is part of the key, so stale entries are never read. Entries are
+# not removed, a cache directory can be deleted at any time.
+
+from pathlib import Path
+import argparse
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger("cobra.ingest")
+
+BASE_DIR = Path(__file__).resolve(strict=True).parent
+
+# version of the parsing and encodings below
+INGEST_VERSION = 2
+
+CACHE_DIR = Path(os.environ.get("COBRA_INGEST_CACHE", BASE_DIR.joinpath("data", "cache")))
+
+SOURCES = {
+    "australian": BASE_DIR.joinpath("data", "australian.dat"),
+    "german": BASE_DIR.joinpath("data", "german.csv"),
+}
+
+GERMAN_SELECTED_COLUMNS = [
+    "checkingstatus",
+    "history",
+    "purpose",
+    "savings",
+    "employ",
+    "status",
+    "others",
+    "property",
+    "otherplans",
+    "housing",
+    "foreign",
+    "age",
+    "amount",
+    "duration",
+]
+
+
+class Ingested:
+    """
+    The cached columns of a data file. features is a DataFrame of the encoded
+    feature columns over one read-only memory-mapped float64 array, target
+    the labels and categorical a DataFrame of the raw text columns as pandas
+    categoricals, e.g. to fit a pipelines.CategoricalEncoder on.
+    """
+
+    def __init__(self, path, digest, features, target, categorical):
+        self.path = path
+        self.digest = digest
+        self.features = features
+        self.target = target
+        self.categorical = categorical
+
+
+def parse_australian(path):
+    # every attribute of australian.dat is numeric, Y is the last column
+    df = pd.read_table(path, sep=r'\s+', header=None)
+    df.columns = ['X1', 'X2', 'X3', 'X4', 'X5', 'X6', 'X7',
+                  'X8', 'X9', 'X10', 'X11', 'X12', 'X13', 'X14', 'Y']
+    return df.drop('Y', axis=1), df['Y'], df.iloc[:, :0]
+
+
+def parse_german(path):
+    # the encodings of model_german.train: business mapping of the ordinal
+    # and binary columns, then get_dummies over the nominal ones
+    df = pd.read_csv(path).drop_duplicates()
+    data = df[GERMAN_SELECTED_COLUMNS].copy()
+
+    # cast explicitly, newer pandas keep the replaced columns as text
+    data["employ"] = data["employ"].replace(
+        {"A71": 1, "A72": 2, "A73": 3, "A74": 4, "A75": 5}).astype(np.int64)
+    data["foreign"] = data["foreign"].replace({"A201": 1, "A202": 0}).astype(np.int64)
+    categorical = df[[column for column in GERMAN_SELECTED_COLUMNS if _is_text(df[column])]]
+    return pd.get_dummies(data), df["GoodCredit"], categorical
+
+
+def _is_text(column):
+    # object columns before pandas 2, string columns since
+    return pd.api.types.is_object_dtype(column) or pd.api.types.is_string_dtype(column)
+
+
+PARSERS = {
+    "australian": parse_australian,
+    "german": parse_german,
+}
+
+
+def file_digest(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def load(dataset, path=None, cache_dir=None):
+    '''
+    The ingested columns of a data file of dataset (its file in data/ by
+    default), read from the cache when the file was ingested before and
+    parsed and cached otherwise.
+    '''
+    path = Path(path or SOURCES[dataset])
+    cache_dir = Path(cache_dir or CACHE_DIR)
+    digest = file_digest(path)
+    entry = cache_dir.joinpath("%s-v%d-%s" % (dataset, INGEST_VERSION, digest[:32]))
+
+    if not entry.joinpath("meta.json").exists():
+        start = time.perf_counter()
+        _write(entry, *PARSERS[dataset](path))
+        logger.info("Ingested %s in %.3fs", path, time.perf_counter() - start)
+    return _read(entry, path, digest)
+
+
+def _write(entry, features, target, categorical):
+    entry.parent.mkdir(parents=True, exist_ok=True)
+    # written next to the entry and renamed, so a reader never sees half an
+    # entry; when another process got there first its entry is kept
+    temporary = Path(tempfile.mkdtemp(prefix=entry.name + ".", dir=entry.parent))
+    try:
+        np.save(temporary.joinpath("features.npy"), features.to_numpy(dtype=np.float64))
+        np.save(temporary.joinpath("target.npy"), target.to_numpy())
+        # text columns as category codes, their categories are kept in meta.json
+        categories = {}
+        for column in categorical.columns:
+            values = categorical[column].astype(str).astype("category")
+            np.save(temporary.joinpath("%s.npy" % column), values.cat.codes.to_numpy())
+            categories[column] = list(values.cat.categories)
+        meta = {
+            "version": INGEST_VERSION,
+            "columns": list(features.columns),
+            "categories": categories,
+        }
+        with open(temporary.joinpath("meta.json"), "w") as f:
+            json.dump(meta, f)
+        os.replace(temporary, entry)
+    except OSError:
+        if not entry.joinpath("meta.json").exists():
+            raise
+    finally:
+        shutil.rmtree(temporary, ignore_errors=True)
+
+
+def _read(entry, path, digest):
+    with open(entry.joinpath("meta.json")) as f:
+        meta = json.load(f)
+    features = np.load(entry.joinpath("features.npy"), mmap_mode="r")
+    target = np.load(entry.joinpath("target.npy"), mmap_mode="r")
+    categorical = pd.DataFrame({
+        column: pd.Categorical.from_codes(
+            np.load(entry.joinpath("%s.npy" % column), mmap_mode="r"), categories)
+        for column, categories in meta["categories"].items()
+    })
+    return Ingested(path, digest, pd.DataFrame(features, columns=meta["columns"], copy=False),
+                    target, categorical)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Ingest the data files of the COBRA models into the cache.")
+    parser.add_argument("datasets", nargs="+", choices=sorted(PARSERS))
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(message)s")
+
+    for dataset in args.datasets:
+        start = time.perf_counter()
+        data = load(dataset)
+        logger.info("%s: %d rows, %d features in %.3fs from %s",
+                    dataset, *data.features.shape, time.perf_counter() - start, data.digest[:12])
+
+
+if __name__ == "__main__":
+    main()
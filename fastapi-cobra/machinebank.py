@@ -0,0 +1,499 @@
+# Licensed under the MIT License - https://opensource.org/licenses/MIT
+
+# Pure-NumPy inference for the fitted COBRA machines, so that a served model
+# needs neither sklearn nor its per-call validation.
+#
+# compile_machines reads the fitted attributes of every estimator into plain
+# arrays. The linear machines (LogisticRegression, linear-kernel SVC) and the
+# first layer of the MLPs are evaluated as one matrix product, and every tree
+# of the tree, forest and gradient boosting machines is walked at once over
+# flattened node arrays. Every step uses the arithmetic of the corresponding
+# sklearn predict (float32 features for the trees, the same summation order
+# for forests and boosting stages), so the predicted labels are the same.
+
+import copy
+
+import numpy as np
+
+import consensus
+import metrics
+
+
+def _expit(x):
+    with np.errstate(over="ignore"):
+        return 1.0 / (1.0 + np.exp(-x))
+
+
+def _softmax(x):
+    x = x - x.max(axis=1)[:, np.newaxis]
+    np.exp(x, out=x)
+    x /= x.sum(axis=1)[:, np.newaxis]
+    return x
+
+
+def _logsumexp(x):
+    x_max = x.max(axis=1)[:, np.newaxis]
+    return np.log(np.exp(x - x_max).sum(axis=1)) + x_max[:, 0]
+
+
+def _normalize(proba):
+    normalizer = proba.sum(axis=1)[:, np.newaxis]
+    normalizer[normalizer == 0.0] = 1.0
+    return proba / normalizer
+
+
+def _ovo_decision(decision, n_classes):
+    # one-vs-one votes of SVC, plus the confidences bringing them into
+    # (-1/3, 1/3) around the vote count that decision_function adds
+    votes = np.zeros((len(decision), n_classes))
+    confidences = np.zeros((len(decision), n_classes))
+    k = 0
+    for i in range(n_classes):
+        for j in range(i + 1, n_classes):
+            confidences[:, i] += decision[:, k]
+            confidences[:, j] -= decision[:, k]
+            votes[decision[:, k] > 0, i] += 1
+            votes[decision[:, k] <= 0, j] += 1
+            k += 1
+    return votes, votes + confidences / (3 * (np.abs(confidences) + 1))
+
+
+ACTIVATIONS = {
+    "identity": lambda x: x,
+    "tanh": np.tanh,
+    "logistic": _expit,
+    "relu": lambda x: np.maximum(x, 0),
+}
+
+
+def _linear(estimator, name):
+    kind = type(estimator).__name__
+    if kind == "SVC":
+        # newer sklearn releases default probability to a truthy "deprecated"
+        if estimator.kernel != "linear" or estimator.probability is True or estimator.break_ties:
+            raise ValueError("%s: only linear-kernel SVC without probability can be compiled" % name)
+        if estimator.decision_function_shape != "ovr":
+            raise ValueError("%s: only ovr SVC decision functions can be compiled" % name)
+        # one decision per pair of classes past two classes
+        output = "decision" if len(estimator.classes_) == 2 else "ovo"
+    else:
+        # multi_class was removed from newer sklearn releases, which behave as "auto"
+        multi_class = getattr(estimator, "multi_class", "auto")
+        if len(estimator.classes_) == 2 or multi_class == "ovr" or (
+                multi_class == "auto" and estimator.solver == "liblinear"):
+            output = "ovr"
+        else:
+            output = "multinomial"
+    return {
+        "kind": "linear",
+        "classes": estimator.classes_,
+        "weights": np.asarray(estimator.coef_, dtype=np.float64).T,
+        "bias": np.asarray(estimator.intercept_, dtype=np.float64).ravel(),
+        "output": output,
+    }
+
+
+def _mlp(estimator, name):
+    if estimator.out_activation_ not in ("logistic", "softmax"):
+        raise ValueError("%s: MLP output %s can not be compiled" % (name, estimator.out_activation_))
+    return {
+        "kind": "mlp",
+        "classes": estimator.classes_,
+        "weights": estimator.coefs_[0],
+        "bias": estimator.intercepts_[0],
+        "layers": list(zip(estimator.coefs_[1:], estimator.intercepts_[1:])),
+        "activation": estimator.activation,
+        "output": estimator.out_activation_,
+    }
+
+
+def _naive_bayes(estimator, name):
+    variance = getattr(estimator, "var_", None)
+    if variance is None:
+        variance = estimator.sigma_
+    return {
+        "kind": "naive_bayes",
+        "classes": estimator.classes_,
+        "log_prior": np.log(estimator.class_prior_),
+        "log_norm": -0.5 * np.sum(np.log(2.0 * np.pi * variance), axis=1),
+        "theta": estimator.theta_,
+        "variance": variance,
+    }
+
+
+def _tree(estimator, name):
+    return {
+        "kind": "tree",
+        "classes": estimator.classes_,
+        "trees": [estimator.tree_],
+        "values": [estimator.tree_.value[:, 0, :]],
+    }
+
+
+def _forest(estimator, name):
+    trees = [tree.tree_ for tree in estimator.estimators_]
+    return {
+        "kind": "forest",
+        "classes": estimator.classes_,
+        "trees": trees,
+        # per node predict_proba of every tree
+        "values": [_normalize(tree.value[:, 0, :]) for tree in trees],
+    }
+
+
+def _boosting(estimator, name):
+    if estimator.loss not in ("deviance", "log_loss"):
+        raise ValueError("%s: boosting loss %s can not be compiled" % (name, estimator.loss))
+    if estimator.init_ != "zero" and type(estimator.init_).__name__ != "DummyClassifier":
+        raise ValueError("%s: boosting init estimator can not be compiled" % name)
+    n_stages, n_outputs = estimator.estimators_.shape
+    trees = [estimator.estimators_[i, k].tree_ for i in range(n_stages) for k in range(n_outputs)]
+    return {
+        "kind": "boosting",
+        "classes": estimator.classes_,
+        # the prior is the same for every row
+        "init": estimator._raw_predict_init(np.zeros((1, estimator.n_features_in_)))[0],
+        "trees": trees,
+        "values": [estimator.learning_rate * tree.value[:, 0, 0] for tree in trees],
+        "n_outputs": n_outputs,
+    }
+
+
+def _knn(estimator, name):
+    if estimator.effective_metric_ != "euclidean" or callable(estimator.weights):
+        raise ValueError("%s: only euclidean nearest neighbours can be compiled" % name)
+    return {
+        "kind": "knn",
+        "classes": estimator.classes_,
+        "fit_X": np.asarray(estimator._fit_X, dtype=np.float64),
+        "y": consensus.narrow_labels(estimator._y),
+        "n_neighbors": estimator.n_neighbors,
+        "weighting": estimator.weights,
+    }
+
+
+# estimator class name -> compiler, matched by name so that nothing here
+# imports sklearn
+COMPILERS = {
+    "LogisticRegression": _linear,
+    "SVC": _linear,
+    "MLPClassifier": _mlp,
+    "GaussianNB": _naive_bayes,
+    "DecisionTreeClassifier": _tree,
+    "ExtraTreeClassifier": _tree,
+    "RandomForestClassifier": _forest,
+    "ExtraTreesClassifier": _forest,
+    "GradientBoostingClassifier": _boosting,
+    "KNeighborsClassifier": _knn,
+}
+
+
+def compile_machines(estimators):
+    """
+    Compile a dict of fitted estimators (name -> estimator, like
+    ClassifierCobra.estimators_) into a MachineBank. Raises ValueError for an
+    estimator the bank can not evaluate.
+    """
+    machines = []
+    for name, estimator in estimators.items():
+        compiler = COMPILERS.get(type(estimator).__name__)
+        if compiler is None:
+            raise ValueError("%s: %s can not be compiled" % (name, type(estimator).__name__))
+        machines.append(dict(compiler(estimator, name), name=name))
+    return MachineBank(machines)
+
+
+class MachineBank:
+    """
+    Fitted classifiers evaluated with NumPy only, built by compile_machines.
+
+    predict gives the labels of every machine, like their sklearn predict,
+    and outputs their predict_proba (decision_function for SVC).
+    """
+
+    # dtype the machines compute in, see astype
+    dtype = np.float64
+
+    def __init__(self, machines):
+        self.names = [machine["name"] for machine in machines]
+
+        # one weight matrix for the linear machines and the MLP first layers
+        blocks = [machine for machine in machines if "weights" in machine]
+        offsets = np.cumsum([0] + [len(machine["bias"]) for machine in blocks])
+        for machine, start, stop in zip(blocks, offsets[:-1], offsets[1:]):
+            machine["columns"] = slice(start, stop)
+        self.weights_ = np.hstack([machine.pop("weights") for machine in blocks]) if blocks else None
+        self.bias_ = np.concatenate([machine.pop("bias") for machine in blocks]) if blocks else None
+
+        # the nodes of every tree in flat arrays, leaves pointing to themselves
+        trees = [tree for machine in machines for tree in machine.get("trees", [])]
+        first_tree = 0
+        for machine in machines:
+            if "trees" in machine:
+                machine["tree_range"] = slice(first_tree, first_tree + len(machine["trees"]))
+                first_tree += len(machine.pop("trees"))
+        if trees:
+            sizes = np.array([tree.node_count for tree in trees])
+            starts = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+            left, right, feature, threshold = [], [], [], []
+            for tree, start in zip(trees, starts):
+                nodes = np.arange(tree.node_count) + start
+                leaf = tree.children_left == -1
+                left.append(np.where(leaf, nodes, tree.children_left + start))
+                right.append(np.where(leaf, nodes, tree.children_right + start))
+                feature.append(np.where(leaf, 0, tree.feature))
+                threshold.append(tree.threshold)
+            self.left_ = np.concatenate(left).astype(np.intp)
+            self.right_ = np.concatenate(right).astype(np.intp)
+            self.feature_ = np.concatenate(feature).astype(np.intp)
+            self.threshold_ = np.concatenate(threshold)
+            # trees walked deepest first, the shallow ones stop early
+            depths = np.array([tree.max_depth for tree in trees])
+            self.tree_order_ = np.argsort(-depths, kind="stable")
+            self.roots_ = starts[self.tree_order_]
+            self.active_trees_ = [int((depths > level).sum()) for level in range(depths.max())]
+            for machine in machines:
+                if "values" in machine:
+                    offset = starts[machine["tree_range"].start]
+                    machine["node_offset"] = offset
+                    machine["values"] = np.concatenate(machine["values"])
+        else:
+            self.left_ = None
+        self.machines_ = machines
+
+    def astype(self, dtype):
+        """
+        Copy of the bank computing in dtype, e.g. np.float32 for half the
+        memory traffic on large batches. Tree thresholds are rounded down to
+        dtype, which keeps every split of the float32 features the trees
+        compare; the other machines may predict differently on points close
+        to their decision boundary.
+        """
+        bank = copy.copy(self)
+        bank.dtype = np.dtype(dtype).type
+        if self.weights_ is not None:
+            bank.weights_ = self.weights_.astype(dtype)
+            bank.bias_ = self.bias_.astype(dtype)
+        if self.left_ is not None:
+            threshold = self.threshold_.astype(dtype)
+            above = threshold > self.threshold_
+            threshold[above] = np.nextafter(threshold[above], -np.inf)
+            bank.threshold_ = threshold
+            # node numbers and features in the smallest integers holding them
+            bank.left_ = self.left_.astype(consensus.code_dtype(len(self.left_)))
+            bank.right_ = self.right_.astype(bank.left_.dtype)
+            bank.feature_ = self.feature_.astype(consensus.code_dtype(self.feature_.max() + 1))
+        bank.machines_ = [_machine_astype(machine, dtype) for machine in self.machines_]
+        return bank
+
+    def predict(self, X):
+        X = np.asarray(X, dtype=self.dtype)
+        scores, leaves = self._shared(X)
+        return consensus.stack_predictions([
+            self._evaluate(machine, X, scores, leaves, False)[0] for machine in self.machines_
+        ]).reshape(len(self.machines_), len(X))
+
+    def outputs(self, X):
+        X = np.asarray(X, dtype=self.dtype)
+        scores, leaves = self._shared(X)
+        return [self._evaluate(machine, X, scores, leaves, True)[1] for machine in self.machines_]
+
+    def _shared(self, X):
+        scores = leaves = None
+        if self.weights_ is not None:
+            with metrics.timer(metrics.MACHINE_SECONDS, machine="linear"):
+                scores = X @ self.weights_
+                scores += self.bias_
+        if self.left_ is not None:
+            with metrics.timer(metrics.MACHINE_SECONDS, machine="trees"):
+                leaves = self.apply(X)
+        return scores, leaves
+
+    def apply(self, X):
+        """
+        Leaf reached by every row in every tree, shape (n_trees, n_samples),
+        as node numbers of the flattened arrays.
+        """
+        # sklearn trees compare float32 features to float64 thresholds
+        X = np.asarray(X, dtype=np.float32)
+        rows = np.arange(len(X))
+        nodes = np.repeat(self.roots_[:, np.newaxis], len(X), axis=1)
+        for active in self.active_trees_:
+            current = nodes[:active]
+            go_left = X[rows, self.feature_[current]] <= self.threshold_[current]
+            nodes[:active] = np.where(go_left, self.left_[current], self.right_[current])
+        leaves = np.empty_like(nodes)
+        leaves[self.tree_order_] = nodes
+        return leaves
+
+    def _evaluate(self, machine, X, scores, leaves, outputs):
+        # (labels, outputs) of one machine, outputs are None unless asked for
+        with metrics.timer(metrics.MACHINE_SECONDS, machine=machine["name"]):
+            return getattr(self, "_" + machine["kind"])(machine, X, scores, leaves, outputs)
+
+    def _linear(self, machine, X, scores, leaves, outputs):
+        decision = scores[:, machine["columns"]]
+        classes = machine["classes"]
+        if machine["output"] == "ovo":
+            # predict goes by the votes alone, ties to the first class
+            votes, decision = _ovo_decision(decision, len(classes))
+            return classes[votes.argmax(axis=1)], decision
+        if decision.shape[1] == 1:
+            decision = decision[:, 0]
+            labels = classes[(decision > 0).astype(np.intp)]
+        else:
+            labels = classes[decision.argmax(axis=1)]
+
+        if not outputs:
+            return labels, None
+        if machine["output"] == "decision":
+            return labels, decision
+        if machine["output"] == "multinomial":
+            return labels, _softmax(decision)
+        proba = _expit(decision)
+        if proba.ndim == 1:
+            return labels, np.vstack([1 - proba, proba]).T
+        return labels, proba / proba.sum(axis=1)[:, np.newaxis]
+
+    def _mlp(self, machine, X, scores, leaves, outputs):
+        activation = scores[:, machine["columns"]]
+        hidden = ACTIVATIONS[machine["activation"]]
+        for coef, intercept in machine["layers"]:
+            activation = hidden(activation)
+            activation = activation @ coef
+            activation += intercept
+
+        classes = machine["classes"]
+        if machine["output"] == "softmax":
+            proba = _softmax(activation)
+            return classes[proba.argmax(axis=1)], proba
+        proba = _expit(activation[:, 0])
+        return classes[(proba > 0.5).astype(np.intp)], np.vstack([1 - proba, proba]).T
+
+    def _naive_bayes(self, machine, X, scores, leaves, outputs):
+        joint = np.array([
+            log_prior + log_norm - 0.5 * np.sum(((X - theta) ** 2) / variance, 1)
+            for log_prior, log_norm, theta, variance in zip(
+                machine["log_prior"], machine["log_norm"], machine["theta"], machine["variance"])
+        ]).T
+        labels = machine["classes"][joint.argmax(axis=1)]
+        if not outputs:
+            return labels, None
+        return labels, np.exp(joint - _logsumexp(joint)[:, np.newaxis])
+
+    def _tree(self, machine, X, scores, leaves, outputs):
+        values = machine["values"][leaves[machine["tree_range"]][0] - machine["node_offset"]]
+        labels = machine["classes"][values.argmax(axis=1)]
+        return labels, _normalize(values) if outputs else None
+
+    def _forest(self, machine, X, scores, leaves, outputs):
+        proba = np.zeros((len(X), len(machine["classes"])), dtype=machine["values"].dtype)
+        for tree_leaves in leaves[machine["tree_range"]]:
+            proba += machine["values"][tree_leaves - machine["node_offset"]]
+        proba /= machine["tree_range"].stop - machine["tree_range"].start
+        return machine["classes"][proba.argmax(axis=1)], proba
+
+    def _boosting(self, machine, X, scores, leaves, outputs):
+        raw = np.repeat(machine["init"][np.newaxis], len(X), axis=0)
+        n_outputs = machine["n_outputs"]
+        # stage by stage, in the order sklearn adds them up
+        for i, tree_leaves in enumerate(leaves[machine["tree_range"]]):
+            raw[:, i % n_outputs] += machine["values"][tree_leaves - machine["node_offset"]]
+
+        classes = machine["classes"]
+        if n_outputs == 1:
+            positive = _expit(raw[:, 0])
+            proba = np.vstack([1 - positive, positive]).T
+        else:
+            proba = np.exp(raw - _logsumexp(raw)[:, np.newaxis])
+        return classes[proba.argmax(axis=1)], proba
+
+    def _knn(self, machine, X, scores, leaves, outputs):
+        fit_X, y = machine["fit_X"], machine["y"]
+        n_classes = len(machine["classes"])
+        k = machine["n_neighbors"]
+
+        weights = np.zeros((len(X), n_classes), dtype=X.dtype)
+        rows = np.arange(len(X))[:, np.newaxis]
+        for start, stop in consensus.query_blocks(len(X), len(fit_X)):
+            # squared euclidean distances the way brute force kneighbors
+            # computes them, then the k smallest
+            query = X[start:stop]
+            distances = -2 * (query @ fit_X.T)
+            distances += np.einsum("ij,ij->i", query, query)[:, np.newaxis]
+            distances += np.einsum("ij,ij->i", fit_X, fit_X)[np.newaxis, :]
+            np.maximum(distances, 0, out=distances)
+            neighbours = np.argpartition(distances, k - 1, axis=1)[:, :k]
+
+            block_rows = rows[:stop - start]
+            if machine["weighting"] == "distance":
+                with np.errstate(divide="ignore"):
+                    neighbour_weights = 1.0 / np.sqrt(distances[block_rows, neighbours])
+                exact = np.isinf(neighbour_weights)
+                exact_rows = exact.any(axis=1)
+                neighbour_weights[exact_rows] = exact[exact_rows]
+            else:
+                neighbour_weights = np.ones(neighbours.shape)
+            np.add.at(weights[start:stop], (block_rows, y[neighbours]), neighbour_weights)
+
+        # ties go to the smallest class, like scipy.stats.mode
+        return machine["classes"][weights.argmax(axis=1)], _normalize(weights)
+
+
+def _machine_astype(machine, dtype):
+    # the floating point arrays of a compiled machine in dtype
+    converted = {}
+    for key, value in machine.items():
+        if key == "layers":
+            value = [(coef.astype(dtype), intercept.astype(dtype)) for coef, intercept in value]
+        elif key != "classes" and isinstance(value, np.ndarray) and value.dtype.kind == "f":
+            value = value.astype(dtype)
+        converted[key] = value
+    return converted
+
+
+# what CompiledCobra keeps of a ClassifierCobra
+INFERENCE_STATE = ("classes_l_", "y_l_", "y_l_codes_", "machine_predictions_",
+                   "machine_labels_", "signature_index_", "calibration_scores_")
+
+
+class CompiledCobra(consensus.CobraConsensus):
+    """
+    A fitted ClassifierCobra for serving: the same predict, predict_proba,
+    predict_sweep and add_calibration, with the machines evaluated by a
+    MachineBank. Loading and running it imports NumPy but not sklearn.
+    Built by ClassifierCobra.export.
+    """
+
+    def __init__(self, bank, machine_list="basic"):
+        self.bank = bank
+        self.machine_list = machine_list
+
+    @classmethod
+    def from_cobra(cls, cobra):
+        compiled = cls(compile_machines(cobra.estimators_), cobra.machine_list)
+        cobra._check_machine_predictions()
+        cobra._check_calibration_scores()
+        for name in INFERENCE_STATE:
+            setattr(compiled, name, copy.deepcopy(getattr(cobra, name, None)))
+        return compiled.compact()
+
+    def astype(self, dtype):
+        """
+        Copy of the model computing in dtype, see MachineBank.astype. The
+        calibration labels and signatures stay small-int codes.
+        """
+        compiled = copy.copy(self)
+        compiled.dtype = np.dtype(dtype).type
+        compiled.bank = self.bank.astype(dtype)
+        compiled.calibration_scores_ = self.calibration_scores_.astype(dtype)
+        return compiled
+
+    def _machines(self):
+        return self.bank.names
+
+    def _machine_labels(self, X):
+        return self.bank.predict(X)
+
+    def _machine_outputs(self, X):
+        return self.bank.outputs(X)
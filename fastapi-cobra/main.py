@@ -1,14 +1,59 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import PlainTextResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.concurrency import run_in_threadpool
 import uvicorn
 import gunicorn
-from pydantic import BaseModel
-from model_australian import predict_helper_australian
-from model_german import predict_helper_german
+from pydantic import BaseModel, ValidationError
+from typing import Literal, Optional
+from model_australian import predict_helper_australian, predict_batch_australian, predict_columns_australian, predict_proba_batch_australian
+from model_german import predict_helper_german, predict_batch_german, predict_columns_german, prediction_json_german, predict_proba_batch_german
+from registry import registry, process_memory
+from batching import MicroBatcher
+from cache import PredictionCache, request_digest
+import columnar
+import metrics
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
+import csv
+import gc
+import io
+import json
+import logging
+import os
+
+logger = logging.getLogger("cobra.api")
 
 app = FastAPI()
 
+# largest number of loan applications accepted by a batch endpoint
+MAX_BATCH_SIZE = int(os.environ.get("COBRA_MAX_BATCH_SIZE", 10000))
+
+# With COBRA_MICRO_BATCHING=1 single-record requests arriving within the same
+# window are scored together through the batch prediction path
+australian_batcher = None
+german_batcher = None
+if os.environ.get("COBRA_MICRO_BATCHING", "0") == "1":
+    batch_workers = int(os.environ.get("COBRA_BATCH_WORKERS", 2))
+    batch_settings = dict(
+        max_batch_size=int(os.environ.get("COBRA_BATCH_MAX_SIZE", 64)),
+        max_wait=float(os.environ.get("COBRA_BATCH_WINDOW_MS", 5)) / 1000,
+        max_concurrency=batch_workers,
+        executor=ThreadPoolExecutor(max_workers=batch_workers),
+    )
+    australian_batcher = MicroBatcher(predict_batch_australian, **batch_settings)
+    german_batcher = MicroBatcher(predict_batch_german, **batch_settings)
+
+# With COBRA_CACHE_SIZE > 0 single-record predictions are cached for
+# COBRA_CACHE_TTL seconds, so repeated submissions skip the models
+prediction_cache = None
+if int(os.environ.get("COBRA_CACHE_SIZE", 0)) > 0:
+    prediction_cache = PredictionCache(
+        max_size=int(os.environ.get("COBRA_CACHE_SIZE")),
+        ttl=float(os.environ.get("COBRA_CACHE_TTL", 300)),
+        current_version=registry.version,
+    )
+
 origins = ["*"]
 
 app.add_middleware(
@@ -19,6 +64,14 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# With COBRA_METRICS=1 every request is timed; the middleware is left out
+# otherwise so that it costs nothing
+if metrics.enabled():
+    @app.middleware("http")
+    async def time_request(request: Request, call_next):
+        with metrics.timer(metrics.REQUEST_SECONDS, path=request.url.path):
+            return await call_next(request)
+
 # pydantic models
 
 
@@ -40,7 +93,8 @@ class request_body_australian(BaseModel):
 
 
 class request_body_german(BaseModel):
-    employ: str
+    # the ordinal categories the German models were trained on
+    employ: Literal["A71", "A72", "A73", "A74", "A75"]
     age: int
     amount: int
     duration: int
@@ -51,20 +105,176 @@ class request_body_german(BaseModel):
     status: str
 
 
+async def read_batch(request, model):
+    '''
+    Parse a batch of records sent as a JSON array, as NDJSON (application/x-ndjson)
+    or as a CSV file with a header row (text/csv), and validate every record.
+    '''
+    body = await request.body()
+    content_type = request.headers.get("content-type", "application/json")
+
+    try:
+        body = body.decode("utf-8")
+        if "csv" in content_type:
+            records = list(csv.DictReader(io.StringIO(body)))
+        elif "ndjson" in content_type:
+            records = [json.loads(line) for line in body.splitlines() if line.strip()]
+        else:
+            records = json.loads(body)
+    except (ValueError, csv.Error) as e:
+        raise HTTPException(status_code=400, detail="Malformed batch: %s" % e)
+
+    if not isinstance(records, list):
+        raise HTTPException(status_code=400, detail="A batch must be a list of records.")
+    if len(records) > MAX_BATCH_SIZE:
+        raise HTTPException(
+            status_code=413, detail="A batch holds at most %d records." % MAX_BATCH_SIZE)
+
+    rows = []
+    for index, record in enumerate(records):
+        if not isinstance(record, dict):
+            raise HTTPException(
+                status_code=422, detail=[{"record": index, "msg": "record must be an object"}])
+        try:
+            rows.append(list(model(**record).dict().values()))
+        except ValidationError as e:
+            raise HTTPException(
+                status_code=422, detail=[{"record": index, "errors": e.errors()}])
+    return rows
+
+
+def field_types(model):
+    '''
+    The (name, type) pairs of the fields of a request model, in order.
+    '''
+    if hasattr(model, "model_fields"):
+        # pydantic 2
+        return [(name, field.annotation) for name, field in model.model_fields.items()]
+    return [(name, field.outer_type_) for name, field in model.__fields__.items()]
+
+
+async def read_columns(request, model, fmt):
+    '''
+    Parse a columnar batch, an Arrow IPC stream or a msgpack map of columns,
+    and validate it column by column against the fields of model. Gives one
+    array per field, in order.
+    '''
+    try:
+        columns = columnar.read_columns(await request.body(), fmt)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail="Malformed batch: %s" % e)
+
+    if max([len(values) for values in columns.values()], default=0) > MAX_BATCH_SIZE:
+        raise HTTPException(
+            status_code=413, detail="A batch holds at most %d records." % MAX_BATCH_SIZE)
+
+    fields = field_types(model)
+    try:
+        return columnar.validate(columns, fields)
+    except columnar.ColumnError as e:
+        raise HTTPException(status_code=422, detail=[e.detail()])
+
+
+def batch_response(request, name, predictions):
+    '''
+    The predictions of a batch as a typed column in the format named by the
+    Accept header, or by the Content-Type of the batch when Accept names
+    neither a columnar format nor JSON. A JSON list otherwise.
+    '''
+    accept = request.headers.get("accept", "")
+    fmt = columnar.media_type(accept)
+    if fmt is None and "json" not in accept:
+        fmt = columnar.media_type(request.headers.get("content-type"))
+    if fmt is None:
+        return list(predictions) if isinstance(predictions, list) else predictions.tolist()
+    return Response(columnar.write_columns({name: predictions}, fmt), media_type=fmt)
+
+
+async def cached_prediction(dataset, data, predict):
+    '''
+    Serve the prediction of a validated request body from the cache, or get
+    it from predict (a coroutine function) and cache it. Predictions are
+    cached with the version of the models that made them.
+    '''
+    if prediction_cache is None:
+        return await predict()
+
+    version = registry.version(dataset)
+    digest = request_digest(data.dict())
+    if version is not None:
+        found, prediction = prediction_cache.get(dataset, version, digest)
+        if found:
+            return prediction
+
+    prediction = await predict()
+    # the first request of an untrained dataset trains it, cache from the next one
+    if version is not None and prediction is not None:
+        prediction_cache.put(dataset, version, digest, prediction)
+    return prediction
+
+
+@app.on_event("startup")
+def load_models():
+    # load the trained models once, before the first request comes in
+    registry.preload()
+
+
 @app.get("/")
 def welcome():
     return {"ping": "Hello COBRA. Go to /docs to see the Swagger documentation"}
 
 
+@app.get("/models", status_code=200)
+def get_models():
+    '''
+    Get the load time (seconds) and memory (bytes) of the models held by this worker.
+    '''
+    return registry.stats()
+
+
+@app.get("/memory", status_code=200)
+def get_memory():
+    '''
+    Get the memory (bytes) of the worker serving this request: resident (rss),
+    proportional (pss), shared and private pages. Models preloaded by the
+    gunicorn master show up as shared pages.
+    '''
+    memory = process_memory()
+    memory["gc_frozen_objects"] = gc.get_freeze_count()
+    return memory
+
+
+@app.get("/cache", status_code=200)
+def get_cache():
+    '''
+    Get the size, hits and misses of the prediction cache of this worker.
+    Empty unless COBRA_CACHE_SIZE is set.
+    '''
+    if prediction_cache is None:
+        return {}
+    return prediction_cache.stats()
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def get_metrics():
+    '''
+    Get the timing histograms of this worker in the Prometheus text format:
+    request time, time per prediction stage (load, preprocessing, predict),
+    time per COBRA machine and in the consensus, and the number of
+    calibration points selected per query. Empty unless COBRA_METRICS=1.
+    '''
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
 @app.post("/predict_australian", status_code=200)
-def get_prediction_australian(data: request_body_australian):
+async def get_prediction_australian(data: request_body_australian):
     '''
     Get prediction for Australian Dataset using COBRA. The accuracy is 85.07%. 
     Sending a JSON query to this end point will give a response of 0 or 1.
     '''
-    print(data)
+    logger.debug("%s", data)
 
-    prediction = predict_helper_australian(
+    record = [
         data.param1,
         data.param2,
         data.param3,
@@ -79,23 +289,79 @@ def get_prediction_australian(data: request_body_australian):
         data.param12,
         data.param13,
         data.param14,
-    )
+    ]
+
+    async def predict():
+        if australian_batcher is not None:
+            return await australian_batcher.submit(record)
+        return await run_in_threadpool(predict_helper_australian, *record)
 
-    if not prediction:
+    try:
+        prediction = await cached_prediction("australian", data, predict)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    if prediction is None:
         raise HTTPException(status_code=400, detail="Model not found.")
 
     return prediction
 
 
+@app.post("/predict_australian/batch", status_code=200)
+async def get_batch_prediction_australian(request: Request):
+    '''
+    Get predictions for many applications of the Australian Dataset at once.
+    The body is a JSON array, NDJSON or CSV of records with the fields of
+    /predict_australian, or one column per field as an Arrow IPC stream
+    (application/vnd.apache.arrow.stream) or a msgpack map (application/msgpack).
+    The response lists 0 or 1 for every record, in order, as JSON or as the
+    "prediction" column of the columnar format asked for.
+    '''
+    fmt = columnar.media_type(request.headers.get("content-type"))
+    try:
+        if fmt is not None:
+            columns = await read_columns(request, request_body_australian, fmt)
+            predictions = np.zeros(0)
+            if len(columns[0]):
+                predictions = await run_in_threadpool(predict_columns_australian, columns)
+        else:
+            rows = await read_batch(request, request_body_australian)
+            predictions = []
+            if rows:
+                predictions = await run_in_threadpool(predict_batch_australian, rows)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return batch_response(request, "prediction", predictions)
+
+
+@app.post("/predict_australian_proba", status_code=200)
+async def get_prediction_proba_australian(data: request_body_australian, kernel: Optional[str] = None,
+                                          metric: Optional[str] = None, bandwidth: float = 1):
+    '''
+    Get class probabilities for Australian Dataset using COBRA. Without kernel and
+    metric these are the shares of the calibration points selected by COBRA; with
+    them every calibration point is weighted by the kernel (gaussian, triangular,
+    epanechnikov or uniform) of the distance (euclidean, manhattan or hamming)
+    between its machine outputs and those of the query.
+    '''
+    record = list(data.dict().values())
+    try:
+        probabilities = await run_in_threadpool(
+            predict_proba_batch_australian, [record], kernel, metric, bandwidth)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return probabilities[0]
+
+
 @app.post("/predict_german", status_code=200)
-def get_prediction_german(data: request_body_german):
+async def get_prediction_german(data: request_body_german):
     '''
     Get prediction for German Dataset using COBRA. The accuracy is 70.37%. 
     Sending a JSON query to this end point will give a JSON object.
     '''
-    print(data)
+    logger.debug("%s", data)
 
-    prediction_json = predict_helper_german(
+    record = [
         data.employ,
         data.age,
         data.amount,
@@ -105,9 +371,61 @@ def get_prediction_german(data: request_body_german):
         data.purpose,
         data.savings,
         data.status,
-    )
+    ]
+
+    async def predict():
+        if german_batcher is not None:
+            return prediction_json_german(await german_batcher.submit(record))
+        return await run_in_threadpool(predict_helper_german, *record) or None
+
+    try:
+        prediction_json = await cached_prediction("german", data, predict)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
     if not prediction_json:
         raise HTTPException(status_code=400, detail="Model not found.")
 
     return prediction_json
+
+
+@app.post("/predict_german/batch", status_code=200)
+async def get_batch_prediction_german(request: Request):
+    '''
+    Get predictions for many applications of the German Dataset at once.
+    The body is a JSON array, NDJSON or CSV of records with the fields of
+    /predict_german, or one column per field as with /predict_australian/batch.
+    The response lists the predicted status of every record, in order, as JSON
+    or as the "Predicted Status" column of the columnar format asked for.
+    '''
+    fmt = columnar.media_type(request.headers.get("content-type"))
+    try:
+        if fmt is not None:
+            columns = await read_columns(request, request_body_german, fmt)
+            predictions = np.zeros(0)
+            if len(columns[0]):
+                predictions = await run_in_threadpool(predict_columns_german, columns)
+        else:
+            rows = await read_batch(request, request_body_german)
+            predictions = []
+            if rows:
+                predictions = await run_in_threadpool(predict_batch_german, rows)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return batch_response(request, "Predicted Status", predictions)
+
+
+@app.post("/predict_german_proba", status_code=200)
+async def get_prediction_proba_german(data: request_body_german, kernel: Optional[str] = None,
+                                      metric: Optional[str] = None, bandwidth: float = 1):
+    '''
+    Get class probabilities for German Dataset using COBRA, with the options of
+    /predict_australian_proba.
+    '''
+    record = list(data.dict().values())
+    try:
+        probabilities = await run_in_threadpool(
+            predict_proba_batch_german, [record], kernel, metric, bandwidth)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return probabilities[0]
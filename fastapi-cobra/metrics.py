@@ -0,0 +1,144 @@
+# Timing instrumentation of the prediction path, exposed in the Prometheus
+# text format by the /metrics endpoint of main.py.
+#
+# Metrics are off unless COBRA_METRICS=1 (or enable() is called). Disabled,
+# timer() hands out one shared no-op context manager and nothing is recorded.
+# Every process keeps its own metrics, so with several gunicorn workers each
+# scrape sees the worker that served it.
+
+from contextlib import nullcontext
+import os
+import threading
+import time
+
+import numpy as np
+
+_enabled = os.environ.get("COBRA_METRICS", "0") == "1"
+
+# seconds, from a tenth of a millisecond to ten seconds
+TIME_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# number of calibration points selected by COBRA for a query
+POINT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+_NULL_TIMER = nullcontext()
+
+
+def enabled():
+    return _enabled
+
+
+def enable(flag=True):
+    global _enabled
+    _enabled = flag
+
+
+class Histogram:
+    """
+    Prometheus histogram with one series per combination of label values.
+    """
+
+    def __init__(self, name, documentation, buckets, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = np.asarray(buckets, dtype=np.float64)
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._series = {}
+
+    def observe(self, value, **labels):
+        self.observe_many([value], **labels)
+
+    def observe_many(self, values, **labels):
+        values = np.asarray(values, dtype=np.float64).ravel()
+        # bucket i counts the values <= buckets[i], the last one is +Inf
+        counts = np.bincount(
+            np.searchsorted(self.buckets, values), minlength=len(self.buckets) + 1)
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [np.zeros(len(self.buckets) + 1, dtype=np.int64), 0.0]
+            series[0] += counts
+            series[1] += float(values.sum())
+
+    def reset(self):
+        with self._lock:
+            self._series = {}
+
+    def render(self):
+        lines = [
+            "# HELP %s %s" % (self.name, self.documentation),
+            "# TYPE %s histogram" % self.name,
+        ]
+        with self._lock:
+            series = sorted((key, counts.copy(), total) for key, (counts, total) in self._series.items())
+        bounds = ["%g" % bound for bound in self.buckets] + ["+Inf"]
+        for key, counts, total in series:
+            labels = ['%s="%s"' % (name, value) for name, value in zip(self.labelnames, key)]
+            for bound, count in zip(bounds, np.cumsum(counts)):
+                lines.append("%s_bucket%s %d" % (
+                    self.name, _format_labels(labels + ['le="%s"' % bound]), count))
+            lines.append("%s_sum%s %r" % (self.name, _format_labels(labels), total))
+            lines.append("%s_count%s %d" % (self.name, _format_labels(labels), counts.sum()))
+        return lines
+
+
+def _format_labels(labels):
+    return "{%s}" % ",".join(labels) if labels else ""
+
+
+class _Timer:
+    __slots__ = ("histogram", "labels", "start")
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+        return False
+
+
+def timer(histogram, **labels):
+    '''
+    Context manager recording the time spent in its block into histogram.
+    '''
+    if not _enabled:
+        return _NULL_TIMER
+    return _Timer(histogram, labels)
+
+
+STAGE_SECONDS = Histogram(
+    "cobra_stage_seconds", "Time spent in each stage of a prediction.",
+    TIME_BUCKETS, ("dataset", "stage"))
+
+MACHINE_SECONDS = Histogram(
+    "cobra_machine_predict_seconds", "Time spent in the predict call of each COBRA machine.",
+    TIME_BUCKETS, ("machine",))
+
+CONSENSUS_SECONDS = Histogram(
+    "cobra_consensus_seconds", "Time spent combining the machine predictions into COBRA votes.",
+    TIME_BUCKETS)
+
+SELECTED_POINTS = Histogram(
+    "cobra_selected_points", "Calibration points selected by COBRA for a query.",
+    POINT_BUCKETS)
+
+REQUEST_SECONDS = Histogram(
+    "cobra_request_seconds", "Time spent serving a request.",
+    TIME_BUCKETS, ("path",))
+
+HISTOGRAMS = [STAGE_SECONDS, MACHINE_SECONDS, CONSENSUS_SECONDS, SELECTED_POINTS, REQUEST_SECONDS]
+
+
+def render():
+    lines = []
+    for histogram in HISTOGRAMS:
+        lines.extend(histogram.render())
+    return "\n".join(lines) + "\n"
@@ -1,23 +1,14 @@
 # model and path libraries
 from pathlib import Path
-import joblib
 
 # data analysis libraries
-from sklearn.model_selection import train_test_split, cross_val_score
-from sklearn.preprocessing import normalize
-from sklearn.decomposition import PCA
-from sklearn.tree import DecisionTreeClassifier
-from sklearn.feature_selection import SelectFromModel
 import numpy as np
 import pandas as pd
-import pickle
 
 # cobra library
-import classifiercobra
-
-# visualization libraries
-import matplotlib.pyplot as plt
-import seaborn as sns
+import metrics
+import pipelines
+from registry import registry, save_bundle
 
 # ignore warnings
 import warnings
@@ -31,17 +22,23 @@ australian_credit_train_data = BASE_DIR.joinpath("data/australian.dat")
 
 
 def train():
+    # training libraries, imported here to keep them off the serving path
+    import classifiercobra
+    import ingest
+    from sklearn.preprocessing import normalize
+    from sklearn.decomposition import PCA
+    from sklearn.tree import DecisionTreeClassifier
+    from sklearn.feature_selection import SelectFromModel
+
     # cleaning of tha data before training -----------------------------------------------------------------
 
-    # Reading the data into python
-    df = pd.read_table(australian_credit_train_data, sep='\s+', header=None)
-    df.columns = ['X1', 'X2', 'X3', 'X4', 'X5', 'X6', 'X7',
-                  'X8', 'X9', 'X10', 'X11', 'X12', 'X13', 'X14', 'Y']
+    # Reading the data into python, parsed once and memory-mapped from the ingestion cache afterwards
+    data = ingest.load("australian", australian_credit_train_data)
 
     # Data Pre-processing
-    # Drop 'Y' column from df and then make a new DataFrame = y
-    x = df.drop('Y', axis=1)
-    y = df['Y']
+    # x holds the 'X1' ... 'X14' columns and y the 'Y' column
+    x = data.features
+    y = data.target
 
     # Decide feature importance using DecisionTreeClassifier
     pohon = DecisionTreeClassifier(class_weight='balanced', random_state=15)
@@ -52,15 +49,9 @@ def train():
     # Transforms x to x_new, with attributes based on importance, using median as a thershold.
     fs = SelectFromModel(pohon, threshold='median', prefit=True)
 
-    # Store fs for tranforming input data later on
-    joblib.dump(fs, Path(BASE_DIR).joinpath("australian_fs.joblib"))
-
     x_new = fs.transform(x)
     x_new = pd.DataFrame(x_new)
 
-    # Storing final data for future use
-    joblib.dump(x_new, Path(BASE_DIR).joinpath("australian_x_new.joblib"))
-
     # Create dummies for categorial features.
     x_dummy = pd.get_dummies(x_new[[2, 3, 4]], columns=[2, 3, 4])
 
@@ -71,9 +62,6 @@ def train():
     pca = PCA(n_components=2)
     pca.fit(x_norm)
 
-    # Store pca for transforming input data later on
-    joblib.dump(pca, Path(BASE_DIR).joinpath("australian_pca.joblib"))
-
     x_pca = pca.transform(x_norm)
     x_pca = pd.DataFrame(x_pca)
     x_pca = pd.concat([x_pca, x_dummy], axis=1)
@@ -85,58 +73,95 @@ def train():
     # Training the model on 100% Data available
     cobra_model = cobra.fit(x_pca, y)
 
-    accuracy_values = cross_val_score(
-        cobra_model, x_pca, y, cv=10, scoring="f1_weighted")
+    # 10-fold Cross Validation of the basic and advanced machine lists, fitting the machines once per fold
+    report = cobra_model.evaluate(
+        x_pca, y, cv=10, machine_lists=["basic", "advanced"])
+    print("\nMean 10-fold accuracy of the basic machine list:",
+          round(np.mean([row["score"] for row in report if row["machine_list"] == "basic"]), 4))
+
+    accuracy_values = np.array(
+        [row["score"] for row in report if row["machine_list"] == "advanced"])
     print("\nAccuracy values for 10-fold Cross Validation:\n", accuracy_values)
     print("\nFinal Average Accuracy of the COBRA model:",
           round(accuracy_values.mean(), 4))
 
-    # Dumping the trained model for future use
-    joblib.dump(cobra, Path(BASE_DIR).joinpath("australian_cobra.joblib"))
-
+    # Compiling fs, the dummy vocabulary of x_new and pca for transforming input data later on
+    pipeline = pipelines.AustralianPipeline().fit(fs, x_new, pca)
+
+    # Compiling the machines to NumPy and keeping only what predictions need,
+    # so that serving the bundle does not import sklearn
+    cobra = cobra.export()
+
+    # Dumping the preprocessing and the trained model as one bundle for future use
+    save_bundle("australian", {"pipeline": pipeline, "cobra": cobra})
+
+
+def prepare_australian(loan_details, models=None):
+    # models default to the ones the registry serves, the stored ones are
+    # passed by update
+    if models is None:
+        # The model has not been trained - so train it
+        if not registry.exists("australian"):
+            train()
+
+        # Trained artefacts are loaded once and shared across requests
+        with metrics.timer(metrics.STAGE_SECONDS, dataset="australian", stage="load"):
+            models = registry.get("australian")
+
+    # Compiling fs, the stored dummy vocabulary and pca into one NumPy pipeline,
+    # once for every loaded set of artefacts
+    if "pipeline" not in models:
+        models["pipeline"] = pipelines.AustralianPipeline().fit(
+            models["fs"], models["x_new"], models["pca"])
+
+    # loan details is a dataframe with one row per loan application
+    with metrics.timer(metrics.STAGE_SECONDS, dataset="australian", stage="preprocess"):
+        x_pca = models["pipeline"].transform(loan_details)
+    return x_pca, models["cobra"]
+
+
+def update(data_path, max_points=None):
+    '''
+    Add newly labelled applications, in the format of data/australian.dat, to
+    the calibration set of the trained model without retraining it. With
+    max_points only the most recent points are kept. The bundle is rewritten
+    and picked up by the registry like a retrained one.
+    '''
+    df = pd.read_table(data_path, sep='\s+', header=None)
+    df.columns = ['X1', 'X2', 'X3', 'X4', 'X5', 'X6', 'X7',
+                  'X8', 'X9', 'X10', 'X11', 'X12', 'X13', 'X14', 'Y']
 
-def predict_australian(loan_details):
-    # File paths for all joblib files
-    model_file = Path(BASE_DIR).joinpath("australian_cobra.joblib")
-    fs_file = Path(BASE_DIR).joinpath("australian_fs.joblib")
-    pca_file = Path(BASE_DIR).joinpath("australian_pca.joblib")
-    x_new_file = Path(BASE_DIR).joinpath("australian_x_new.joblib")
-
-    # The model has not been trained - so train it
-    if not model_file.exists():
+    if not registry.exists("australian"):
         train()
-        model_file = Path(BASE_DIR).joinpath("australian_cobra.joblib")
 
-    # Assumning loan details is a dataframe with only 1 row ...
-    # This is valid because the API will only accept 1 set of values at a time
-    x = loan_details
+    # Updating the stored models in full precision, the loaded ones keep
+    # serving until the bundle is reloaded
+    models = registry.stored("australian")
+    x_pca, cobra = prepare_australian(df.drop('Y', axis=1), models)
+    pipeline = models["pipeline"]
+    cobra = cobra.add_calibration(x_pca, df['Y'], max_points=max_points)
+    save_bundle("australian", {"pipeline": pipeline, "cobra": cobra})
+    return cobra
 
-    # Using fs to transform x
-    fs = joblib.load(fs_file)
-    x_new = fs.transform(x)
-    x_new = pd.DataFrame(x_new)
 
-    x_new_stored = joblib.load(x_new_file)
-    x_new_stored.iloc[0] = x_new.values[0].tolist()
+def predict_australian(loan_details):
+    x_pca, cobra = prepare_australian(loan_details)
 
-    # Create dummies for categorial features.
-    x_dummy = pd.get_dummies(x_new_stored[[2, 3, 4]], columns=[2, 3, 4])
-    x_dummy = x_dummy.head(1)
+    # Using trained model with COBRA to make a prediction
+    with metrics.timer(metrics.STAGE_SECONDS, dataset="australian", stage="predict"):
+        prediction = cobra.predict(x_pca)
 
-    # Perform a row normalization on the conitnuous data
-    x_norm = pd.DataFrame(normalize(x_new[[0, 1, 5, 6]]))
+    return prediction
 
-    # Using pca to transform x_norm
-    pca = joblib.load(pca_file)
-    x_pca = pca.transform(x_norm)
-    x_pca = pd.DataFrame(x_pca)
-    x_pca = pd.concat([x_pca, x_dummy], axis=1)
 
-    # Using trained model with COBRA to make a prediction
-    cobra = joblib.load(model_file)
-    prediction = cobra.predict(x_pca)
+def predict_proba_australian(loan_details, kernel=None, metric=None, bandwidth=1):
+    x_pca, cobra = prepare_australian(loan_details)
 
-    return prediction
+    # Using trained model with COBRA to get the probability of every class
+    probabilities = cobra.predict_proba(
+        x_pca, kernel=kernel, metric=metric, bandwidth=bandwidth)
+
+    return pd.DataFrame(probabilities, columns=[str(label) for label in cobra.classes_l_])
 
 
 def predict_helper_australian(param1, param2, param3, param4, param5, param6, param7, param8, param9, param10, param11, param12, param13, param14):
@@ -154,6 +179,42 @@ def predict_helper_australian(param1, param2, param3, param4, param5, param6, pa
     return prediciton
 
 
+def predict_batch_australian(loan_applications):
+    # loan applications is a list of [param1, ..., param14] rows
+    new_loan_applications = pd.DataFrame(
+        data=loan_applications,
+        columns=[
+            "X1", "X2", "X3", "X4", "X5", "X6", "X7", "X8", "X9", "X10", "X11", "X12", "X13", "X14"
+        ],
+    )
+
+    predictions = predict_australian(new_loan_applications)
+    return predictions.tolist()
+
+
+def predict_columns_australian(columns):
+    # columns holds one array per field, param1 ... param14, as validated by columnar
+    new_loan_applications = pd.DataFrame(dict(zip(
+        ["X1", "X2", "X3", "X4", "X5", "X6", "X7", "X8", "X9", "X10", "X11", "X12", "X13", "X14"],
+        columns)))
+
+    return predict_australian(new_loan_applications)
+
+
+def predict_proba_batch_australian(loan_applications, kernel=None, metric=None, bandwidth=1):
+    # loan applications is a list of [param1, ..., param14] rows
+    new_loan_applications = pd.DataFrame(
+        data=loan_applications,
+        columns=[
+            "X1", "X2", "X3", "X4", "X5", "X6", "X7", "X8", "X9", "X10", "X11", "X12", "X13", "X14"
+        ],
+    )
+
+    probabilities = predict_proba_australian(
+        new_loan_applications, kernel=kernel, metric=metric, bandwidth=bandwidth)
+    return probabilities.to_dict("records")
+
+
 '''
 # How to use the predict function? --- code below.
 new_loan_application = pd.DataFrame(
@@ -1,20 +1,14 @@
 # model and path libraries
 from pathlib import Path
-import joblib
 
 # data analysis libraries
-from sklearn.model_selection import train_test_split, cross_val_score
-from sklearn.preprocessing import StandardScaler, MinMaxScaler
 import numpy as np
 import pandas as pd
-import pickle
 
 # cobra library
-import classifiercobra
-
-# visualization libraries
-import matplotlib.pyplot as plt
-import seaborn as sns
+import metrics
+import pipelines
+from registry import registry, save_bundle
 
 # ignore warnings
 import warnings
@@ -28,57 +22,22 @@ german_credit_train_data = BASE_DIR.joinpath("data/german.csv")
 
 
 def train():
-    # cleaning of tha data before training -----------------------------------------------------------------
+    # training libraries, imported here to keep them off the serving path
+    import classifiercobra
+    import ingest
+    from sklearn.model_selection import train_test_split
+    from sklearn.preprocessing import MinMaxScaler
 
-    # Reading the data into python
-    df = pd.read_csv(german_credit_train_data)
-    df = df.drop_duplicates()
+    # cleaning of tha data before training -----------------------------------------------------------------
 
-    SelectedColumns = [
-        "checkingstatus",
-        "history",
-        "purpose",
-        "savings",
-        "employ",
-        "status",
-        "others",
-        "property",
-        "otherplans",
-        "housing",
-        "foreign",
-        "age",
-        "amount",
-        "duration",
-    ]
+    # Reading the data into python, parsed once and memory-mapped from the ingestion cache afterwards.
+    # The cache holds the data with duplicates dropped and the encodings below applied:
+    # 1. the ordinal variable employ and the binary nominal variable foreign mapped to numbers,
+    # 2. all the nominal variables converted to dummy variables with get_dummies()
+    data = ingest.load("german", german_credit_train_data)
 
     # Selecting final columns
-    DataForML = df[SelectedColumns]
-
-    # Saving this final data for reference during deployment
-    joblib.dump(DataForML, Path(BASE_DIR).joinpath(
-        "german_data_for_ml.joblib"))
-
-    """# Data Pre-processing for Machine Learning
-    ##### 1. Converting Ordinal variables to numeric using business mapping
-    """
-
-    # Treating the Ordinal variable first
-    DataForML["employ"].replace(
-        {"A71": 1, "A72": 2, "A73": 3, "A74": 4, "A75": 5}, inplace=True
-    )
-
-    # Converting the binary nominal variable to numeric using 1/0 mapping
-    # Treating the binary nominal variable
-
-    DataForML["foreign"].replace({"A201": 1, "A202": 0}, inplace=True)
-
-    """##### 2. Converting nominal variables to numeric using get_dummies()"""
-
-    # Treating all the nominal variables at once using dummy variables
-    DataForML_Numeric = pd.get_dummies(DataForML)
-
-    # Adding Target Variable to the data
-    DataForML_Numeric["GoodCredit"] = df["GoodCredit"]
+    DataForML_Numeric = data.features
 
     # Separate Target Variable and Predictor Variables
     TargetVariable = "GoodCredit"
@@ -132,7 +91,7 @@ def train():
     ]
 
     X = DataForML_Numeric[Predictors].values
-    y = DataForML_Numeric[TargetVariable].values
+    y = data.target
 
     # Splitting the data into training and testing set
 
@@ -194,16 +153,18 @@ def train():
     ]
 
     X = DataForML_Numeric[Predictors].values
-    y = DataForML_Numeric[TargetVariable].values
+    y = data.target
+
+    # Fixing the category vocabulary used to encode loan applications during deployment
+    Encoder = pipelines.CategoricalEncoder(
+        Predictors, ordinal={"employ": {"A71": 1, "A72": 2, "A73": 3, "A74": 4, "A75": 5}}
+    )
+    Encoder.fit(data.categorical)
 
     ### Normalization of data ###
     PredictorScaler = MinMaxScaler()
     PredictorScalerFit = PredictorScaler.fit(X)
 
-    # Store predictor scaler fir for future use
-    joblib.dump(PredictorScalerFit, Path(BASE_DIR).joinpath(
-        "german_predictor_scaler_fit.joblib"))
-
     X = PredictorScalerFit.transform(X)
 
     # Retraining the model using 100% data
@@ -212,92 +173,93 @@ def train():
 
     # Training the model on 100% Data available
     cobra_model = cobra.fit(X, y)
-    accuracy_Values = cross_val_score(
-        cobra_model, X, y, cv=10, scoring="f1_weighted")
+
+    # 10-fold Cross Validation of the basic and advanced machine lists, fitting the machines once per fold
+    report = cobra_model.evaluate(
+        X, y, cv=10, machine_lists=["basic", "advanced"])
+    print("\nMean 10-fold accuracy of the basic machine list:",
+          round(np.mean([row["score"] for row in report if row["machine_list"] == "basic"]), 4))
+
+    accuracy_Values = np.array(
+        [row["score"] for row in report if row["machine_list"] == "advanced"])
     print("\nAccuracy values for 10-fold Cross Validation:\n", accuracy_Values)
     print("\nFinal Average Accuracy of the model:",
           round(accuracy_Values.mean(), 4))
 
-    # Dumping the trained model for future use
-    joblib.dump(cobra, Path(BASE_DIR).joinpath("german_cobra.joblib"))
+    # Compiling the scaler and the machines to NumPy and keeping only what
+    # predictions need, so that serving the bundle does not import sklearn
+    scaler = pipelines.MinMaxScaling().fit(PredictorScalerFit)
+    cobra = cobra.export()
 
+    # Dumping the encoder, the predictor scaler fit and the trained model as one bundle for future use
+    save_bundle("german", {"encoder": Encoder, "scaler": scaler, "cobra": cobra})
 
-def predict_german(loan_details):
-    model_file = Path(BASE_DIR).joinpath("german_cobra.joblib")
-    data_for_ml_file = Path(BASE_DIR).joinpath("german_data_for_ml.joblib")
-    predictor_scaler_fit_file = Path(BASE_DIR).joinpath(
-        "german_predictor_scaler_fit.joblib")
 
-    # the model has not been trained.
-    if not model_file.exists():
-        train()
-        model_file = Path(BASE_DIR).joinpath("german_cobra.joblib")
+def prepare_german(loan_details, models=None):
+    # models default to the ones the registry serves, the stored ones are
+    # passed by update
+    if models is None:
+        # the model has not been trained.
+        if not registry.exists("german"):
+            train()
 
-    num_inputs = loan_details.shape[0]
+        # Trained artefacts are loaded once and shared across requests
+        with metrics.timer(metrics.STAGE_SECONDS, dataset="german", stage="load"):
+            models = registry.get("german")
 
-    # Appending the new data with the Training data
-    DataForML = joblib.load(data_for_ml_file)
-    loan_details = loan_details.append(DataForML)
+    # Encoding the application with the category vocabulary fixed during training,
+    # this gives the same columns as get_dummies over the training data
+    with metrics.timer(metrics.STAGE_SECONDS, dataset="german", stage="encode"):
+        X = models["encoder"].transform(loan_details)
 
-    # Treating the Ordinal variable first
-    loan_details["employ"].replace(
-        {"A71": 1, "A72": 2, "A73": 3, "A74": 4, "A75": 5}, inplace=True
-    )
+    # Generating the standardized values of X since it was done while model training also
+    PredictorScalerFit = models["scaler"]
+    with metrics.timer(metrics.STAGE_SECONDS, dataset="german", stage="scale"):
+        X = PredictorScalerFit.transform(X)
 
-    # Generating dummy variables for rest of the nominal variables
-    loan_details = pd.get_dummies(loan_details)
+    return X, models["cobra"]
 
-    # Maintaining the same order of columns as it was during the model training
-    Predictors = [
-        "employ",
-        "age",
-        "amount",
-        "duration",
-        "checkingstatus_A11",
-        "checkingstatus_A12",
-        "checkingstatus_A13",
-        "checkingstatus_A14",
-        "history_A30",
-        "history_A31",
-        "history_A32",
-        "history_A33",
-        "history_A34",
-        "purpose_A40",
-        "purpose_A41",
-        "purpose_A410",
-        "purpose_A42",
-        "purpose_A43",
-        "purpose_A44",
-        "purpose_A45",
-        "purpose_A46",
-        "purpose_A48",
-        "purpose_A49",
-        "savings_A61",
-        "savings_A62",
-        "savings_A63",
-        "savings_A64",
-        "savings_A65",
-        "status_A91",
-        "status_A92",
-        "status_A93",
-        "status_A94",
-    ]
 
-    # Generating the input values to the model
-    X = loan_details[Predictors].values[0:num_inputs]
+def update(data_path, max_points=None):
+    '''
+    Add newly labelled applications, in the format of data/german.csv, to the
+    calibration set of the trained model without retraining it. With
+    max_points only the most recent points are kept. The bundle is rewritten
+    and picked up by the registry like a retrained one.
+    '''
+    df = pd.read_csv(data_path)
 
-    # Generating the standardized values of X since it was done while model training also
-    PredictorScalerFit = joblib.load(predictor_scaler_fit_file)
-    X = PredictorScalerFit.transform(X)
+    if not registry.exists("german"):
+        train()
 
-    cobra = joblib.load(model_file)
+    # Updating the stored models in full precision, the loaded ones keep
+    # serving until the bundle is reloaded
+    models = registry.stored("german")
+    X, cobra = prepare_german(df, models)
+    cobra = cobra.add_calibration(X, df["GoodCredit"], max_points=max_points)
+    save_bundle("german", {"encoder": models["encoder"], "scaler": models["scaler"], "cobra": cobra})
+    return cobra
+
+
+def predict_german(loan_details):
+    X, cobra = prepare_german(loan_details)
 
     # Genrating Predictions
-    prediction = cobra.predict(X)
+    with metrics.timer(metrics.STAGE_SECONDS, dataset="german", stage="predict"):
+        prediction = cobra.predict(X)
     predicted_status = pd.DataFrame(prediction, columns=["Predicted Status"])
     return predicted_status
 
 
+def predict_proba_german(loan_details, kernel=None, metric=None, bandwidth=1):
+    X, cobra = prepare_german(loan_details)
+
+    # Generating the probability of every class
+    probabilities = cobra.predict_proba(
+        X, kernel=kernel, metric=metric, bandwidth=bandwidth)
+    return pd.DataFrame(probabilities, columns=[str(label) for label in cobra.classes_l_])
+
+
 def predict_helper_german(
     employ,
     age,
@@ -340,6 +302,65 @@ def predict_helper_german(
     return predictions.to_json()
 
 
+def predict_batch_german(loan_applications):
+    # loan applications is a list of [employ, ..., status] rows
+    new_loan_applications = pd.DataFrame(
+        data=loan_applications,
+        columns=[
+            "employ",
+            "age",
+            "amount",
+            "duration",
+            "checkingstatus",
+            "history",
+            "purpose",
+            "savings",
+            "status",
+        ],
+    )
+
+    predictions = predict_german(loan_details=new_loan_applications)
+    return predictions["Predicted Status"].tolist()
+
+
+def predict_columns_german(columns):
+    # columns holds one array per field, employ ... status, as validated by columnar
+    new_loan_applications = pd.DataFrame(dict(zip(
+        ["employ", "age", "amount", "duration", "checkingstatus",
+            "history", "purpose", "savings", "status"],
+        columns)))
+
+    predictions = predict_german(loan_details=new_loan_applications)
+    return predictions["Predicted Status"].to_numpy()
+
+
+def predict_proba_batch_german(loan_applications, kernel=None, metric=None, bandwidth=1):
+    # loan applications is a list of [employ, ..., status] rows
+    new_loan_applications = pd.DataFrame(
+        data=loan_applications,
+        columns=[
+            "employ",
+            "age",
+            "amount",
+            "duration",
+            "checkingstatus",
+            "history",
+            "purpose",
+            "savings",
+            "status",
+        ],
+    )
+
+    probabilities = predict_proba_german(
+        new_loan_applications, kernel=kernel, metric=metric, bandwidth=bandwidth)
+    return probabilities.to_dict("records")
+
+
+def prediction_json_german(prediction):
+    # the JSON predict_helper_german gives for a single application
+    return pd.DataFrame([prediction], columns=["Predicted Status"]).to_json()
+
+
 '''
 # How to use the predict function? --- code below.
 new_loan_application = pd.DataFrame(
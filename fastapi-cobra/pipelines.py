@@ -0,0 +1,189 @@
+# Licensed under the MIT License - https://opensource.org/licenses/MIT
+
+import copy
+
+import numpy as np
+
+
+class CategoricalEncoder:
+    """
+    One-hot encoder with a category vocabulary fixed at fit time.
+
+    Output columns follow the given layout, with dummy columns named
+    "<column>_<category>" like pd.get_dummies. Ordinal columns are mapped
+    through their dict and every other layout column is copied as-is. A
+    category missing from the layout encodes to all zeros, which is what
+    get_dummies followed by column selection gives.
+    """
+
+    # dtype of the encoded features, see astype
+    dtype = np.float64
+
+    def __init__(self, columns, ordinal=None):
+        self.columns = list(columns)
+        self.ordinal = ordinal or {}
+
+    def fit(self, X):
+        position = {column: i for i, column in enumerate(self.columns)}
+
+        self.categories_ = {}
+        self.dummies_ = {}
+        for column in X.columns:
+            if column in position or X[column].dtype.kind in "biufc":
+                continue
+            categories = sorted(X[column].astype(str).unique())
+            dummies = {
+                category: position["%s_%s" % (column, category)]
+                for category in categories
+                if "%s_%s" % (column, category) in position
+            }
+            # columns left out of the layout are not needed at prediction time
+            if dummies:
+                self.categories_[column] = categories
+                self.dummies_[column] = dummies
+
+        dummy_positions = {
+            i for positions in self.dummies_.values() for i in positions.values()}
+        self.numeric_ = [
+            (i, column) for i, column in enumerate(self.columns)
+            if i not in dummy_positions
+        ]
+        return self
+
+    def astype(self, dtype):
+        encoder = copy.copy(self)
+        encoder.dtype = np.dtype(dtype).type
+        return encoder
+
+    def transform(self, X):
+        out = np.zeros((len(X), len(self.columns)), dtype=self.dtype)
+
+        for i, column in self.numeric_:
+            values = np.asarray(X[column])
+            if column in self.ordinal:
+                mapping = self.ordinal[column]
+                try:
+                    values = [mapping[value] for value in values]
+                except KeyError as e:
+                    record = [value in mapping for value in values].index(False)
+                    raise ValueError("Unknown category %r for %s in record %d" % (
+                        e.args[0], column, record))
+            out[:, i] = values
+
+        for column, positions in self.dummies_.items():
+            index = np.fromiter(
+                (positions.get(str(value), -1) for value in np.asarray(X[column])),
+                dtype=np.intp, count=len(X))
+            rows = np.flatnonzero(index >= 0)
+            out[rows, index[rows]] = 1
+        return out
+
+
+class AustralianPipeline:
+    """
+    The preprocessing of model_australian compiled to NumPy arrays.
+
+    The steps are SelectFromModel column selection, l2 row normalization of
+    the continuous columns followed by PCA, and one-hot encoding of the
+    categorical columns with the vocabulary of the stored training frame.
+    The features equal those of the sklearn / pandas steps up to rounding:
+    releases of scikit-learn differ in the order PCA.transform centers and
+    projects. A category outside the vocabulary encodes to zeros.
+    """
+
+    # dtype of the features, see astype
+    dtype = np.float64
+
+    def __init__(self, continuous=(0, 1, 5, 6), categorical=(2, 3, 4)):
+        self.continuous = list(continuous)
+        self.categorical = list(categorical)
+
+    def fit(self, fs, x_new, pca):
+        # fs is the fitted SelectFromModel, x_new the selected training data
+        # and pca the PCA fitted on its normalized continuous columns
+        self.selected_ = np.flatnonzero(fs.get_support())
+        self.categories_ = [
+            np.unique(np.asarray(x_new[column], dtype=np.float64))
+            for column in self.categorical
+        ]
+        self.mean_ = pca.mean_
+        self.components_ = pca.components_
+        self.scale_ = np.sqrt(pca.explained_variance_) if pca.whiten else None
+        self.n_features_ = len(self.components_) + sum(
+            len(categories) for categories in self.categories_)
+        return self
+
+    def astype(self, dtype):
+        '''
+        Copy of the pipeline computing in dtype. The features of float32 are
+        only close to those of the sklearn steps.
+        '''
+        pipeline = copy.copy(self)
+        pipeline.dtype = np.dtype(dtype).type
+        pipeline.categories_ = [categories.astype(dtype) for categories in self.categories_]
+        pipeline.mean_ = self.mean_.astype(dtype)
+        pipeline.components_ = self.components_.astype(dtype)
+        if self.scale_ is not None:
+            pipeline.scale_ = self.scale_.astype(dtype)
+        return pipeline
+
+    def transform(self, X):
+        X = np.asarray(X, dtype=self.dtype)
+        out = np.zeros((len(X), self.n_features_), dtype=self.dtype)
+
+        # SelectFromModel.transform
+        x_new = X[:, self.selected_]
+
+        # normalize (l2 norm over rows)
+        x_norm = x_new[:, self.continuous]
+        norms = np.sqrt(np.einsum("ij,ij->i", x_norm, x_norm))
+        norms[norms < 10 * np.finfo(norms.dtype).eps] = 1.0
+        x_norm /= norms[:, np.newaxis]
+
+        # PCA.transform
+        x_pca = np.dot(x_norm - self.mean_, self.components_.T)
+        if self.scale_ is not None:
+            x_pca /= self.scale_
+        out[:, :x_pca.shape[1]] = x_pca
+
+        # get_dummies with the training vocabulary
+        offset = x_pca.shape[1]
+        for column, categories in zip(self.categorical, self.categories_):
+            values = x_new[:, column]
+            index = np.minimum(np.searchsorted(categories, values), len(categories) - 1)
+            rows = np.flatnonzero(categories[index] == values)
+            out[rows, offset + index[rows]] = 1
+            offset += len(categories)
+        return out
+
+
+class MinMaxScaling:
+    """
+    MinMaxScaler.transform compiled to NumPy arrays, with the same operations
+    so that the features are bit-identical.
+    """
+
+    # dtype of the features, see astype
+    dtype = np.float64
+
+    def fit(self, scaler):
+        # scaler is the fitted MinMaxScaler
+        self.scale_ = scaler.scale_
+        self.min_ = scaler.min_
+        self.clip_ = scaler.feature_range if getattr(scaler, "clip", False) else None
+        return self
+
+    def astype(self, dtype):
+        scaling = copy.copy(self)
+        scaling.dtype = np.dtype(dtype).type
+        scaling.scale_ = self.scale_.astype(dtype)
+        scaling.min_ = self.min_.astype(dtype)
+        return scaling
+
+    def transform(self, X):
+        X = np.array(X, dtype=self.dtype)
+        X *= self.scale_
+        X += self.min_
+        if self.clip_ is not None:
+            np.clip(X, self.clip_[0], self.clip_[1], out=X)
+        return X
@@ -0,0 +1,249 @@
+# model and path libraries
+from pathlib import Path
+import joblib
+
+# bookkeeping libraries
+import logging
+import os
+import threading
+import time
+import tracemalloc
+
+logger = logging.getLogger("cobra.registry")
+
+# ---------------------------------------------------------------------------------------------------------
+
+BASE_DIR = Path(__file__).resolve(strict=True).parent
+
+# version of the bundle layout written by save_bundle
+BUNDLE_VERSION = 1
+
+# COBRA_PRECISION=float32 serves the compiled models and their preprocessing
+# in single precision, converted when they are loaded
+PRECISION = os.environ.get("COBRA_PRECISION", "float64")
+
+# single file holding the preprocessing and the COBRA model of every dataset
+BUNDLES = {
+    "australian": "australian_bundle.joblib",
+    "german": "german_bundle.joblib",
+}
+
+# joblib files of models trained before bundles, used when there is no bundle
+ARTEFACTS = {
+    "australian": {
+        "fs": "australian_fs.joblib",
+        "x_new": "australian_x_new.joblib",
+        "pca": "australian_pca.joblib",
+        "cobra": "australian_cobra.joblib",
+    },
+    "german": {
+        "encoder": "german_encoder.joblib",
+        "scaler": "german_predictor_scaler_fit.joblib",
+        "cobra": "german_cobra.joblib",
+    },
+}
+
+
+def with_precision(models, precision):
+    '''
+    The models converted to precision ("float32" or "float64"). Only the
+    models with an astype method (the compiled pipelines and COBRA models)
+    are converted, sklearn artefacts are kept as they are.
+    '''
+    if precision == "float64":
+        return models
+    return {
+        name: model.astype(precision) if hasattr(model, "astype") else model
+        for name, model in models.items()
+    }
+
+
+def save_bundle(dataset, models, base_dir=BASE_DIR):
+    '''
+    Write the models of a dataset as one versioned bundle. The file is not
+    compressed so that its NumPy arrays can be memory-mapped when loading.
+    '''
+    bundle = dict(models, dataset=dataset, version=BUNDLE_VERSION, created_at=time.time())
+    path = Path(base_dir).joinpath(BUNDLES[dataset])
+
+    # write next to the bundle and swap it in, so a running registry never reads half a file
+    temporary = path.with_name(path.name + ".tmp")
+    joblib.dump(bundle, temporary)
+    os.replace(temporary, path)
+    return path
+
+
+class ModelRegistry:
+    """
+    Loads the models of every dataset once and shares them across requests.
+    Models are loaded lazily on first use (or eagerly through preload) and
+    reloaded when one of their files changes on disk.
+
+    A dataset is read from its bundle when there is one, with the NumPy arrays
+    memory-mapped read-only (mmap_mode), and from the older per-artefact joblib
+    files otherwise. The models are served in the given precision, see
+    with_precision.
+    """
+
+    def __init__(self, base_dir=BASE_DIR, artefacts=ARTEFACTS, bundles=BUNDLES,
+                 check_interval=1.0, mmap_mode="r", precision=PRECISION):
+        self.base_dir = Path(base_dir)
+        self.artefacts = artefacts
+        self.bundles = bundles
+        self.check_interval = check_interval
+        self.mmap_mode = mmap_mode
+        self.precision = precision
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    def paths(self, dataset):
+        bundle = self.base_dir.joinpath(self.bundles[dataset])
+        if bundle.exists():
+            return {"bundle": bundle}
+        return {
+            name: self.base_dir.joinpath(file_name)
+            for name, file_name in self.artefacts[dataset].items()
+        }
+
+    def exists(self, dataset):
+        return all(path.exists() for path in self.paths(dataset).values())
+
+    def get(self, dataset):
+        entry = self._entries.get(dataset)
+        if entry is not None and not self._is_stale(entry):
+            return entry["models"]
+
+        with self._lock:
+            current = self._entries.get(dataset)
+            if current is not None and current is not entry:
+                # another thread reloaded it while we were waiting
+                return current["models"]
+            try:
+                current = self._load(dataset)
+            except Exception:
+                if entry is None:
+                    raise
+                # a file may still be half written, retry on a later call
+                logger.exception("Reloading %s models failed", dataset)
+                entry["mtimes"] = {}
+                return entry["models"]
+            self._entries[dataset] = current
+        return current["models"]
+
+    def version(self, dataset):
+        '''
+        Token of the models currently served for dataset, which changes every
+        time they are reloaded. None when the dataset has no trained models.
+        '''
+        if dataset not in self._entries and not self.exists(dataset):
+            return None
+        self.get(dataset)
+        return self._entries[dataset]["loaded_at"]
+
+    def stored(self, dataset):
+        '''
+        The models of dataset as stored, read again from disk in full
+        precision and not memory-mapped, e.g. to update and save them.
+        '''
+        return self._read(self.paths(dataset), mmap_mode=None)
+
+    def preload(self):
+        for dataset in self.artefacts:
+            if self.exists(dataset):
+                self.get(dataset)
+        return self
+
+    def stats(self):
+        return {
+            dataset: {
+                "version": entry["models"].get("version"),
+                "precision": self.precision,
+                "loaded_at": entry["loaded_at"],
+                "load_time": entry["load_time"],
+                "memory": entry["memory"],
+                "files": {name: str(path) for name, path in entry["paths"].items()},
+            }
+            for dataset, entry in self._entries.items()
+        }
+
+    def _mtimes(self, paths):
+        return {name: path.stat().st_mtime for name, path in paths.items()}
+
+    def _is_stale(self, entry):
+        now = time.monotonic()
+        if now - entry["checked_at"] < self.check_interval:
+            return False
+        entry["checked_at"] = now
+        try:
+            if self.paths(entry["dataset"]) != entry["paths"]:
+                # a bundle has been written for a dataset served from artefacts
+                return True
+            return self._mtimes(entry["paths"]) != entry["mtimes"]
+        except FileNotFoundError:
+            # keep serving the loaded model while the files are rewritten
+            return False
+
+    def _load(self, dataset):
+        paths = self.paths(dataset)
+        mtimes = self._mtimes(paths)
+
+        tracing = tracemalloc.is_tracing()
+        if not tracing:
+            tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+
+        models = with_precision(self._read(paths, self.mmap_mode), self.precision)
+
+        load_time = time.perf_counter() - start
+        memory = tracemalloc.get_traced_memory()[0] - before
+        if not tracing:
+            tracemalloc.stop()
+
+        logger.info("Loaded %s models in %.3fs (%d bytes)",
+                    dataset, load_time, memory)
+        return {
+            "dataset": dataset,
+            "models": models,
+            "paths": paths,
+            "mtimes": mtimes,
+            "loaded_at": time.time(),
+            "checked_at": time.monotonic(),
+            "load_time": load_time,
+            "memory": memory,
+        }
+
+    def _read(self, paths, mmap_mode):
+        if "bundle" in paths:
+            models = joblib.load(paths["bundle"], mmap_mode=mmap_mode)
+            if models.get("version") != BUNDLE_VERSION:
+                raise ValueError("%s has bundle version %s, expected %s" % (
+                    paths["bundle"], models.get("version"), BUNDLE_VERSION))
+            return models
+        return {name: joblib.load(path) for name, path in paths.items()}
+
+
+def process_memory():
+    '''
+    Memory of the current process in bytes. On Linux this splits the resident
+    set into pages shared with other processes (the gunicorn master and the
+    other workers) and pages private to this one; PSS charges every shared
+    page evenly to the processes mapping it.
+    '''
+    memory = {"pid": os.getpid()}
+    try:
+        with open("/proc/self/smaps_rollup") as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) == 3 and fields[2] == "kB":
+                    memory[fields[0].rstrip(":").lower()] = int(fields[1]) * 1024
+    except OSError:
+        import resource
+
+        # peak resident set, in kilobytes on Linux and bytes on macOS
+        memory["max_rss"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return memory
+
+
+# process-wide registry shared by the model modules and the API
+registry = ModelRegistry()
@@ -0,0 +1,177 @@
+# Licensed under the MIT License - https://opensource.org/licenses/MIT
+
+from sklearn.base import BaseEstimator
+from sklearn.utils.validation import check_X_y, check_array
+
+import numpy as np
+import logging
+
+import consensus
+import fitting
+import metrics
+
+logger = logging.getLogger("pycobra.regressorcobra")
+
+# every machine load_default knows, in the order of the "advanced" machine list:
+# name -> (estimator class, hyperparameters), as in classifiercobra
+MACHINES = {
+    "lasso": ("sklearn.linear_model.LassoLars", dict(alpha=1.0)),
+    "tree": ("sklearn.tree.DecisionTreeRegressor", dict()),
+    "ridge": ("sklearn.linear_model.Ridge", dict(alpha=1.0)),
+    "random_forest": ("sklearn.ensemble.RandomForestRegressor", dict()),
+    "svm": ("sklearn.svm.LinearSVR", dict()),
+    "knn": ("sklearn.neighbors.KNeighborsRegressor", dict()),
+}
+
+BASIC_MACHINES = ["lasso", "tree", "ridge", "random_forest"]
+
+
+def register_machine(name, estimator, **params):
+    """
+    Make a regression machine available to load_default, like
+    classifiercobra.register_machine.
+    """
+    MACHINES[name] = (estimator, params)
+
+
+class RegressorCobra(BaseEstimator, fitting.MachineFitting):
+    """
+    COBRA for real-valued targets. A calibration point is selected for a
+    query when the predictions of exactly M machines on the point are within
+    epsilon of their predictions on the query, and the prediction is the mean
+    of y_l_ over the selected points (0 when there is none).
+
+    The calibration predictions of every machine are kept sorted, so the
+    epsilon ball of a query is a range found by binary search rather than a
+    scan of X_l_. With epsilon=None it is tuned by tune_epsilon when fitting.
+    """
+
+    known_machines = MACHINES
+    basic_machines = BASIC_MACHINES
+
+    def __init__(self, random_state=None, epsilon=None, machine_list="basic", n_jobs=None):
+        self.random_state = random_state
+        self.epsilon = epsilon
+        self.machine_list = machine_list
+        self.n_jobs = n_jobs
+
+    def fit(self, X, y, default=True, X_k=None, X_l=None, y_k=None, y_l=None):
+        X, y = check_X_y(X, y, y_numeric=True)
+        self.X_ = X
+        self.y_ = y
+        self.X_k_ = X_k
+        self.X_l_ = X_l
+        self.y_k_ = y_k
+        self.y_l_ = y_l
+        self.estimators_ = {}
+        self.epsilon_ = self.epsilon
+
+        if default:
+            self.split_data()
+            self.load_default(machine_list=self.machine_list)
+            self.load_machine_predictions()
+            if self.epsilon is None:
+                self.tune_epsilon()
+        return self
+
+    def pred(self, X, M, info=False):
+        query = self._machine_predictions(X)
+        queries, points = self._selection(query, self.epsilon_, M)
+        means, counts = consensus.ball_means(queries, points, self.y_l_, 1)
+
+        if metrics.enabled():
+            metrics.SELECTED_POINTS.observe(counts[0])
+
+        # if no points are selected, return 0
+        if counts[0] == 0:
+            logger.info("No points were selected, prediction is 0")
+            if info:
+                return (0, 0)
+            return 0
+
+        if info:
+            return means[0], points.tolist()
+        return means[0]
+
+    def predict(self, X, M=None, info=False):
+        X = check_array(X)
+
+        if M is None:
+            M = len(self.estimators_)
+
+        # every machine predicts the whole batch once
+        query = self._machine_predictions(X)
+
+        result = np.zeros(len(X))
+        total_points = 0
+        with metrics.timer(metrics.CONSENSUS_SECONDS):
+            for start, stop in consensus.query_blocks(len(X), len(self.y_l_)):
+                queries, points = self._selection(query[:, start:stop], self.epsilon_, M)
+                result[start:stop], counts = consensus.ball_means(
+                    queries, points, self.y_l_, stop - start)
+                total_points += counts.sum()
+                if metrics.enabled():
+                    metrics.SELECTED_POINTS.observe_many(counts)
+
+        if info:
+            avg_points = total_points / len(X)
+            return result, avg_points
+        return result
+
+    def tune_epsilon(self, epsilons=None, grid_points=50, M=None):
+        """
+        Pick epsilon_ among epsilons by the mean squared error of leave-one-out
+        predictions over the calibration set: every calibration point is
+        predicted from the others. The machines are not refitted and predict
+        nothing new, every epsilon only reruns the range queries on the sorted
+        calibration predictions.
+
+        epsilons defaults to grid_points values from the smallest positive gap
+        between values of y_l_ to their range, like pycobra's set_epsilon. The
+        grid and its errors are kept in epsilon_grid_ and epsilon_scores_.
+        """
+        if M is None:
+            M = len(self.estimators_)
+        if epsilons is None:
+            values = np.unique(self.y_l_)
+            gaps = np.diff(values)
+            low = gaps[gaps > 0].min() if (gaps > 0).any() else 0.0
+            epsilons = np.linspace(low, values[-1] - values[0], grid_points)
+        epsilons = np.asarray(epsilons, dtype=np.float64)
+
+        n_points = len(self.y_l_)
+        scores = np.zeros(len(epsilons))
+        for i, epsilon in enumerate(epsilons):
+            for start, stop in consensus.query_blocks(n_points, n_points):
+                queries, points = self._selection(
+                    self.machine_predictions_[:, start:stop], epsilon, M,
+                    exclude=np.arange(start, stop))
+                means, _ = consensus.ball_means(queries, points, self.y_l_, stop - start)
+                scores[i] += ((means - self.y_l_[start:stop]) ** 2).sum()
+        scores /= n_points
+
+        self.epsilon_grid_ = epsilons
+        self.epsilon_scores_ = scores
+        self.epsilon_ = float(epsilons[np.argmin(scores)])
+        logger.debug("Tuned epsilon to %g", self.epsilon_)
+        return self
+
+    def _selection(self, query, epsilon, M, exclude=None):
+        lo, hi = consensus.epsilon_ranges(self.sorted_index_, query, epsilon)
+        return consensus.ball_selection(self.sorted_index_, lo, hi, M, exclude=exclude)
+
+    def _machine_predictions(self, X):
+        predictions = []
+        for machine in self.estimators_:
+            with metrics.timer(metrics.MACHINE_SECONDS, machine=machine):
+                predictions.append(self.estimators_[machine].predict(X))
+        return consensus.stack_predictions(predictions).reshape(
+            len(self.estimators_), len(X)).astype(np.float64)
+
+    def load_machine_predictions(self, predictions=None):
+        # one row per machine, in the order of estimators_
+        self.machine_predictions_ = self._calibration_predictions(predictions).astype(np.float64)
+        self.y_l_ = np.asarray(self.y_l_, dtype=np.float64)
+        # sort the predictions of every machine for the epsilon range queries
+        self.sorted_index_ = consensus.build_sorted_index(self.machine_predictions_)
+        return self
@@ -0,0 +1,130 @@
+# Score large files of loan applications offline, chunk by chunk.
+#
+#   python score.py australian data/australian.dat predictions.csv
+#   python score.py german data/german.csv - --chunksize 50000 --jobs 4
+#
+# Files are read in the formats of data/: whitespace separated without a
+# header (.dat, the first 14 columns are the Australian attributes) or CSV
+# with a header row. Only one chunk per worker (plus a small read-ahead) is in
+# memory at a time and predictions are written in input order as soon as
+# their chunk is scored.
+
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque
+import argparse
+import logging
+import sys
+import time
+
+import pandas as pd
+
+from registry import registry
+
+logger = logging.getLogger("cobra.score")
+
+AUSTRALIAN_COLUMNS = ["X%d" % i for i in range(1, 15)]
+
+GERMAN_COLUMNS = [
+    "employ",
+    "age",
+    "amount",
+    "duration",
+    "checkingstatus",
+    "history",
+    "purpose",
+    "savings",
+    "status",
+]
+
+
+def read_chunks(path, chunksize):
+    source = sys.stdin if path == "-" else path
+    if str(path).endswith(".dat"):
+        return pd.read_csv(source, sep=r"\s+", header=None, chunksize=chunksize)
+    return pd.read_csv(source, chunksize=chunksize)
+
+
+def score_chunk(dataset, chunk):
+    # imported here so that every worker process resolves the models through its own registry
+    if dataset == "australian":
+        from model_australian import predict_australian
+
+        loan_details = chunk.iloc[:, :len(AUSTRALIAN_COLUMNS)]
+        loan_details.columns = AUSTRALIAN_COLUMNS
+        prediction = predict_australian(loan_details)
+    else:
+        from model_german import predict_german
+
+        prediction = predict_german(chunk[GERMAN_COLUMNS])["Predicted Status"]
+    return pd.DataFrame({"prediction": prediction}, dtype=int)
+
+
+def load_models(dataset):
+    # train before forking workers, so they do not all train at once
+    if not registry.exists(dataset):
+        if dataset == "australian":
+            from model_australian import train
+        else:
+            from model_german import train
+        train()
+    registry.get(dataset)
+
+
+def score_file(dataset, input_path, output, chunksize=100000, jobs=1):
+    '''
+    Score every row of input_path and write one prediction per row to output
+    (a file object), in input order. With jobs > 1 chunks are scored by a pool
+    of processes; models loaded before forking are shared by the workers.
+    Returns the number of rows scored.
+    '''
+    load_models(dataset)
+    chunks = read_chunks(input_path, chunksize)
+
+    n_rows = 0
+    start = time.perf_counter()
+
+    def write(scored):
+        nonlocal n_rows
+        scored.to_csv(output, header=n_rows == 0, index=False)
+        n_rows += len(scored)
+        logger.info("%d rows scored (%.0f rows/s)", n_rows, n_rows / (time.perf_counter() - start))
+
+    if jobs <= 1:
+        for chunk in chunks:
+            write(score_chunk(dataset, chunk))
+        return n_rows
+
+    # keep at most two chunks per worker in flight, so memory stays bounded
+    # however large the file is
+    pending = deque()
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        for chunk in chunks:
+            pending.append(pool.submit(score_chunk, dataset, chunk))
+            if len(pending) >= 2 * jobs:
+                write(pending.popleft().result())
+        while pending:
+            write(pending.popleft().result())
+    return n_rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Score a file of loan applications with COBRA.")
+    parser.add_argument("dataset", choices=["australian", "german"])
+    parser.add_argument("input", help="CSV or .dat file, - for stdin (read as CSV)")
+    parser.add_argument("output", help="CSV file for the predictions, - for stdout")
+    parser.add_argument("--chunksize", type=int, default=100000, help="rows read and scored at a time")
+    parser.add_argument("--jobs", type=int, default=1, help="worker processes")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(message)s")
+
+    if args.output == "-":
+        n_rows = score_file(args.dataset, args.input, sys.stdout, args.chunksize, args.jobs)
+    else:
+        with open(args.output, "w", newline="") as output:
+            n_rows = score_file(args.dataset, args.input, output, args.chunksize, args.jobs)
+    logger.info("Wrote %d predictions", n_rows)
+
+
+if __name__ == "__main__":
+    main()
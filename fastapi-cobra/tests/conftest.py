@@ -0,0 +1,35 @@
+import functools
+import sys
+from pathlib import Path
+
+import pytest
+
+# the modules of the app are imported flat, as main.py does
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+
+@pytest.fixture(scope="session")
+def trained(tmp_path_factory):
+    '''
+    Both datasets trained into a temporary directory and served from it, so
+    that the tests neither read nor write the artefacts of the app directory.
+    '''
+    import ingest
+    import main
+    import model_australian
+    import model_german
+    import registry
+
+    base_dir = tmp_path_factory.mktemp("models")
+    models = registry.ModelRegistry(base_dir=base_dir)
+    save_bundle = functools.partial(registry.save_bundle, base_dir=base_dir)
+
+    with pytest.MonkeyPatch.context() as patch:
+        patch.setattr(ingest, "CACHE_DIR", base_dir.joinpath("cache"))
+        for module in (model_australian, model_german, main):
+            patch.setattr(module, "registry", models)
+        for module in (model_australian, model_german):
+            patch.setattr(module, "save_bundle", save_bundle)
+        model_australian.train()
+        model_german.train()
+        yield models
@@ -0,0 +1,72 @@
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+
+GERMAN = dict(employ="A72", age=40, amount=8951, duration=24, checkingstatus="A12",
+              history="A32", purpose="A43", savings="A61", status="A92")
+
+AUSTRALIAN = dict(zip(["param%d" % i for i in range(1, 15)],
+                      [0, 21.67, 11.5, 1, 5, 3, 0, 1, 1, 11, 1, 2, 0, 1]))
+
+
+@pytest.fixture
+def client(trained):
+    return TestClient(main.app)
+
+
+def test_predictions(client):
+    assert client.post("/predict_australian", json=AUSTRALIAN).json() in (0, 1)
+    batch = client.post("/predict_german/batch", json=[GERMAN, GERMAN]).json()
+    assert len(batch) == 2 and set(batch) <= {0.0, 1.0}
+    assert '"Predicted Status"' in client.post("/predict_german", json=GERMAN).json()
+
+
+def test_unknown_employ_category_is_refused(client):
+    response = client.post("/predict_german", json=dict(GERMAN, employ="A99"))
+    assert response.status_code == 422
+
+    response = client.post("/predict_german/batch", json=[GERMAN, dict(GERMAN, employ="A99")])
+    assert response.status_code == 422
+    assert response.json()["detail"][0]["record"] == 1
+
+
+def test_model_errors_are_400(client, monkeypatch):
+    def fail(*args):
+        raise ValueError("Unknown category 'A99' for employ in record 1")
+
+    monkeypatch.setattr(main, "predict_helper_german", fail)
+    monkeypatch.setattr(main, "predict_batch_german", fail)
+    for path, body in [("/predict_german", GERMAN), ("/predict_german/batch", [GERMAN])]:
+        response = client.post(path, json=body)
+        assert response.status_code == 400
+        assert "record 1" in response.json()["detail"]
+
+
+@pytest.mark.parametrize("content_type", ["text/csv", "application/x-ndjson", "application/json"])
+def test_batch_that_is_not_utf8_is_400(client, content_type):
+    response = client.post("/predict_german/batch", content="employ\nA72\xe9".encode("latin-1"),
+                           headers={"content-type": content_type})
+    assert response.status_code == 400
+
+
+@pytest.mark.parametrize("path, body", [("/predict_australian_proba", AUSTRALIAN), ("/predict_german_proba", GERMAN)])
+@pytest.mark.parametrize("params", [{}, {"kernel": "gaussian", "metric": "hamming", "bandwidth": 0.5}])
+def test_probabilities(client, path, body, params):
+    response = client.post(path, json=body, params=params)
+    assert response.status_code == 200
+    probabilities = response.json()
+    assert len(probabilities) == 2
+    assert sum(probabilities.values()) == pytest.approx(1)
+
+
+@pytest.mark.parametrize("path, body", [("/predict_australian_proba", AUSTRALIAN), ("/predict_german_proba", GERMAN)])
+@pytest.mark.parametrize("params, message", [
+    ({"kernel": "gaussian", "bandwidth": 0}, "bandwidth must be positive"),
+    ({"kernel": "uniform", "bandwidth": -1}, "bandwidth must be positive"),
+    ({"kernel": "cosine"}, "Unknown kernel"),
+])
+def test_probability_options_are_400(client, path, body, params, message):
+    response = client.post(path, json=body, params=params)
+    assert response.status_code == 400
+    assert message in response.json()["detail"]
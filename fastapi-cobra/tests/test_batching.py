@@ -0,0 +1,34 @@
+import asyncio
+
+from batching import MicroBatcher
+
+
+def double_all(records):
+    if "bad" in records:
+        raise ValueError("bad record")
+    return [2 * record for record in records]
+
+
+def test_results_in_order():
+    async def run():
+        batcher = MicroBatcher(double_all, max_batch_size=4, max_wait=0.01)
+        results = await asyncio.gather(*(batcher.submit(i) for i in range(10)))
+        await asyncio.sleep(0)
+        return batcher, results
+
+    batcher, results = asyncio.run(run())
+    assert results == [2 * i for i in range(10)]
+    # finished batches are not kept around
+    assert not batcher._tasks
+
+
+def test_bad_record_only_fails_its_request():
+    async def run():
+        batcher = MicroBatcher(double_all, max_batch_size=8, max_wait=0.01)
+        return await asyncio.gather(
+            batcher.submit(1), batcher.submit("bad"), batcher.submit(3),
+            return_exceptions=True)
+
+    good, bad, other = asyncio.run(run())
+    assert (good, other) == (2, 6)
+    assert isinstance(bad, ValueError)
@@ -0,0 +1,24 @@
+from cache import PredictionCache, request_digest
+
+
+def test_hit_and_version_invalidation():
+    cache = PredictionCache(max_size=10)
+    digest = request_digest({"a": 1, "b": 2})
+    assert digest == request_digest({"b": 2, "a": 1})
+
+    cache.put("german", 1, digest, "x")
+    assert cache.get("german", 1, digest) == (True, "x")
+    # models reloaded: the entries of the old version are dropped
+    assert cache.get("german", 2, digest) == (False, None)
+
+
+def test_stale_put_is_skipped():
+    versions = {"german": 2}
+    cache = PredictionCache(max_size=1, current_version=versions.get)
+    cache.put("german", 2, "fresh", "new")
+
+    # a request that started before the reload to version 2 finishes late
+    cache.put("german", 1, "stale", "old")
+    assert cache.get("german", 2, "fresh") == (True, "new")
+    assert cache.get("german", 2, "stale") == (False, None)
+    assert cache.stats()["invalidations"] == 0
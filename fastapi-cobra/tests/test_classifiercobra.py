@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+from sklearn.datasets import make_classification
+
+from classifiercobra import ClassifierCobra
+
+
+def loop_pred(cobra, x, M):
+    # the original pred: the points on which exactly M machines agree with
+    # the query, and the majority class of y_l_ over them (0 for none)
+    select = {}
+    for machine in cobra.estimators_:
+        label = cobra.estimators_[machine].predict(x)
+        calibration = cobra.estimators_[machine].predict(cobra.X_l_)
+        select[machine] = {count for count in range(len(cobra.X_l_)) if calibration[count] == label}
+
+    points = [count for count in range(len(cobra.X_l_))
+              if sum(count in select[machine] for machine in select) == M]
+    if not points:
+        return 0, []
+
+    classes = {label: 0 for label in np.unique(cobra.y_l_)}
+    for point in points:
+        classes[cobra.y_l_[point]] += 1
+    return int(max(classes, key=classes.get)), points
+
+
+@pytest.fixture(scope="module", params=[2, 3])
+def data(request):
+    X, y = make_classification(
+        n_samples=260, n_features=6, n_informative=4, n_classes=request.param, random_state=0)
+    return X[:200], y[:200], X[200:]
+
+
+@pytest.fixture(scope="module")
+def cobra(data):
+    X, y, _ = data
+    return ClassifierCobra(random_state=0).fit(X, y)
+
+
+def test_predict_matches_loop(cobra, data):
+    _, _, X_test = data
+    for M in range(1, len(cobra.estimators_) + 1):
+        expected = [loop_pred(cobra, x.reshape(1, -1), M) for x in X_test]
+        result, avg_points = cobra.predict(X_test, M=M, info=True)
+        assert result.tolist() == [label for label, _ in expected]
+        assert avg_points == np.mean([len(points) for _, points in expected])
+
+        for x, (label, points) in list(zip(X_test, expected))[:5]:
+            assert cobra.pred(x.reshape(1, -1), M) == label
+            assert cobra.pred(x.reshape(1, -1), M, info=True) == ((label, points) if points else (0, 0))
+
+
+def test_compact_and_export_keep_predictions(cobra, data):
+    _, _, X_test = data
+    expected = {M: cobra.predict(X_test, M=M) for M in range(1, len(cobra.estimators_) + 1)}
+    proba = cobra.predict_proba(X_test)
+
+    compiled = cobra.export()
+    compact = ClassifierCobra(random_state=0).fit(*data[:2]).compact()
+    for M, labels in expected.items():
+        assert (compact.predict(X_test, M=M) == labels).all()
+        assert (compiled.predict(X_test, M=M) == labels).all()
+    np.testing.assert_allclose(compact.predict_proba(X_test), proba)
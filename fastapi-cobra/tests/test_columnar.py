@@ -0,0 +1,132 @@
+from typing import Literal
+
+import msgpack
+import numpy as np
+import pyarrow as pa
+import pytest
+from fastapi.testclient import TestClient
+
+import columnar
+import main
+
+GERMAN_FIELDS = ["employ", "age", "amount", "duration", "checkingstatus",
+                 "history", "purpose", "savings", "status"]
+
+GERMAN_ROWS = [
+    ["A72", 40, 8951, 24, "A12", "A32", "A43", "A61", "A92"],
+    ["A73", 53, 4870, 24, "A11", "A33", "A40", "A61", "A93"],
+    ["A75", 22, 1200, 12, "A14", "A34", "A43", "A65", "A93"],
+]
+
+AUSTRALIAN_ROWS = [
+    [0, 21.67, 11.5, 1, 5, 3, 0, 1, 1, 11, 1, 2, 0, 1],
+    [1, 22.08, 11.46, 2, 4, 4, 1.585, 0, 0, 0, 1, 2, 100, 1213],
+]
+
+
+def columns_of(fields, rows):
+    return {name: [row[i] for row in rows] for i, name in enumerate(fields)}
+
+
+def arrow_payload(columns):
+    table = pa.table(columns)
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def read_arrow(payload):
+    return pa.ipc.open_stream(payload).read_all()
+
+
+@pytest.fixture
+def client(trained):
+    return TestClient(main.app)
+
+
+@pytest.mark.parametrize("path, fields, rows, name", [
+    ("/predict_german/batch", GERMAN_FIELDS, GERMAN_ROWS, "Predicted Status"),
+    ("/predict_australian/batch", ["param%d" % i for i in range(1, 15)], AUSTRALIAN_ROWS, "prediction"),
+])
+def test_round_trips_match_json(client, path, fields, rows, name):
+    expected = client.post(path, json=[dict(zip(fields, row)) for row in rows]).json()
+    columns = columns_of(fields, rows)
+
+    response = client.post(path, content=arrow_payload(columns),
+                           headers={"content-type": columnar.ARROW})
+    assert response.headers["content-type"] == columnar.ARROW
+    table = read_arrow(response.content)
+    assert table.column_names == [name]
+    assert pa.types.is_floating(table.schema.field(name).type)
+    assert table.column(name).to_pylist() == expected
+
+    response = client.post(path, content=msgpack.packb(columns),
+                           headers={"content-type": columnar.MSGPACK})
+    assert response.headers["content-type"] == columnar.MSGPACK
+    assert msgpack.unpackb(response.content) == {name: expected}
+
+    # JSON in, Arrow out, and the other way round
+    response = client.post(path, json=[dict(zip(fields, row)) for row in rows],
+                           headers={"accept": columnar.ARROW})
+    assert read_arrow(response.content).column(name).to_pylist() == expected
+    response = client.post(path, content=arrow_payload(columns),
+                           headers={"content-type": columnar.ARROW, "accept": "application/json"})
+    assert response.json() == expected
+
+
+def test_invalid_columns_are_422(client):
+    columns = columns_of(GERMAN_FIELDS, GERMAN_ROWS)
+    response = client.post("/predict_german/batch", content=msgpack.packb(dict(columns, age=[40, "x", 22])),
+                           headers={"content-type": columnar.MSGPACK})
+    assert response.status_code == 422
+    assert response.json()["detail"] == [
+        {"column": "age", "msg": "value is not a valid integer", "record": 1}]
+
+    response = client.post("/predict_german/batch", content=arrow_payload(dict(columns, employ=["A72", "A73", "A99"])),
+                           headers={"content-type": columnar.ARROW})
+    assert response.status_code == 422
+    assert response.json()["detail"][0]["record"] == 2
+
+    response = client.post("/predict_german/batch", content=b"not arrow",
+                           headers={"content-type": columnar.ARROW})
+    assert response.status_code == 400
+
+
+FIELDS = [("a", int), ("b", float), ("c", str), ("d", Literal["x", "y"])]
+
+
+def test_validate_coerces_like_pydantic():
+    a, b, c, d = columnar.validate({
+        "a": np.array(["1", "2"]), "b": np.array([1, 2]), "c": np.array([3, 4]), "d": np.array(["x", "y"]),
+    }, FIELDS)
+    assert a.dtype == np.int64 and a.tolist() == [1, 2]
+    assert b.dtype == np.float64 and b.tolist() == [1.0, 2.0]
+    assert c.tolist() == ["3", "4"]
+    assert d.tolist() == ["x", "y"]
+
+
+@pytest.mark.parametrize("columns, error", [
+    ({"a": [1, None], "b": [1.0, 2.0], "c": ["p", "q"], "d": ["x", "x"]},
+     {"column": "a", "msg": "none is not an allowed value", "record": 1}),
+    ({"a": [1, 2], "b": [1.0, float("nan")], "c": ["p", "q"], "d": ["x", "x"]},
+     {"column": "b", "msg": "value is not a finite number", "record": 1}),
+    ({"a": [1, 2], "b": [1.0, 2.0], "d": ["x", "x"]},
+     {"column": "c", "msg": "field required"}),
+    ({"a": [1, 2], "b": [1.0, 2.0], "c": ["p", "q"], "d": ["z", "x"]},
+     {"column": "d", "msg": "unexpected value; permitted: 'x', 'y'", "record": 0}),
+    ({"a": [1, 2], "b": [1.0], "c": ["p", "q"], "d": ["x", "x"]},
+     {"column": None, "msg": "columns must have the same length"}),
+])
+def test_validate_errors(columns, error):
+    payload = msgpack.packb(columns)
+    with pytest.raises(columnar.ColumnError) as e:
+        columnar.validate(columnar.read_columns(payload, columnar.MSGPACK), FIELDS)
+    assert e.value.detail() == error
+
+
+def test_arrow_nulls_are_refused():
+    payload = arrow_payload({"a": pa.array([1, None], pa.int64()), "b": [1.0, 2.0],
+                             "c": ["p", "q"], "d": ["x", "y"]})
+    with pytest.raises(columnar.ColumnError, match="none is not an allowed value"):
+        columnar.validate(columnar.read_columns(payload, columnar.ARROW), FIELDS)
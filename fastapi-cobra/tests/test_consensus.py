@@ -0,0 +1,189 @@
+import numpy as np
+import pytest
+
+import consensus
+from classifiercobra import ClassifierCobra
+
+
+class Binned:
+    # a machine predicting the bin of one feature, so that a test picks the
+    # labels the machines agree on
+    def __init__(self, column, width=1.0):
+        self.column = column
+        self.width = width
+
+    def predict(self, X):
+        return np.floor(X[:, self.column] / self.width)
+
+    def predict_proba(self, X):
+        return X[:, [self.column]]
+
+
+MACHINES = [Binned(0), Binned(1), Binned(2, width=2.0), Binned(3)]
+
+
+def make_data(n_points, n_classes, seed, high=6):
+    rng = np.random.RandomState(seed)
+    return rng.randint(0, high, size=(n_points, 4)).astype(np.float64), rng.randint(0, n_classes, size=n_points)
+
+
+def make_cobra(X_l, y_l):
+    cobra = ClassifierCobra().fit(X_l, y_l, default=False, X_l=X_l, y_l=y_l)
+    for i, machine in enumerate(MACHINES):
+        cobra.load_machine("machine_%d" % i, machine)
+    cobra.load_machine_predictions()
+    cobra.load_machine_proba_predictions()
+    return cobra
+
+
+def labels(X):
+    return np.array([machine.predict(X) for machine in MACHINES])
+
+
+def scan_votes(calibration, query, y_l, classes, M):
+    # the original pred, one query at a time: the points on which exactly M
+    # machines agree with the query vote for their class
+    votes = np.zeros((query.shape[1], len(classes)), dtype=np.int64)
+    for q in range(query.shape[1]):
+        for point in range(calibration.shape[1]):
+            agree = sum(calibration[m, point] == query[m, q] for m in range(len(calibration)))
+            if agree == M:
+                votes[q, list(classes).index(y_l[point])] += 1
+    return votes
+
+
+def scan_predict(votes, classes):
+    # the majority class, the smallest on ties, and 0 without any point
+    return np.array([classes[np.argmax(row)] if row.sum() else 0 for row in votes], dtype=np.float64)
+
+
+@pytest.mark.parametrize("n_bits", [1, 8, 63, 64, 65, 130])
+def test_pack_bits_matches_unpackbits(n_bits):
+    bits = np.random.RandomState(n_bits).rand(3, 2, n_bits) < 0.5
+    packed = consensus.pack_bits(bits)
+    assert packed.dtype == np.uint64 and packed.shape == (3, 2, -(-n_bits // 64))
+    unpacked = np.unpackbits(packed.view(np.uint8), axis=-1)
+    assert (unpacked[..., :n_bits] == bits).all()
+    assert not unpacked[..., n_bits:].any()
+
+
+@pytest.mark.parametrize("native", [True, False])
+def test_popcount_counts_bits(monkeypatch, native):
+    if not native:
+        monkeypatch.delattr(np, "bitwise_count", raising=False)
+    rng = np.random.RandomState(0)
+    words = rng.randint(0, 1 << 62, size=200, dtype=np.int64).astype(np.uint64) * np.uint64(3)
+    words[:3] = [0, np.iinfo(np.uint64).max, 1 << 63]
+    assert consensus.popcount(words).tolist() == [bin(int(word)).count("1") for word in words]
+
+
+def test_vote_masks_slice_votes():
+    votes = np.random.RandomState(0).randint(0, 40, size=(150, 3))
+    masks = consensus.vote_masks(votes)
+    bits = np.unpackbits(masks.view(np.uint8), axis=-1)[..., :len(votes)].astype(np.int64)
+    assert (np.einsum("cbs,b->sc", bits, 1 << np.arange(masks.shape[1])) == votes).all()
+
+
+def test_agreement_planes_count_agreements():
+    X_l, y_l = make_data(150, 3, seed=0)
+    index = consensus.build_signature_index(labels(X_l), np.unique(y_l, return_inverse=True)[1], 3)
+    X, _ = make_data(30, 3, seed=1, high=7)
+    query_codes = consensus.encode_machine_labels(labels(X), index["labels"])
+
+    planes = consensus.agreement_planes(index, query_codes)
+    bits = np.unpackbits(planes.view(np.uint8), axis=-1)[..., :len(index["signatures"])].astype(np.int64)
+    counts = np.einsum("pqs,p->qs", bits, 1 << np.arange(len(planes)))
+    assert (counts == consensus.agreement_counts(query_codes, index["signatures"].T)).all()
+
+
+@pytest.mark.parametrize("n_classes", [2, 3])
+def test_indexed_votes_match_scan(n_classes):
+    X_l, y_l = make_data(150, n_classes, seed=0)
+    classes, y_codes = np.unique(y_l, return_inverse=True)
+    index = consensus.build_signature_index(labels(X_l), y_codes, n_classes)
+    # values of 6 give labels never seen in calibration
+    X, _ = make_data(40, n_classes, seed=1, high=7)
+    query_codes = consensus.encode_machine_labels(labels(X), index["labels"])
+
+    for M in range(len(MACHINES) + 1):
+        expected = scan_votes(labels(X_l), labels(X), y_l, classes, M)
+        assert (consensus.indexed_votes(index, query_codes, M) == expected).all()
+        assert (consensus.planes_votes(index, consensus.agreement_planes(index, query_codes), M) == expected).all()
+
+
+@pytest.mark.parametrize("n_classes", [2, 3])
+def test_predict_matches_scan(n_classes):
+    X_l, y_l = make_data(150, n_classes, seed=0)
+    cobra = make_cobra(X_l, y_l)
+    X, _ = make_data(40, n_classes, seed=1, high=7)
+    sweep = cobra.predict_sweep(X, range(len(MACHINES) + 1))
+
+    for M in range(len(MACHINES) + 1):
+        expected = scan_predict(scan_votes(labels(X_l), labels(X), y_l, cobra.classes_l_, M), cobra.classes_l_)
+        assert (cobra.predict(X, M=M) == expected).all()
+        assert (sweep[M] == expected).all()
+        assert [cobra.pred(X[i:i + 1], M) for i in range(5)] == expected[:5].tolist()
+
+
+def test_update_signature_index_matches_rebuild():
+    X_l, y_l = make_data(150, 3, seed=0)
+    X, y = make_data(100, 3, seed=1)
+    index = consensus.build_signature_index(labels(X_l), y_l, 3)
+
+    def codes(X):
+        return consensus.encode_machine_labels(labels(X), index["labels"])
+
+    updated = consensus.update_signature_index(index, codes(X), y, codes(X_l[:40]), y_l[:40])
+    rebuilt = consensus.build_signature_index(
+        labels(np.vstack([X_l[40:], X])), np.concatenate([y_l[40:], y]), 3)
+    # the same labels, so signatures of both are codes into the same vocabulary
+    assert (rebuilt["labels"] == index["labels"]).all()
+
+    votes = {key: updated["votes"][row] for key, row in updated["lookup"].items()}
+    for key, row in rebuilt["lookup"].items():
+        assert (votes.pop(key) == rebuilt["votes"][row]).all()
+    # signatures whose points were all removed are kept without votes
+    assert not any(v.any() for v in votes.values())
+
+    query_codes = codes(make_data(40, 3, seed=2, high=7)[0])
+    for M in range(len(MACHINES) + 1):
+        assert (consensus.indexed_votes(updated, query_codes, M)
+                == consensus.indexed_votes(rebuilt, query_codes, M)).all()
+    # the given index is left as it is
+    assert len(index["lookup"]) == len(index["signatures"]) < len(updated["signatures"])
+
+
+@pytest.mark.parametrize("compacted", [False, True])
+@pytest.mark.parametrize("max_points, unseen", [(None, False), (180, False), (None, True), (180, True)])
+def test_add_calibration_matches_scan(compacted, max_points, unseen):
+    X_l, y_l = make_data(150, 2, seed=0)
+    cobra = make_cobra(X_l, y_l)
+    if compacted:
+        cobra.compact()
+
+    X, y = make_data(60, 2, seed=1)
+    if unseen:
+        # a label no machine predicted on the calibration set, and a new class
+        X[0, 0] = 9
+        y[1] = 2
+    cobra.add_calibration(X[:30], y[:30], max_points=max_points)
+    cobra.add_calibration(X[30:], y[30:], max_points=max_points)
+
+    X_all, y_all = np.vstack([X_l, X]), np.concatenate([y_l, y])
+    if max_points is not None:
+        X_all, y_all = X_all[-max_points:], y_all[-max_points:]
+    assert (cobra.y_l_ == y_all).all()
+    assert cobra.classes_l_.tolist() == np.unique(y_all).tolist()
+    assert (getattr(cobra, "machine_labels_", None) is not None) == compacted
+
+    X_test, _ = make_data(40, 2, seed=2, high=10)
+    for M in range(len(MACHINES) + 1):
+        expected = scan_predict(
+            scan_votes(labels(X_all), labels(X_test), y_all, cobra.classes_l_, M), cobra.classes_l_)
+        assert (cobra.predict(X_test, M=M) == expected).all()
+
+
+@pytest.mark.parametrize("bandwidth", [0, -1.0, float("nan")])
+def test_kernel_weights_refuse_bandwidth_not_positive(bandwidth):
+    with pytest.raises(ValueError, match="bandwidth must be positive"):
+        consensus.kernel_weights(np.ones((2, 3)), "gaussian", bandwidth)
@@ -0,0 +1,69 @@
+import shutil
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import ingest
+
+
+def memory_mapped(array):
+    while isinstance(array, np.ndarray):
+        if isinstance(array, np.memmap):
+            return True
+        array = array.base
+    return False
+
+
+@pytest.fixture
+def german_csv(tmp_path):
+    path = tmp_path / "german.csv"
+    shutil.copy(ingest.SOURCES["german"], path)
+    return path
+
+
+@pytest.mark.parametrize("dataset", ["australian", "german"])
+def test_cached_columns_match_a_fresh_parse(dataset, tmp_path, monkeypatch):
+    features, target, categorical = ingest.PARSERS[dataset](ingest.SOURCES[dataset])
+    ingest.load(dataset, cache_dir=tmp_path)
+
+    # the second load reads the cache only
+    def fail(path):
+        raise AssertionError("parsed again")
+
+    monkeypatch.setitem(ingest.PARSERS, dataset, fail)
+    data = ingest.load(dataset, cache_dir=tmp_path)
+
+    assert memory_mapped(data.features.values)
+    assert not data.features.values.flags.writeable
+    assert list(data.features.columns) == list(features.columns)
+    np.testing.assert_array_equal(data.features.values, features.to_numpy(dtype=np.float64))
+    np.testing.assert_array_equal(data.target, target.to_numpy())
+    assert list(data.categorical.columns) == list(categorical.columns)
+    for column in categorical.columns:
+        np.testing.assert_array_equal(data.categorical[column].astype(str), categorical[column].astype(str))
+
+
+def test_german_encodings():
+    features, _, categorical = ingest.parse_german(ingest.SOURCES["german"])
+    # the ordinal and binary columns are mapped, not turned into dummies
+    assert features["employ"].dtype == np.int64 and set(features["employ"]) <= {1, 2, 3, 4, 5}
+    assert features["foreign"].dtype == np.int64 and set(features["foreign"]) <= {0, 1}
+    assert "employ_A71" not in features.columns
+    assert "checkingstatus_A11" in features.columns
+    assert {"employ", "foreign", "checkingstatus", "housing"} <= set(categorical.columns)
+    assert "age" not in categorical.columns
+
+
+def test_key_follows_the_content(german_csv, tmp_path):
+    cache_dir = tmp_path / "cache"
+    before = ingest.load("german", german_csv, cache_dir=cache_dir)
+
+    df = pd.read_csv(german_csv)
+    df.loc[0, "age"] += 1
+    df.to_csv(german_csv, index=False)
+    after = ingest.load("german", german_csv, cache_dir=cache_dir)
+
+    assert after.digest != before.digest
+    assert len(list(cache_dir.iterdir())) == 2
+    assert after.features["age"].iloc[0] == before.features["age"].iloc[0] + 1
@@ -0,0 +1,63 @@
+import json
+
+import numpy as np
+import pytest
+
+import classifiercobra
+import fitting
+from classifiercobra import ClassifierCobra
+
+
+@pytest.fixture
+def machines():
+    # registrations of a test do not leak into the others
+    saved = dict(classifiercobra.MACHINES)
+    yield classifiercobra.MACHINES
+    classifiercobra.MACHINES.clear()
+    classifiercobra.MACHINES.update(saved)
+
+
+def write_config(tmp_path, config):
+    path = tmp_path / "machines.json"
+    path.write_text(json.dumps(config))
+    return path
+
+
+def test_params_of_known_machine_are_updated(tmp_path, machines):
+    classifiercobra.load_machine_config(write_config(tmp_path, {"knn": {"params": {"n_neighbors": 5}}}))
+    estimator, params = machines["knn"]
+    assert estimator == "sklearn.neighbors.KNeighborsClassifier"
+    assert params == {"n_neighbors": 5, "weights": "uniform"}
+
+
+def test_new_machine_is_registered(tmp_path, machines):
+    classifiercobra.load_machine_config(write_config(
+        tmp_path, {"extra": {"estimator": "sklearn.tree.ExtraTreeClassifier", "params": {"max_depth": 3}}}))
+    assert fitting.make_machine("extra", machines).max_depth == 3
+
+
+def test_new_machine_without_estimator_is_refused(tmp_path, machines):
+    with pytest.raises(ValueError, match="unknown_machine"):
+        classifiercobra.load_machine_config(write_config(tmp_path, {"unknown_machine": {"params": {}}}))
+    assert "unknown_machine" not in machines
+
+
+class Majority:
+    # a machine without sklearn's get_params, predicting the majority class
+    def fit(self, X, y):
+        values, counts = np.unique(y, return_counts=True)
+        self.label = values[np.argmax(counts)]
+        return self
+
+    def predict(self, X):
+        return np.full(len(X), self.label)
+
+
+def test_machine_from_plain_factory_is_fitted(machines):
+    classifiercobra.register_machine("majority", lambda: Majority())
+    X = np.arange(40, dtype=np.float64).reshape(20, 2)
+    y = np.array([0] * 12 + [1] * 8)
+    cobra = ClassifierCobra(random_state=0).fit(X, y, default=False, X_k=X, y_k=y)
+    cobra.load_default(machine_list=["majority"])
+    assert list(cobra.estimators_) == ["majority"]
+    assert cobra.estimators_["majority"].label == 0
@@ -0,0 +1,100 @@
+import numpy as np
+import pytest
+from sklearn.datasets import make_classification
+from sklearn.ensemble import ExtraTreesClassifier, GradientBoostingClassifier, RandomForestClassifier
+from sklearn.linear_model import LogisticRegression
+from sklearn.naive_bayes import GaussianNB
+from sklearn.neighbors import KNeighborsClassifier
+from sklearn.neural_network import MLPClassifier
+from sklearn.svm import SVC
+from sklearn.tree import DecisionTreeClassifier, ExtraTreeClassifier
+
+import classifiercobra
+import machinebank
+
+MACHINES = {
+    "logreg": lambda: LogisticRegression(C=0.5),
+    "logreg_liblinear": lambda: LogisticRegression(solver="liblinear"),
+    "svm": lambda: SVC(C=0.01, kernel="linear"),
+    "mlp_tanh": lambda: MLPClassifier(max_iter=200, activation="tanh", random_state=0),
+    "mlp_relu": lambda: MLPClassifier(hidden_layer_sizes=(8, 4), max_iter=200, random_state=0),
+    "naive_bayes": lambda: GaussianNB(),
+    "tree": lambda: DecisionTreeClassifier(min_samples_leaf=5, random_state=0),
+    "extra_tree": lambda: ExtraTreeClassifier(random_state=0),
+    "random_forest": lambda: RandomForestClassifier(n_estimators=10, max_depth=4, random_state=0),
+    "extra_trees": lambda: ExtraTreesClassifier(n_estimators=10, random_state=0),
+    "gdb": lambda: GradientBoostingClassifier(n_estimators=20, max_depth=2, random_state=0),
+    "knn": lambda: KNeighborsClassifier(n_neighbors=7),
+    "knn_distance": lambda: KNeighborsClassifier(n_neighbors=7, weights="distance"),
+}
+
+
+def dataset(n_classes, seed=0):
+    X, y = make_classification(n_samples=300, n_features=6, n_informative=4, n_classes=n_classes,
+                               random_state=seed)
+    return X[:200], y[:200] + 1, X[200:]
+
+
+def fitted(make, X, y):
+    # None for a machine this sklearn release can not fit on y, e.g.
+    # liblinear on three classes in newer releases
+    try:
+        return make().fit(X, y)
+    except ValueError:
+        return None
+
+
+def sklearn_outputs(estimator, X):
+    if isinstance(estimator, SVC):
+        return estimator.decision_function(X)
+    return estimator.predict_proba(X)
+
+
+@pytest.mark.filterwarnings("ignore::sklearn.exceptions.ConvergenceWarning")
+@pytest.mark.parametrize("n_classes", [2, 3])
+@pytest.mark.parametrize("name", sorted(MACHINES))
+def test_bank_matches_sklearn(name, n_classes):
+    X_train, y_train, X_test = dataset(n_classes)
+    estimator = fitted(MACHINES[name], X_train, y_train)
+    if estimator is None:
+        pytest.skip("%s can not be fitted on %d classes" % (name, n_classes))
+    bank = machinebank.compile_machines({name: estimator})
+
+    np.testing.assert_array_equal(bank.predict(X_test)[0], estimator.predict(X_test))
+    np.testing.assert_allclose(bank.outputs(X_test)[0], sklearn_outputs(estimator, X_test),
+                               rtol=1e-7, atol=1e-9)
+
+
+@pytest.mark.filterwarnings("ignore::sklearn.exceptions.ConvergenceWarning")
+def test_bank_of_many_machines_matches_sklearn():
+    # the machines share the matrix product and the tree walk
+    X_train, y_train, X_test = dataset(3, seed=1)
+    estimators = {name: fitted(make, X_train, y_train) for name, make in MACHINES.items()}
+    estimators = {name: estimator for name, estimator in estimators.items() if estimator is not None}
+    bank = machinebank.compile_machines(estimators)
+
+    labels = bank.predict(X_test)
+    for row, (name, estimator) in zip(labels, estimators.items()):
+        np.testing.assert_array_equal(row, estimator.predict(X_test), err_msg=name)
+    for output, (name, estimator) in zip(bank.outputs(X_test), estimators.items()):
+        np.testing.assert_allclose(output, sklearn_outputs(estimator, X_test),
+                                   rtol=1e-7, atol=1e-9, err_msg=name)
+
+
+@pytest.mark.parametrize("estimator", [SVC(kernel="rbf"), SVC(kernel="linear", probability=True)])
+def test_unsupported_machines_are_refused(estimator):
+    X_train, y_train, _ = dataset(2)
+    with pytest.raises(ValueError):
+        machinebank.compile_machines({"svm": estimator.fit(X_train, y_train)})
+
+
+@pytest.mark.filterwarnings("ignore::sklearn.exceptions.ConvergenceWarning")
+@pytest.mark.parametrize("n_classes", [2, 3])
+def test_exported_cobra_matches(n_classes):
+    X_train, y_train, X_test = dataset(n_classes, seed=2)
+    cobra = classifiercobra.ClassifierCobra(random_state=0, machine_list="advanced").fit(X_train, y_train)
+    compiled = cobra.export()
+
+    for M in range(1, len(cobra.estimators_) + 1):
+        np.testing.assert_array_equal(compiled.predict(X_test, M=M), cobra.predict(X_test, M=M))
+    np.testing.assert_allclose(compiled.predict_proba(X_test), cobra.predict_proba(X_test))
@@ -0,0 +1,46 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import pipelines
+
+
+def test_encoder_matches_get_dummies():
+    train = pd.DataFrame({"employ": ["A71", "A73"], "age": [30, 40], "purpose": ["A40", "A41"]})
+    layout = ["employ", "age", "purpose_A40", "purpose_A41"]
+    encoder = pipelines.CategoricalEncoder(layout, ordinal={"employ": {"A71": 1, "A73": 3}}).fit(train)
+
+    X = encoder.transform(pd.DataFrame({"employ": ["A73"], "age": [50], "purpose": ["A49"]}))
+    # an unseen nominal category encodes to zeros
+    np.testing.assert_array_equal(X, [[3, 50, 0, 0]])
+
+
+def test_unknown_ordinal_category_names_the_record():
+    train = pd.DataFrame({"employ": ["A71", "A73"]})
+    encoder = pipelines.CategoricalEncoder(["employ"], ordinal={"employ": {"A71": 1, "A73": 3}}).fit(train)
+    with pytest.raises(ValueError, match="'A99' for employ in record 2"):
+        encoder.transform(pd.DataFrame({"employ": ["A71", "A73", "A99"]}))
+
+
+def test_australian_pipeline_matches_sklearn():
+    from sklearn.decomposition import PCA
+    from sklearn.feature_selection import SelectFromModel
+    from sklearn.preprocessing import normalize
+    from sklearn.tree import DecisionTreeClassifier
+
+    import ingest
+
+    # the steps of model_australian.train on the real data
+    x, y, _ = ingest.parse_australian(ingest.SOURCES["australian"])
+    fs = SelectFromModel(DecisionTreeClassifier(class_weight='balanced', random_state=15).fit(x, y),
+                         threshold='median', prefit=True)
+    x_new = pd.DataFrame(fs.transform(x))
+    x_dummy = pd.get_dummies(x_new[[2, 3, 4]], columns=[2, 3, 4])
+    x_norm = pd.DataFrame(normalize(x_new[[0, 1, 5, 6]]))
+    pca = PCA(n_components=2).fit(x_norm)
+    expected = pd.concat([pd.DataFrame(pca.transform(x_norm)), x_dummy], axis=1).to_numpy(dtype=np.float64)
+
+    features = pipelines.AustralianPipeline().fit(fs, x_new, pca).transform(x)
+    # the one-hot columns are exact, the projection equal up to rounding
+    np.testing.assert_array_equal(features[:, 2:], expected[:, 2:])
+    np.testing.assert_allclose(features[:, :2], expected[:, :2], rtol=0, atol=1e-12)
@@ -0,0 +1,118 @@
+import numpy as np
+import pytest
+from sklearn.datasets import make_regression
+
+import consensus
+from regressorcobra import RegressorCobra
+
+
+def in_balls(calibration, query, epsilon):
+    # machines whose calibration prediction is within epsilon of the query's,
+    # shape (n_machines, n_query, n_points)
+    calibration = calibration[:, np.newaxis, :]
+    query = query[:, :, np.newaxis]
+    return (calibration >= query - epsilon) & (calibration <= query + epsilon)
+
+
+def scan(calibration, query, y, epsilon, M, exclude=None):
+    # the epsilon-ball selection point by point, and the mean of y over it
+    counts = in_balls(calibration, query, epsilon).sum(axis=0)
+    means = np.zeros(query.shape[1])
+    selected = []
+    for q in range(query.shape[1]):
+        points = [p for p in range(len(y)) if counts[q, p] == M
+                  and (exclude is None or p != exclude[q])]
+        selected.append(points)
+        if points:
+            means[q] = np.mean(y[points])
+    return selected, means
+
+
+def pairs(selected):
+    return sorted((q, p) for q, points in enumerate(selected) for p in points)
+
+
+@pytest.mark.parametrize("epsilon", [0.0, 1.0, 2.5, 100.0])
+@pytest.mark.parametrize("integral", [True, False])
+def test_ball_selection_matches_scan(epsilon, integral):
+    rng = np.random.RandomState(0)
+    # integral predictions put points exactly on the edges of the balls
+    if integral:
+        calibration = rng.randint(0, 10, size=(4, 60)).astype(np.float64)
+        query = rng.randint(0, 10, size=(4, 25)).astype(np.float64)
+    else:
+        calibration = rng.normal(size=(4, 60)) * 3
+        query = rng.normal(size=(4, 25)) * 3
+    y = rng.normal(size=60)
+    index = consensus.build_sorted_index(calibration)
+    lo, hi = consensus.epsilon_ranges(index, query, epsilon)
+
+    for M in range(5):
+        queries, points = consensus.ball_selection(index, lo, hi, M)
+        selected, expected = scan(calibration, query, y, epsilon, M)
+        assert sorted(zip(queries.tolist(), points.tolist())) == pairs(selected)
+        means, counts = consensus.ball_means(queries, points, y, query.shape[1])
+        np.testing.assert_allclose(means, expected)
+        assert counts.tolist() == [len(points) for points in selected]
+
+
+def test_ball_selection_excludes_points():
+    rng = np.random.RandomState(1)
+    calibration = rng.randint(0, 5, size=(3, 40)).astype(np.float64)
+    index = consensus.build_sorted_index(calibration)
+    lo, hi = consensus.epsilon_ranges(index, calibration, 1.0)
+    exclude = np.arange(40)
+
+    for M in range(4):
+        queries, points = consensus.ball_selection(index, lo, hi, M, exclude=exclude)
+        selected, _ = scan(calibration, calibration, np.zeros(40), 1.0, M, exclude=exclude)
+        assert sorted(zip(queries.tolist(), points.tolist())) == pairs(selected)
+
+
+@pytest.fixture(scope="module")
+def data():
+    X, y = make_regression(n_samples=240, n_features=5, noise=10.0, random_state=0)
+    return X[:200], y[:200], X[200:]
+
+
+@pytest.fixture(scope="module")
+def cobra(data):
+    X, y, _ = data
+    return RegressorCobra(random_state=0, epsilon=20.0).fit(X, y)
+
+
+def machine_predictions(cobra, X):
+    return np.array([cobra.estimators_[machine].predict(X) for machine in cobra.estimators_])
+
+
+def test_predict_matches_scan(cobra, data):
+    _, _, X_test = data
+    query = machine_predictions(cobra, X_test)
+    for M in range(1, len(cobra.estimators_) + 1):
+        _, expected = scan(cobra.machine_predictions_, query, cobra.y_l_, cobra.epsilon_, M)
+        np.testing.assert_allclose(cobra.predict(X_test, M=M), expected)
+        np.testing.assert_allclose(
+            [cobra.pred(X_test[i:i + 1], M) for i in range(5)], expected[:5])
+
+
+def test_tune_epsilon_matches_leave_one_out(cobra):
+    epsilons = [1.0, 5.0, 20.0, 80.0]
+    cobra.tune_epsilon(epsilons=epsilons)
+
+    calibration = cobra.machine_predictions_
+    n_points = len(cobra.y_l_)
+    scores = []
+    for epsilon in epsilons:
+        _, means = scan(calibration, calibration, cobra.y_l_, epsilon, len(calibration),
+                        exclude=np.arange(n_points))
+        scores.append(((means - cobra.y_l_) ** 2).mean())
+
+    np.testing.assert_allclose(cobra.epsilon_scores_, scores)
+    assert cobra.epsilon_ == epsilons[int(np.argmin(scores))]
+
+
+def test_fit_tunes_epsilon(data):
+    X, y, _ = data
+    cobra = RegressorCobra(random_state=0).fit(X, y)
+    assert cobra.epsilon_ == cobra.epsilon_grid_[np.argmin(cobra.epsilon_scores_)]
+    assert list(cobra.estimators_) == ["lasso", "tree", "ridge", "random_forest"]